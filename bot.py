@@ -5,6 +5,7 @@ from aiogram.fsm.state import StatesGroup, State
 from aiogram.filters import StateFilter
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.types import (
     InlineKeyboardMarkup,
     InlineKeyboardButton,
@@ -17,9 +18,12 @@ from aiogram.types import (
     ChosenInlineResult
 )
 
-import requests
+import math
 import random
 from decimal import Decimal
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import sqlite3
 from uuid import uuid4
@@ -40,8 +44,14 @@ import threading
 import ssl
 import random
 import string
-import difflib
 import unicodedata
+import difflib
+from email.utils import parsedate_to_datetime
+
+try:
+    import numpy as np  # необязательно: пакетная оценка в поиске
+except ImportError:
+    np = None
 
 PAGE_SIZE = 50
 ANIME_PER_PAGI = 90
@@ -53,7 +63,6 @@ MAX_TITLE_LEN = 30
 EPISODES_PER_PAGE = EPISODES_PER_ROW * ROWS_PER_PAGE
 WAITING_CHECK = set()
 PENDING_PAYMENTS = {}
-SHIKI_CACHE = {}
 PROCESSED_INVOICES = set()
 BURMALDOD_EDIT = {}
 LAST_SEARCH_MSG = {}
@@ -114,6 +123,31 @@ API_TOKEN = os.getenv("BOT_TOKEN")
 CRYPTOBOT_TOKEN = os.getenv("CRYPTOBOT_TOKEN")
 CRYPTOBOT_API_BASE = os.getenv("CRYPTOBOT_API_BASE", "https://pay.crypt.bot/api").rstrip("/")
 WEBHOOK_FULL_URL = os.getenv("WEBHOOK_FULL_URL")
+# Как часто обновлять курсы CryptoBot в памяти (секунды)
+CRYPTO_RATES_REFRESH = int(os.getenv("CRYPTO_RATES_REFRESH", "60"))
+# Курсы старше этого (секунды) для расчёта цены не используются
+RATE_MAX_AGE = int(os.getenv("RATE_MAX_AGE", "900"))
+
+# Как получать апдейты Telegram: "polling" (по умолчанию) или "webhook".
+# В режиме webhook Telegram шлёт апдейты на TELEGRAM_WEBHOOK_URL
+# (по умолчанию — тот же хост, что и WEBHOOK_FULL_URL, путь TELEGRAM_WEBHOOK_PATH),
+# маршрут вешается на то же aiohttp-приложение, что и платёжные вебхуки.
+TELEGRAM_DELIVERY = os.getenv("TELEGRAM_DELIVERY", "polling").strip().lower()
+TELEGRAM_WEBHOOK_PATH = os.getenv("TELEGRAM_WEBHOOK_PATH", "/telegram")
+TELEGRAM_WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL") or (
+    urllib.parse.urljoin(WEBHOOK_FULL_URL, TELEGRAM_WEBHOOK_PATH) if WEBHOOK_FULL_URL else None
+)
+# Секрет, который Telegram присылает в X-Telegram-Bot-Api-Secret-Token (A-Z, a-z, 0-9, _ и -).
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET")
+# Очереди апдейтов: сколько всего и сколько от одного пользователя/чата может ждать обработки.
+# Лишние апдейты отбрасываются с логом, а Telegram всё равно получает 200 —
+# повторная доставка 503 задержала бы вебхук для всех остальных.
+TELEGRAM_QUEUE_SIZE = int(os.getenv("TELEGRAM_QUEUE_SIZE", "2000"))
+TELEGRAM_USER_QUEUE_SIZE = int(os.getenv("TELEGRAM_USER_QUEUE_SIZE", "20"))
+# Сколько апдейтов обрабатывается одновременно.
+TELEGRAM_MAX_CONCURRENT_UPDATES = int(os.getenv("TELEGRAM_MAX_CONCURRENT_UPDATES", "64"))
+# Сколько секунд при остановке ждём апдейты, которые уже обрабатываются.
+TELEGRAM_SHUTDOWN_TIMEOUT = float(os.getenv("TELEGRAM_SHUTDOWN_TIMEOUT", "10"))
 
 # =========================
 # YooKassa settings
@@ -137,6 +171,36 @@ YOOMONEY_SECRET = os.getenv("YOOMONEY_SECRET")
 YOOMONEY_RETURN_URL = os.getenv("YOOMONEY_RETURN_URL") or WEBHOOK_FULL_URL or "https://t.me/"
 YOOMONEY_QUICKPAY_URL = "https://yoomoney.ru/quickpay/confirm"
 
+# =========================
+# Inline-поиск
+# =========================
+# INLINE_CACHE_TIME — сколько секунд Telegram может сам отдавать готовые
+# (не персональные) результаты inline-поиска, не обращаясь к боту.
+# INLINE_RESULTS_TTL / INLINE_RESULTS_SIZE — локальный кэш ранжированных списков.
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "300"))
+INLINE_RESULTS_TTL = int(os.getenv("INLINE_RESULTS_TTL", "600"))
+INLINE_RESULTS_SIZE = int(os.getenv("INLINE_RESULTS_SIZE", "1000"))
+# Подгрузка постеров/метаданных для страницы результатов: сколько запросов
+# одновременно и сколько секунд ждать, прежде чем ответить с заглушками.
+INLINE_HYDRATE_CONCURRENCY = int(os.getenv("INLINE_HYDRATE_CONCURRENCY", "8"))
+INLINE_HYDRATE_DEADLINE = float(os.getenv("INLINE_HYDRATE_DEADLINE", "4"))
+# Сколько секунд помнить, что Shikimori/AniList ничего не нашли по названию.
+NEGATIVE_CACHE_TTL = int(os.getenv("NEGATIVE_CACHE_TTL", str(6 * 60 * 60)))
+
+# =========================
+# Кэш метаданных Shikimori
+# =========================
+# META_CACHE_SIZE / META_CACHE_TTL — LRU в памяти процесса,
+# META_DB_TTL — сколько секунд считаются свежими данные в anime_info.
+META_CACHE_SIZE = int(os.getenv("META_CACHE_SIZE", "2000"))
+META_CACHE_TTL = int(os.getenv("META_CACHE_TTL", str(6 * 60 * 60)))
+META_DB_TTL = int(os.getenv("META_DB_TTL", str(7 * 24 * 60 * 60)))
+# Фоновая догрузка метаданных всего каталога:
+# METADATA_PREFETCH_INTERVAL — пауза на каждый тайтл (2 запроса к Shikimori, постеры пачкой в AniList),
+# METADATA_PREFETCH_RESCAN — как часто искать новые/устаревшие записи, когда очередь пуста.
+METADATA_PREFETCH_INTERVAL = float(os.getenv("METADATA_PREFETCH_INTERVAL", "2"))
+METADATA_PREFETCH_RESCAN = int(os.getenv("METADATA_PREFETCH_RESCAN", str(60 * 60)))
+
 ADMINS = [6265184966]
 ADMIN_CHAT_ID = ADMINS[0]
 
@@ -149,206 +213,681 @@ dp.include_router(router)
 # =========================
 # База данных
 # =========================
-db = sqlite3.connect("anime.db")
-cursor = db.cursor()
+DB_PATH = os.getenv("DB_PATH", "anime.db")
+# Потоков-читателей в DB и сколько секунд ждать чужую блокировку записи.
+DB_READERS = int(os.getenv("DB_READERS", "4"))
+DB_BUSY_TIMEOUT = float(os.getenv("DB_BUSY_TIMEOUT", "10"))
+# Кэш страниц на соединение (КиБ), размер mmap (байты) и как часто сбрасывать WAL в базу (секунды).
+DB_CACHE_KB = int(os.getenv("DB_CACHE_KB", str(32 * 1024)))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+DB_CHECKPOINT_INTERVAL = int(os.getenv("DB_CHECKPOINT_INTERVAL", "300"))
+# Очередь /darling: сколько хранить уже загруженные записи и когда считать claim зависшим (секунды).
+PENDING_VIDEOS_TTL = int(os.getenv("PENDING_VIDEOS_TTL", str(7 * 24 * 60 * 60)))
+PENDING_CLAIM_TIMEOUT = int(os.getenv("PENDING_CLAIM_TIMEOUT", "600"))
+
+
+def configure_connection(conn: sqlite3.Connection, readonly: bool = False):
+    """Общие PRAGMA для всех соединений с anime.db.
+
+    WAL: читатели не блокируют писателя и наоборот; synchronous=NORMAL в WAL
+    не теряет целостность, но fsync делается только на чекпоинте, а не на каждом commit.
+    """
+    if not readonly:
+        conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT * 1000)}")
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_KB}")
+    conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    if readonly:
+        conn.execute("PRAGMA query_only=ON")
 
-cursor.execute("DROP TABLE IF EXISTS pending_videos")
 
-cursor.execute("""
-CREATE TABLE pending_videos (
-    message_id INTEGER PRIMARY KEY,
-    file_id TEXT NOT NULL,
-    date TEXT
-)
-""")
-db.commit()
-
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS collection_likes (
-    collection_id INTEGER,
-    user_id INTEGER,
-    PRIMARY KEY (collection_id, user_id)
-)
-""")
-db.commit()
-
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS subscriptions (
-    user_id INTEGER PRIMARY KEY,
-    type TEXT,
-    expire_date TEXT
-)
-""")
-db.commit()
-
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS videos (
-    anime TEXT,
-    dub TEXT,
-    season INTEGER,
-    episode INTEGER,
-    file_id TEXT
-)
-""")
-db.commit()
-
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS users (
-    user_id INTEGER PRIMARY KEY,
-    first_start INTEGER,
-    paid_until INTEGER
-)
-""")
-db.commit()
-
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS user_profiles (
-    user_id INTEGER PRIMARY KEY,
-    nickname_html TEXT,
-    description_html TEXT,
-    photo TEXT,
-    updated_at TEXT
-)
-""")
-db.commit()
-
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS collections (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    owner_id INTEGER,
-    title TEXT NOT NULL,
-    description TEXT,
-    photo TEXT NOT NULL,
-    status TEXT NOT NULL
-)
-""")
-
-# В старых базах таблица collections уже существует без владельца.
-# Добавляем колонку безопасно, не удаляя существующие подборки.
-cursor.execute("PRAGMA table_info(collections)")
-collection_columns = [col[1] for col in cursor.fetchall()]
-if "owner_id" not in collection_columns:
-    cursor.execute("ALTER TABLE collections ADD COLUMN owner_id INTEGER")
-    db.commit()
-
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS collection_items (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    collection_id INTEGER NOT NULL,
-    anime TEXT NOT NULL,
-    position INTEGER NOT NULL,
-    FOREIGN KEY(collection_id) REFERENCES collections(id)
-)
-""")
-
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS processed_invoices (
-    invoice_id TEXT PRIMARY KEY,
-    user_id INTEGER,
-    period_key TEXT,
-    created_at TEXT
-)
-""")
-
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS referrals (
-    user_id INTEGER PRIMARY KEY,
-    my_code TEXT UNIQUE,
-    used_code TEXT,
-    referred_by INTEGER,
-    bonus_given INTEGER DEFAULT 0,
-    months_awarded INTEGER DEFAULT 0,
-    first_name TEXT,
-    username TEXT,
-    created_at TEXT
-)
-""")
-
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS watch_history (
-    user_id INTEGER,
-    anime TEXT,
-    dub TEXT,
-    season INTEGER,
-    episode INTEGER,
-    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    PRIMARY KEY (user_id, anime, dub, season)
-)
-""")
-
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS pending_payments (
-    user_id INTEGER PRIMARY KEY,
-    invoice_id TEXT,
-    period_key TEXT,
-    created_at TEXT
-)
-""")
-
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS anime_info (
-    anime TEXT PRIMARY KEY,
-    poster TEXT,
-    poster_file_id TEXT,
-    score TEXT,
-    genres TEXT,
-    year TEXT
-)
-""")
+def _migration_1_baseline(cursor):
+    """Схема, которая раньше создавалась/дополнялась при каждом запуске.
 
-db.commit()
+    Все шаги идемпотентны: на старой базе без schema_version ничего не ломают.
+    """
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS collection_likes (
+        collection_id INTEGER,
+        user_id INTEGER,
+        PRIMARY KEY (collection_id, user_id)
+    )
+    """)
 
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS anime_catalog (
-    id TEXT PRIMARY KEY,
-    anime TEXT UNIQUE NOT NULL
-)
-""")
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS subscriptions (
+        user_id INTEGER PRIMARY KEY,
+        type TEXT,
+        expire_date TEXT
+    )
+    """)
 
-db.commit()
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS videos (
+        anime TEXT,
+        dub TEXT,
+        season INTEGER,
+        episode INTEGER,
+        file_id TEXT
+    )
+    """)
 
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS user_bookmarks (
-    user_id INTEGER,
-    anime TEXT,
-    status TEXT,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    PRIMARY KEY(user_id, anime, status)
-)
-""")
-db.commit()
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        first_start INTEGER,
+        paid_until INTEGER
+    )
+    """)
+
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS user_profiles (
+        user_id INTEGER PRIMARY KEY,
+        nickname_html TEXT,
+        description_html TEXT,
+        photo TEXT,
+        updated_at TEXT
+    )
+    """)
+
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS collections (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        owner_id INTEGER,
+        title TEXT NOT NULL,
+        description TEXT,
+        photo TEXT NOT NULL,
+        status TEXT NOT NULL
+    )
+    """)
+
+    # В старых базах таблица collections уже существует без владельца.
+    # Добавляем колонку безопасно, не удаляя существующие подборки.
+    cursor.execute("PRAGMA table_info(collections)")
+    collection_columns = [col[1] for col in cursor.fetchall()]
+    if "owner_id" not in collection_columns:
+        cursor.execute("ALTER TABLE collections ADD COLUMN owner_id INTEGER")
+
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS collection_items (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        collection_id INTEGER NOT NULL,
+        anime TEXT NOT NULL,
+        position INTEGER NOT NULL,
+        FOREIGN KEY(collection_id) REFERENCES collections(id)
+    )
+    """)
+
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS processed_invoices (
+        invoice_id TEXT PRIMARY KEY,
+        user_id INTEGER,
+        period_key TEXT,
+        created_at TEXT
+    )
+    """)
+
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS referrals (
+        user_id INTEGER PRIMARY KEY,
+        my_code TEXT UNIQUE,
+        used_code TEXT,
+        referred_by INTEGER,
+        bonus_given INTEGER DEFAULT 0,
+        months_awarded INTEGER DEFAULT 0,
+        first_name TEXT,
+        username TEXT,
+        created_at TEXT
+    )
+    """)
+
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS watch_history (
+        user_id INTEGER,
+        anime TEXT,
+        dub TEXT,
+        season INTEGER,
+        episode INTEGER,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (user_id, anime, dub, season)
+    )
+    """)
+
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS pending_payments (
+        user_id INTEGER PRIMARY KEY,
+        invoice_id TEXT,
+        period_key TEXT,
+        created_at TEXT
+    )
+    """)
+
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS anime_info (
+        anime TEXT PRIMARY KEY,
+        poster TEXT,
+        poster_file_id TEXT,
+        score TEXT,
+        genres TEXT,
+        year TEXT
+    )
+    """)
+
+    # --- Описание/статус с Shikimori храним рядом с остальными метаданными ---
+    cursor.execute("PRAGMA table_info(anime_info)")
+    columns = [col[1] for col in cursor.fetchall()]
+    for column in ("description", "status_text", "fetched_at"):
+        if column not in columns:
+            cursor.execute(f"ALTER TABLE anime_info ADD COLUMN {column} TEXT")
+
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS anime_catalog (
+        id TEXT PRIMARY KEY,
+        anime TEXT UNIQUE NOT NULL
+    )
+    """)
+
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS user_bookmarks (
+        user_id INTEGER,
+        anime TEXT,
+        status TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY(user_id, anime, status)
+    )
+    """)
+
+    # --- Безопасно добавляем pay_url (если её нет) ---
+    cursor.execute("PRAGMA table_info(pending_payments)")
+    columns = [col[1] for col in cursor.fetchall()]
+
+    if "pay_url" not in columns:
+        cursor.execute("ALTER TABLE pending_payments ADD COLUMN pay_url TEXT")
+
+    cursor.execute("PRAGMA table_info(videos)")
+    columns = [col[1] for col in cursor.fetchall()]
 
+    # --- Безопасно добавляем english_name (если её нет) ---
+    # Используется для поиска постеров и теперь может задаваться сразу в /darling.
+    if "english_name" not in columns:
+        cursor.execute("ALTER TABLE videos ADD COLUMN english_name TEXT")
+        print("✅ Колонка english_name создана в таблице videos")
 
-# --- Безопасно добавляем pay_url (если её нет) ---
-cursor.execute("PRAGMA table_info(pending_payments)")
-columns = [col[1] for col in cursor.fetchall()]
+    # Если раньше была старая колонка title_en — аккуратно переносим данные в english_name.
+    cursor.execute("PRAGMA table_info(videos)")
+    columns = [col[1] for col in cursor.fetchall()]
+    if "title_en" in columns and "english_name" in columns:
+        cursor.execute("""
+            UPDATE videos
+            SET english_name = title_en
+            WHERE (english_name IS NULL OR english_name = '')
+              AND title_en IS NOT NULL
+              AND title_en != ''
+        """)
+
+
+# Индексы под частые запросы в текущей схеме. Имена нужны и /dbbench, чтобы показать план "до".
+# Серии по озвучке ищутся по PRIMARY KEY episodes — его не удалить, поэтому здесь его нет.
+SCHEMA_INDEXES = [
+    # Список озвучек сезона (создаётся в миграциях v4/v5 вместе с episodes)
+    ("idx_episodes_title_season_dub", "episodes(title_id, kind, season, dub_id)"),
+    # Закладки по статусу, свежие сверху
+    ("idx_user_bookmarks_user_status_created",
+     "user_bookmarks(user_id, status, created_at, anime)"),
+    # История просмотра, свежие сверху
+    ("idx_watch_history_user_updated", "watch_history(user_id, updated_at)"),
+    # Состав подборки по порядку
+    ("idx_collection_items_collection_position",
+     "collection_items(collection_id, position, anime)"),
+    # Топ по рейтингу (ORDER BY CAST(score AS REAL))
+    ("idx_anime_info_score", "anime_info(CAST(score AS REAL))"),
+    # Очистка старых invoice
+    ("idx_processed_invoices_created", "processed_invoices(created_at)"),
+]
+
+
+# Индексы таблицы videos на момент v2. Таблицу заменили в v4, индексы ушли вместе с ней.
+_MIGRATION_2_VIDEOS_INDEXES = [
+    ("idx_videos_anime_dub_season_episode",
+     "videos(anime, dub, season, episode, file_id)"),
+    ("idx_videos_anime_season_dub", "videos(anime, season, dub)"),
+]
+
+
+def _migration_2_indexes(cursor):
+    # collection_likes(collection_id, user_id) уже покрыт PRIMARY KEY.
+    # Индексы episodes создают миграции v4/v5: на v2 этой таблицы ещё нет.
+    indexes = _MIGRATION_2_VIDEOS_INDEXES + [
+        (name, target) for name, target in SCHEMA_INDEXES if not target.startswith("episodes(")
+    ]
+    for name, target in indexes:
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {target}")
+    cursor.execute("ANALYZE")
+
+
+def _migration_3_pending_videos(cursor):
+    """Очередь /darling переживает перезапуск: статус, кто забрал, когда загружено."""
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS pending_videos (
+        message_id INTEGER PRIMARY KEY,
+        file_id TEXT NOT NULL,
+        date TEXT
+    )
+    """)
+    cursor.execute("PRAGMA table_info(pending_videos)")
+    columns = [col[1] for col in cursor.fetchall()]
+    for column, ddl in (
+        ("status", "TEXT NOT NULL DEFAULT 'pending'"),
+        ("claim_token", "TEXT"),
+        ("claimed_at", "TEXT"),
+        ("ingested_at", "TEXT"),
+    ):
+        if column not in columns:
+            cursor.execute(f"ALTER TABLE pending_videos ADD COLUMN {column} {ddl}")
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_pending_videos_status_date "
+        "ON pending_videos(status, date)"
+    )
+
+
+def _migration_4_normalized_videos(cursor):
+    """videos -> titles / dubs / episodes с целочисленными ключами.
+
+    Название, озвучка и english_name больше не повторяются в каждой серии.
+    videos остаётся представлением с INSTEAD OF-триггерами, так что админские
+    команды и редкие запросы работают с ним как раньше.
+    """
+    cursor.execute("""
+    CREATE TABLE titles (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE,
+        english_name TEXT
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE dubs (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE episodes (
+        title_id INTEGER NOT NULL REFERENCES titles(id),
+        dub_id INTEGER NOT NULL REFERENCES dubs(id),
+        season INTEGER NOT NULL,
+        episode INTEGER NOT NULL,
+        file_id TEXT NOT NULL,
+        PRIMARY KEY (title_id, dub_id, season, episode)
+    ) WITHOUT ROWID
+    """)
+    # Список озвучек сезона
+    cursor.execute("CREATE INDEX idx_episodes_title_season_dub ON episodes(title_id, season, dub_id)")
+
+    # Переносим в порядке добавления: у дублей серии остаётся первая строка, как и раньше.
+    cursor.execute("SELECT anime, dub, season, episode, file_id, english_name FROM videos ORDER BY rowid")
+    rows = cursor.fetchall()
+    title_ids, dub_ids = {}, {}
+    duplicates = []
+    for anime, dub, season, episode, file_id, english_name in rows:
+        if anime not in title_ids:
+            cursor.execute("INSERT INTO titles (name) VALUES (?)", (anime,))
+            title_ids[anime] = cursor.lastrowid
+        if english_name:
+            cursor.execute(
+                "UPDATE titles SET english_name=? WHERE id=? AND english_name IS NULL",
+                (english_name, title_ids[anime])
+            )
+        if dub not in dub_ids:
+            cursor.execute("INSERT INTO dubs (name) VALUES (?)", (dub,))
+            dub_ids[dub] = cursor.lastrowid
+        try:
+            cursor.execute(
+                "INSERT INTO episodes (title_id, dub_id, season, episode, file_id) VALUES (?, ?, ?, ?, ?)",
+                (title_ids[anime], dub_ids[dub], season, episode, file_id)
+            )
+        except sqlite3.IntegrityError:
+            duplicates.append((anime, dub, season, episode))
+
+    if duplicates:
+        print(f"⚠️ Дубли серий при переносе videos: {len(duplicates)}, у каждой оставлена первая загрузка")
+        for anime, dub, season, episode in duplicates:
+            print(f"   {anime} | {dub} | {season} | {episode}")
+
+    cursor.execute("DROP TABLE videos")
+    cursor.execute("""
+    CREATE VIEW videos AS
+    SELECT t.name AS anime, d.name AS dub, e.season, e.episode, e.file_id, t.english_name
+    FROM episodes e
+    JOIN titles t ON t.id = e.title_id
+    JOIN dubs d ON d.id = e.dub_id
+    """)
+    cursor.execute("""
+    CREATE TRIGGER videos_insert INSTEAD OF INSERT ON videos
+    BEGIN
+        INSERT OR IGNORE INTO titles (name) VALUES (NEW.anime);
+        UPDATE titles SET english_name = NEW.english_name
+        WHERE name = NEW.anime AND COALESCE(NEW.english_name, '') != '';
+        INSERT OR IGNORE INTO dubs (name) VALUES (NEW.dub);
+        INSERT OR IGNORE INTO episodes (title_id, dub_id, season, episode, file_id)
+        VALUES (
+            (SELECT id FROM titles WHERE name = NEW.anime),
+            (SELECT id FROM dubs WHERE name = NEW.dub),
+            NEW.season, NEW.episode, NEW.file_id
+        );
+    END
+    """)
+    # Через представление можно менять english_name и file_id; переименование — только удалить и добавить.
+    cursor.execute("""
+    CREATE TRIGGER videos_update INSTEAD OF UPDATE ON videos
+    BEGIN
+        UPDATE titles SET english_name = NEW.english_name
+        WHERE name = OLD.anime AND NEW.english_name IS NOT OLD.english_name;
+        UPDATE episodes SET file_id = NEW.file_id
+        WHERE title_id = (SELECT id FROM titles WHERE name = OLD.anime)
+          AND dub_id = (SELECT id FROM dubs WHERE name = OLD.dub)
+          AND season = OLD.season
+          AND episode = OLD.episode;
+    END
+    """)
+    cursor.execute("""
+    CREATE TRIGGER videos_delete INSTEAD OF DELETE ON videos
+    BEGIN
+        DELETE FROM episodes
+        WHERE title_id = (SELECT id FROM titles WHERE name = OLD.anime)
+          AND dub_id = (SELECT id FROM dubs WHERE name = OLD.dub)
+          AND season = OLD.season
+          AND episode = OLD.episode;
+        DELETE FROM titles
+        WHERE name = OLD.anime
+          AND NOT EXISTS (SELECT 1 FROM episodes WHERE title_id = titles.id);
+    END
+    """)
+    cursor.execute("ANALYZE")
+
+
+def _migration_5_typed_seasons(cursor):
+    """Сезон и серия в episodes — только целые числа, фильм отмечается kind.
+
+    Раньше в season лежал либо номер, либо строка "Фильм", и фильтры по нему
+    приходилось писать через CAST — мимо индексов. Теперь фильм — это
+    kind='film' и season=0. Представление videos по-прежнему отдаёт "Фильм",
+    так что хэши callback'ов и остальной код не меняются.
+    """
+    for trigger in ("videos_insert", "videos_update", "videos_delete"):
+        cursor.execute(f"DROP TRIGGER {trigger}")
+    cursor.execute("DROP VIEW videos")
 
-if "pay_url" not in columns:
-    cursor.execute("ALTER TABLE pending_payments ADD COLUMN pay_url TEXT")
-    db.commit()
+    cursor.execute("""
+    CREATE TABLE episodes_typed (
+        title_id INTEGER NOT NULL REFERENCES titles(id),
+        dub_id INTEGER NOT NULL REFERENCES dubs(id),
+        kind TEXT NOT NULL CHECK (kind IN ('series', 'film')),
+        season INTEGER NOT NULL CHECK (typeof(season) = 'integer'),
+        episode INTEGER NOT NULL CHECK (typeof(episode) = 'integer'),
+        file_id TEXT NOT NULL,
+        PRIMARY KEY (title_id, dub_id, kind, season, episode)
+    ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+    INSERT INTO episodes_typed (title_id, dub_id, kind, season, episode, file_id)
+    SELECT title_id, dub_id,
+           CASE WHEN season = 'Фильм' THEN 'film' ELSE 'series' END,
+           CASE WHEN season = 'Фильм' THEN 0 ELSE CAST(season AS INTEGER) END,
+           CAST(episode AS INTEGER),
+           file_id
+    FROM episodes
+    """)
+    cursor.execute("DROP TABLE episodes")
+    cursor.execute("ALTER TABLE episodes_typed RENAME TO episodes")
+    # Список озвучек сезона
+    cursor.execute("CREATE INDEX idx_episodes_title_season_dub ON episodes(title_id, kind, season, dub_id)")
+
+    # UNION ALL, а не CASE: условие season=? уходит в каждую ветку отдельно,
+    # и для сериалов это поиск по индексу, а не проверка каждой строки тайтла.
+    cursor.execute("""
+    CREATE VIEW videos AS
+    SELECT t.name AS anime, d.name AS dub, e.season, e.episode, e.file_id, t.english_name
+    FROM episodes e
+    JOIN titles t ON t.id = e.title_id
+    JOIN dubs d ON d.id = e.dub_id
+    WHERE e.kind = 'series'
+    UNION ALL
+    SELECT t.name, d.name, 'Фильм', e.episode, e.file_id, t.english_name
+    FROM episodes e
+    JOIN titles t ON t.id = e.title_id
+    JOIN dubs d ON d.id = e.dub_id
+    WHERE e.kind = 'film'
+    """)
+    cursor.execute("""
+    CREATE TRIGGER videos_insert INSTEAD OF INSERT ON videos
+    BEGIN
+        INSERT OR IGNORE INTO titles (name) VALUES (NEW.anime);
+        UPDATE titles SET english_name = NEW.english_name
+        WHERE name = NEW.anime AND COALESCE(NEW.english_name, '') != '';
+        INSERT OR IGNORE INTO dubs (name) VALUES (NEW.dub);
+        INSERT OR IGNORE INTO episodes (title_id, dub_id, kind, season, episode, file_id)
+        VALUES (
+            (SELECT id FROM titles WHERE name = NEW.anime),
+            (SELECT id FROM dubs WHERE name = NEW.dub),
+            CASE WHEN NEW.season = 'Фильм' THEN 'film' ELSE 'series' END,
+            CASE WHEN NEW.season = 'Фильм' THEN 0 ELSE CAST(NEW.season AS INTEGER) END,
+            CAST(NEW.episode AS INTEGER),
+            NEW.file_id
+        );
+    END
+    """)
+    cursor.execute("""
+    CREATE TRIGGER videos_update INSTEAD OF UPDATE ON videos
+    BEGIN
+        UPDATE titles SET english_name = NEW.english_name
+        WHERE name = OLD.anime AND NEW.english_name IS NOT OLD.english_name;
+        UPDATE episodes SET file_id = NEW.file_id
+        WHERE title_id = (SELECT id FROM titles WHERE name = OLD.anime)
+          AND dub_id = (SELECT id FROM dubs WHERE name = OLD.dub)
+          AND kind = CASE WHEN OLD.season = 'Фильм' THEN 'film' ELSE 'series' END
+          AND season = CASE WHEN OLD.season = 'Фильм' THEN 0 ELSE OLD.season END
+          AND episode = OLD.episode;
+    END
+    """)
+    cursor.execute("""
+    CREATE TRIGGER videos_delete INSTEAD OF DELETE ON videos
+    BEGIN
+        DELETE FROM episodes
+        WHERE title_id = (SELECT id FROM titles WHERE name = OLD.anime)
+          AND dub_id = (SELECT id FROM dubs WHERE name = OLD.dub)
+          AND kind = CASE WHEN OLD.season = 'Фильм' THEN 'film' ELSE 'series' END
+          AND season = CASE WHEN OLD.season = 'Фильм' THEN 0 ELSE OLD.season END
+          AND episode = OLD.episode;
+        DELETE FROM titles
+        WHERE name = OLD.anime
+          AND NOT EXISTS (SELECT 1 FROM episodes WHERE title_id = titles.id);
+    END
+    """)
+    cursor.execute("ANALYZE")
 
-cursor.execute("PRAGMA table_info(videos)")
-columns = [col[1] for col in cursor.fetchall()]
 
-# --- Безопасно добавляем english_name (если её нет) ---
-# Используется для поиска постеров и теперь может задаваться сразу в /darling.
-if "english_name" not in columns:
-    cursor.execute("ALTER TABLE videos ADD COLUMN english_name TEXT")
-    db.commit()
-    print("✅ Колонка english_name создана в таблице videos")
+def _migration_6_strict_episode_insert(cursor):
+    """Вставка через videos больше не глотает уже существующую серию.
 
-# Если раньше была старая колонка title_en — аккуратно переносим данные в english_name.
-cursor.execute("PRAGMA table_info(videos)")
-columns = [col[1] for col in cursor.fetchall()]
-if "title_en" in columns and "english_name" in columns:
+    Раньше INSERT OR IGNORE в триггере молча выбрасывал новый file_id, а /add и
+    /darling сообщали об успехе. Теперь конфликт ключа серии — IntegrityError,
+    и команда говорит админу, какие серии уже есть.
+    """
+    cursor.execute("DROP TRIGGER videos_insert")
     cursor.execute("""
-        UPDATE videos
-        SET english_name = title_en
-        WHERE (english_name IS NULL OR english_name = '')
-          AND title_en IS NOT NULL
-          AND title_en != ''
+    CREATE TRIGGER videos_insert INSTEAD OF INSERT ON videos
+    BEGIN
+        INSERT OR IGNORE INTO titles (name) VALUES (NEW.anime);
+        UPDATE titles SET english_name = NEW.english_name
+        WHERE name = NEW.anime AND COALESCE(NEW.english_name, '') != '';
+        INSERT OR IGNORE INTO dubs (name) VALUES (NEW.dub);
+        INSERT INTO episodes (title_id, dub_id, kind, season, episode, file_id)
+        VALUES (
+            (SELECT id FROM titles WHERE name = NEW.anime),
+            (SELECT id FROM dubs WHERE name = NEW.dub),
+            CASE WHEN NEW.season = 'Фильм' THEN 'film' ELSE 'series' END,
+            CASE WHEN NEW.season = 'Фильм' THEN 0 ELSE CAST(NEW.season AS INTEGER) END,
+            CAST(NEW.episode AS INTEGER),
+            NEW.file_id
+        );
+    END
     """)
-    db.commit()
+
+
+# Версия схемы -> что делает миграция (получает курсор писателя).
+# Новые изменения схемы — только новой записью в конце.
+MIGRATIONS = [
+    (1, "базовая схема", _migration_1_baseline),
+    (2, "индексы под частые запросы, ANALYZE", _migration_2_indexes),
+    (3, "постоянная очередь pending_videos", _migration_3_pending_videos),
+    (4, "videos -> titles/dubs/episodes", _migration_4_normalized_videos),
+    (5, "целые season/episode, kind для фильмов", _migration_5_typed_seasons),
+    (6, "вставка серии без OR IGNORE", _migration_6_strict_episode_insert),
+]
+
+
+def init_db(conn: sqlite3.Connection):
+    """Создаёт/обновляет схему базы. Вызывается один раз из main() через DB.write.
+
+    Применяет недостающие миграции из MIGRATIONS по schema_version.
+    Всё идёт одной транзакцией: при падении посередине база остаётся
+    в прежнем состоянии, а на старте — один fsync вместо десятка.
+    WAL включает configure_connection ещё до транзакции, при открытии соединения.
+    """
+    cursor = conn.cursor()
+    cursor.execute("BEGIN")
+    try:
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TEXT
+        )
+        """)
+        cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+        current = cursor.fetchone()[0]
+
+        for version, description, migrate in MIGRATIONS:
+            if version <= current:
+                continue
+            migrate(cursor)
+            cursor.execute(
+                "INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+                (version, description, datetime.now().isoformat())
+            )
+            print(f"✅ Схема БД обновлена до версии {version}: {description}")
+    except Exception:
+        conn.rollback()
+        raise
+    conn.commit()
+
+
+class Database:
+    """Доступ к SQLite вне event loop.
+
+    Запись — через один поток со своим соединением (транзакции идут строго
+    по очереди и не ждут друг друга на блокировке), чтение — через пул потоков,
+    у каждого из которых своё read-only соединение. В WAL читатели работают
+    параллельно с писателем. Хэндлеры только ждут результат.
+    """
+
+    def __init__(self, path: str, readers: int = 4):
+        self.path = path
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-reader")
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            readonly = threading.current_thread().name.startswith("db-reader")
+            if readonly:
+                uri = f"file:{urllib.parse.quote(os.path.abspath(self.path))}?mode=ro"
+                conn = sqlite3.connect(uri, uri=True, timeout=DB_BUSY_TIMEOUT, check_same_thread=False)
+            else:
+                conn = sqlite3.connect(self.path, timeout=DB_BUSY_TIMEOUT, check_same_thread=False)
+            configure_connection(conn, readonly=readonly)
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    async def _submit(self, executor, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+    # --- чтение ---
+    def _fetch(self, sql, params, one):
+        cur = self._connection().execute(sql, params)
+        try:
+            return cur.fetchone() if one else cur.fetchall()
+        finally:
+            cur.close()
+
+    async def fetchone(self, sql: str, params=()):
+        return await self._submit(self._readers, self._fetch, sql, params, True)
+
+    async def fetchall(self, sql: str, params=()) -> list:
+        return await self._submit(self._readers, self._fetch, sql, params, False)
+
+    async def fetchval(self, sql: str, params=(), default=None):
+        row = await self.fetchone(sql, params)
+        return row[0] if row else default
+
+    async def read(self, func, *args):
+        """Выполняет func(conn, *args) в потоке-читателе."""
+        return await self._submit(self._readers, lambda: func(self._connection(), *args))
+
+    # --- запись ---
+    def _execute(self, sql, params, many):
+        conn = self._connection()
+        with conn:
+            cur = conn.executemany(sql, params) if many else conn.execute(sql, params)
+            return cur.rowcount
+
+    async def execute(self, sql: str, params=()) -> int:
+        """Один запрос в отдельной транзакции; возвращает rowcount."""
+        return await self._submit(self._writer, self._execute, sql, params, False)
+
+    async def executemany(self, sql: str, seq_of_params) -> int:
+        return await self._submit(self._writer, self._execute, sql, list(seq_of_params), True)
+
+    async def transaction(self, func, *args):
+        """Выполняет func(conn, *args) в потоке-писателе одной транзакцией."""
+        def run():
+            conn = self._connection()
+            with conn:
+                return func(conn, *args)
+        return await self._submit(self._writer, run)
+
+    async def write(self, func, *args):
+        """Выполняет func(conn, *args) в потоке-писателе; транзакцией func управляет сама."""
+        return await self._submit(self._writer, lambda: func(self._connection(), *args))
+
+    def _checkpoint(self, mode):
+        return self._connection().execute(f"PRAGMA wal_checkpoint({mode})").fetchone()
+
+    async def checkpoint(self, mode: str = "PASSIVE"):
+        """Переносит WAL в основной файл; возвращает (busy, страниц в WAL, перенесено)."""
+        return await self._submit(self._writer, self._checkpoint, mode)
+
+    def close(self):
+        try:
+            self._writer.submit(self._checkpoint, "TRUNCATE").result()
+        except Exception as e:
+            logging.warning(f"[DB] Финальный чекпоинт не удался: {e}")
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+
+DB = Database(DB_PATH, readers=DB_READERS)
 
 
 
@@ -401,10 +940,6 @@ def format_anime_title(title: str) -> str:
     return string.capwords(title)
 
 
-r = requests.get(f"https://api.telegram.org/bot{API_TOKEN}/setWebhook?url={WEBHOOK_FULL_URL}")
-print(r.text)  # должен вернуть {"ok":true,...}
-
-
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s | %(levelname)s | %(message)s"
@@ -418,10 +953,9 @@ class MultiEpisodes(StatesGroup):
 # Вспомогательные функции
 # =========================
 
-def has_active_sub(user_id: int) -> bool:
+async def has_active_sub(user_id: int) -> bool:
     """Проверяет, есть ли у пользователя активная подписка."""
-    cursor.execute("SELECT expire_date FROM subscriptions WHERE user_id=?", (user_id,))
-    row = cursor.fetchone()
+    row = await DB.fetchone("SELECT expire_date FROM subscriptions WHERE user_id=?", (user_id,))
 
     if not row or not row[0]:
         return False
@@ -438,6 +972,32 @@ async def send_and_track(user_id, send_func, *args, **kwargs):
         tracked.append(msg.message_id)
     return msg
 
+async def send_anime_poster(user_id, send_func, anime, poster_url, **kwargs):
+    """Отправляет карточку аниме с постером.
+
+    Постер загружается в Telegram один раз: file_id из ответа сохраняется в
+    anime_info.poster_file_id и дальше используется вместо URL. Если Telegram
+    не принял сохранённый file_id, он сбрасывается и фото уходит по URL.
+    """
+    poster_file_id = await DB.fetchval("SELECT poster_file_id FROM anime_info WHERE anime=?", (anime,))
+
+    if poster_file_id:
+        try:
+            return await send_and_track(user_id, send_func, photo=poster_file_id, **kwargs)
+        except TelegramBadRequest as e:
+            logging.warning(f"[poster] file_id для {anime} не принят: {e}")
+            await DB.execute("UPDATE anime_info SET poster_file_id=NULL WHERE anime=?", (anime,))
+
+    msg = await send_and_track(user_id, send_func, photo=poster_url, **kwargs)
+
+    if msg.photo:
+        await DB.execute(
+            "UPDATE anime_info SET poster_file_id=? WHERE anime=?",
+            (msg.photo[-1].file_id, anime)
+        )
+
+    return msg
+
 async def delete_bot_messages(user_id, chat_id):
     """Удаляет все сообщения бота пользователя"""
     for msg_id in USER_MESSAGES.get(user_id, []):
@@ -453,54 +1013,513 @@ def make_cb_id(*args):
     s = "|".join(args)
     return hashlib.md5(s.encode()).hexdigest()
 
-def get_or_create_anime_id(anime: str):
-    cursor.execute("SELECT id FROM anime_catalog WHERE anime=?", (anime,))
-    row = cursor.fetchone()
+
+# =========================
+# СНИМОК КАТАЛОГА
+# =========================
+def _sql_order_key(value):
+    """Порядок как у ORDER BY в SQLite: NULL, затем числа, затем текст ("Фильм" после сезонов)."""
+    if value is None:
+        return (0, 0)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    return (2, value)
+
+
+class CatalogSnapshot:
+    """Неизменяемый снимок таблицы videos: аниме -> сезон -> озвучка -> серии.
+
+    Собирается целиком и подменяется одной ссылкой (CATALOG), поэтому хэндлер,
+    взявший снимок, видит согласованные данные и не делает ни одного SQL-запроса.
+    version растёт с каждой пересборкой — по нему ключуются зависящие от каталога кэши.
+    Заодно хранит хэши из callback_data -> ключ строки videos.
+    """
+
+    def __init__(self, version: int, rows):
+        tree = {}
+        for anime, dub, season, episode, file_id in rows:
+            episodes = tree.setdefault(anime, {}).setdefault(season, {}).setdefault(dub, {})
+            # Как и при переборе таблицы, дубль серии не перетирает первую строку
+            episodes.setdefault(episode, file_id)
+
+        self.version = version
+        self.animes = tuple(sorted(tree))
+        self._seasons = {}    # anime -> (season, ...)
+        self._dubs = {}       # (anime, season) -> (dub, ...)
+        self._episodes = {}   # (anime, dub, season) -> (episode, ...) по возрастанию
+        self._file_ids = {}   # (anime, dub, season) -> {episode: file_id}
+        self._season_hashes = {}   # make_cb_id(anime, season) -> (anime, season)
+        self._dub_hashes = {}      # make_cb_id(anime, dub, season) -> (anime, dub, season)
+        self._episode_hashes = {}  # make_cb_id(anime, dub, season, episode) -> (anime, dub, season, episode, file_id)
+
+        for anime, seasons in tree.items():
+            self._seasons[anime] = tuple(sorted(seasons, key=_sql_order_key))
+            for season, dubs in seasons.items():
+                self._dubs[(anime, season)] = tuple(sorted(dubs, key=_sql_order_key))
+                self._season_hashes.setdefault(make_cb_id(anime, str(season)), (anime, season))
+                for dub, episodes in dubs.items():
+                    key = (anime, dub, season)
+                    self._episodes[key] = tuple(sorted(episodes, key=_sql_order_key))
+                    self._file_ids[key] = episodes
+                    self._dub_hashes.setdefault(make_cb_id(anime, dub, str(season)), key)
+                    for episode, file_id in episodes.items():
+                        self._episode_hashes.setdefault(
+                            make_cb_id(anime, dub, str(season), str(episode)),
+                            (anime, dub, season, episode, file_id)
+                        )
+
+    def __contains__(self, anime):
+        return anime in self._seasons
+
+    def seasons(self, anime) -> tuple:
+        return self._seasons.get(anime, ())
+
+    def dubs(self, anime, season) -> tuple:
+        return self._dubs.get((anime, season), ())
+
+    def episodes(self, anime, dub, season) -> tuple:
+        return self._episodes.get((anime, dub, season), ())
+
+    def file_id(self, anime, dub, season, episode):
+        return self._file_ids.get((anime, dub, season), {}).get(episode)
+
+    # Всё ниже — бинпоиск по отсортированному кортежу серий, без перебора и без SQL.
+    def episode_position(self, anime, dub, season, episode) -> int:
+        """Индекс серии в списке (или куда бы она встала), страница — position // EPISODES_PER_PAGE."""
+        return bisect_left(self.episodes(anime, dub, season), _sql_order_key(episode), key=_sql_order_key)
+
+    def neighbours(self, anime, dub, season, episode) -> tuple:
+        """(предыдущая, следующая) существующая серия или None. Пропуски в нумерации перешагиваются."""
+        episodes = self.episodes(anime, dub, season)
+        i = bisect_left(episodes, _sql_order_key(episode), key=_sql_order_key)
+        j = bisect_right(episodes, _sql_order_key(episode), lo=i, key=_sql_order_key)
+        return (
+            episodes[i - 1] if i > 0 else None,
+            episodes[j] if j < len(episodes) else None,
+        )
+
+    def episode_range(self, anime, dub, season, first, last) -> list:
+        """[(episode, file_id), ...] с номерами от first до last включительно."""
+        episodes = self.episodes(anime, dub, season)
+        lo = bisect_left(episodes, _sql_order_key(first), key=_sql_order_key)
+        hi = bisect_right(episodes, _sql_order_key(last), lo=lo, key=_sql_order_key)
+        file_ids = self._file_ids[(anime, dub, season)] if hi > lo else {}
+        return [(episode, file_ids[episode]) for episode in episodes[lo:hi]]
+
+    def episode_page(self, anime, dub, season, page: int, per_page: int) -> list:
+        """[(episode, file_id), ...] страницы page."""
+        episodes = self.episodes(anime, dub, season)[page * per_page:(page + 1) * per_page]
+        file_ids = self._file_ids.get((anime, dub, season), {})
+        return [(episode, file_ids[episode]) for episode in episodes]
+
+    def episode_blocks(self, anime, dub, season, per_page: int) -> list:
+        """[(первая, последняя серия), ...] по страницам — подписи для «Быстрого перехода»."""
+        episodes = self.episodes(anime, dub, season)
+        return [
+            (episodes[start], episodes[min(start + per_page, len(episodes)) - 1])
+            for start in range(0, len(episodes), per_page)
+        ]
+
+    def by_episode_hash(self, ep_hash):
+        return self._episode_hashes.get(ep_hash)
+
+    def by_dub_hash(self, dub_hash):
+        return self._dub_hashes.get(dub_hash)
+
+    def by_season_hash(self, season_hash):
+        return self._season_hashes.get(season_hash)
+
+    @property
+    def episode_count(self) -> int:
+        return len(self._episode_hashes)
+
+    @property
+    def dub_count(self) -> int:
+        return len(self._dub_hashes)
+
+
+CATALOG = CatalogSnapshot(0, ())
+# Пересборки идут по очереди: иначе снимок, прочитанный раньше, мог бы подменить более свежий.
+CATALOG_REBUILD_LOCK = asyncio.Lock()
+
+
+async def rebuild_catalog():
+    """Собирает новый снимок каталога из videos и атомарно подменяет CATALOG."""
+    global CATALOG
+    async with CATALOG_REBUILD_LOCK:
+        rows = await DB.fetchall("SELECT anime, dub, season, episode, file_id FROM videos")
+        CATALOG = CatalogSnapshot(CATALOG.version + 1, rows)
+    logging.info(
+        f"Снимок каталога v{CATALOG.version}: {len(CATALOG.animes)} аниме, "
+        f"{CATALOG.episode_count} серий, {CATALOG.dub_count} озвучек"
+    )
+
+
+async def on_catalog_changed(*animes):
+    """Вызывается после любого изменения videos (/darling, /add, /delete)"""
+    await rebuild_catalog()
+    for anime in animes:
+        await SEARCH_INDEX.refresh(anime)
+        enqueue_metadata_prefetch(anime)
+
+
+def resolve_episode_hash(ep_hash):
+    """(anime, dub, season, episode, file_id) или None"""
+    return CATALOG.by_episode_hash(ep_hash)
+
+
+def resolve_dub_hash(dub_hash):
+    """(anime, dub, season) или None"""
+    return CATALOG.by_dub_hash(dub_hash)
+
+
+def resolve_season_hash(season_hash):
+    """(anime, season) или None"""
+    return CATALOG.by_season_hash(season_hash)
+
+
+# =========================
+# КЭШ С TTL
+# =========================
+class TTLCache:
+    """Небольшой LRU-кэш с временем жизни записей."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return default
+
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: float | None = None):
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+# Ранжированные списки inline-поиска: (версия каталога, ключ) -> полный список аниме
+INLINE_RESULTS_CACHE = TTLCache(INLINE_RESULTS_SIZE, INLINE_RESULTS_TTL)
+
+# Метаданные Shikimori (get_anime_info): память -> anime_info -> сеть
+META_CACHE = TTLCache(META_CACHE_SIZE, META_CACHE_TTL)
+META_CACHE_STATS = {"memory_hits": 0, "db_hits": 0, "misses": 0}
+
+# ("shikimori" | "anilist", title) -> True: внешний сервис ничего не нашёл
+NEGATIVE_CACHE = TTLCache(10000, NEGATIVE_CACHE_TTL)
+
+
+# =========================
+# ОБЩИЙ HTTP-КЛИЕНТ
+# =========================
+# Настройки по внешним сервисам:
+# timeout — общий таймаут запроса, retries — сколько раз повторить при сетевой
+# ошибке/5xx, concurrency — максимум одновременных запросов к сервису,
+# retry_post — можно ли повторять POST (только там, где он идемпотентен).
+# Circuit breaker: после failure_threshold неудачных запросов подряд сервис
+# считается недоступным на reset_timeout секунд (на 429 — на Retry-After).
+HTTP_UPSTREAMS = {
+    "shikimori": {"timeout": 10, "retries": 2, "concurrency": 4, "retry_post": False},
+    "anilist": {"timeout": 10, "retries": 2, "concurrency": 4, "retry_post": True},    # GraphQL-запросы только на чтение
+    "cryptobot": {"timeout": 20, "retries": 1, "concurrency": 8, "retry_post": False},
+    "yookassa": {"timeout": 20, "retries": 1, "concurrency": 8, "retry_post": True},   # POST с Idempotence-Key
+}
+
+
+class UpstreamUnavailable(Exception):
+    """Внешний сервис сейчас недоступен: открыт circuit breaker, 429 или 5xx."""
+
+
+def _retry_after_seconds(value: str | None) -> float | None:
+    """Retry-After: число секунд или HTTP-дата."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - datetime.now(retry_at.tzinfo)).total_seconds())
+
+
+class CircuitBreaker:
+    """Быстрый отказ, пока сервис нездоров.
+
+    closed -> (failure_threshold ошибок подряд или 429) -> open на reset_timeout
+    секунд -> half-open: пропускается один пробный запрос; успех закрывает
+    breaker, ошибка снова открывает.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.open_until = 0.0
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if self.open_until > time.monotonic():
+            return "open"
+        return "half-open" if self.open_until else "closed"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "open":
+            return False
+        if state == "half-open":
+            if self._probing:
+                return False
+            self._probing = True
+        return True
+
+    def success(self):
+        self.failures = 0
+        self.open_until = 0.0
+        self._probing = False
+
+    def failure(self, hold: float | None = None):
+        self.failures += 1
+        self._probing = False
+        if hold is not None or self.failures >= self.failure_threshold or self.open_until:
+            hold = self.reset_timeout if hold is None else hold
+            self.open_until = time.monotonic() + hold
+            logging.warning(f"[HTTP:{self.name}] сервис недоступен, запросы приостановлены на {hold:.0f} с")
+
+    def release(self):
+        """Запрос прерван без результата (например, отменён) — пробу можно повторить."""
+        self._probing = False
+
+
+class HttpClient:
+    """Один aiohttp.ClientSession на всё приложение.
+
+    Держит keep-alive соединения к Shikimori/AniList/CryptoBot/YooKassa,
+    кэширует DNS и ограничивает число соединений на хост. Создаётся в main()
+    через start() и закрывается через close().
+    """
+
+    def __init__(self, upstreams: dict, limit: int = 100, limit_per_host: int = 10):
+        self.upstreams = upstreams
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.session = None
+        self._semaphores = {name: asyncio.Semaphore(cfg["concurrency"]) for name, cfg in upstreams.items()}
+        self.breakers = {
+            name: CircuitBreaker(name, cfg.get("failure_threshold", 5), cfg.get("reset_timeout", 30.0))
+            for name, cfg in upstreams.items()
+        }
+
+    async def start(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                ttl_dns_cache=300,
+                keepalive_timeout=60,
+            )
+            self.session = aiohttp.ClientSession(connector=connector)
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    async def request_json(self, upstream: str, method: str, url: str, **kwargs):
+        """Запрос к сервису upstream. Возвращает (status, json или None).
+
+        Сетевые ошибки после всех повторов пробрасываются наружу. Пока сервис
+        считается недоступным (circuit breaker), и на ответ 429 сразу
+        поднимается UpstreamUnavailable — без ожидания таймаутов.
+        """
+        breaker = self.breakers[upstream]
+        if not breaker.allow():
+            raise UpstreamUnavailable(f"{upstream}: circuit breaker open")
+
+        settled = False
+        try:
+            await self.start()
+
+            cfg = self.upstreams[upstream]
+            attempts = 1 + (cfg["retries"] if method == "GET" or cfg["retry_post"] else 0)
+            kwargs.setdefault("timeout", aiohttp.ClientTimeout(total=cfg["timeout"]))
+
+            for attempt in range(attempts):
+                last_try = attempt == attempts - 1
+                try:
+                    async with self._semaphores[upstream]:
+                        async with self.session.request(method, url, **kwargs) as resp:
+                            if resp.status == 429:
+                                hold = _retry_after_seconds(resp.headers.get("Retry-After"))
+                                breaker.failure(hold=hold if hold is not None else breaker.reset_timeout)
+                                settled = True
+                                raise UpstreamUnavailable(f"{upstream}: 429 Too Many Requests")
+                            if resp.status >= 500 and not last_try:
+                                raise aiohttp.ClientResponseError(resp.request_info, resp.history, status=resp.status)
+                            try:
+                                data = await resp.json(content_type=None)
+                            except (ValueError, aiohttp.ContentTypeError):
+                                data = None
+                            if resp.status >= 500:
+                                breaker.failure()
+                            else:
+                                breaker.success()
+                            settled = True
+                            return resp.status, data
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    if last_try:
+                        breaker.failure()
+                        settled = True
+                        raise
+                    logging.warning(f"[HTTP:{upstream}] {method} {url}: {type(e).__name__} {e}, повтор {attempt + 1}/{attempts - 1}")
+                    await asyncio.sleep(0.5 * 2 ** attempt)
+        finally:
+            if not settled:
+                breaker.release()
+
+
+HTTP = HttpClient(HTTP_UPSTREAMS)
+
+
+# =========================
+# SINGLE-FLIGHT
+# =========================
+class SingleFlight:
+    """Склеивает одновременные одинаковые запросы.
+
+    Первый вызов по ключу запускает загрузку, остальные ждут тот же future.
+    Отмена одного из ожидающих не отменяет загрузку для остальных.
+    """
+
+    def __init__(self):
+        self._inflight = {}
+
+    async def do(self, key, factory):
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(factory())
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(future)
+
+    def __len__(self):
+        return len(self._inflight)
+
+
+# Ключи: ("shikimori", title), ("anilist", title_en), ("anime_info", anime)
+INFLIGHT = SingleFlight()
+
+def _create_anime_id(conn, anime: str):
+    # Ещё раз под транзакцией писателя: ID мог появиться, пока ждали очереди
+    row = conn.execute("SELECT id FROM anime_catalog WHERE anime=?", (anime,)).fetchone()
     if row:
         return row[0]
 
     while True:
         anime_id = str(random.randint(100000, 999999))
-        cursor.execute("SELECT 1 FROM anime_catalog WHERE id=?", (anime_id,))
-        if not cursor.fetchone():
+        if not conn.execute("SELECT 1 FROM anime_catalog WHERE id=?", (anime_id,)).fetchone():
             break
 
-    cursor.execute(
+    conn.execute(
         "INSERT INTO anime_catalog(id, anime) VALUES (?, ?)",
         (anime_id, anime)
     )
-    db.commit()
     return anime_id
 
 
-def get_anime_name_by_id(anime_id):
+async def get_or_create_anime_id(anime: str):
+    anime_id = await DB.fetchval("SELECT id FROM anime_catalog WHERE anime=?", (anime,))
+    if anime_id is not None:
+        return anime_id
+    return await DB.transaction(_create_anime_id, anime)
+
+
+async def get_anime_name_by_id(anime_id):
     """Возвращает название аниме по стабильному ID из anime_catalog."""
-    cursor.execute(
+    return await DB.fetchval(
         "SELECT anime FROM anime_catalog WHERE id=?",
         (str(anime_id),)
     )
-    row = cursor.fetchone()
-    return row[0] if row else None
 
 
-def anime_ids_to_names(anime_ids):
+async def get_anime_ids(animes) -> dict:
+    """{название: ID из anime_catalog} для списка кнопок; недостающие ID создаются."""
+    animes = list(dict.fromkeys(animes))
+    if not animes:
+        return {}
+    rows = await DB.fetchall(
+        f"SELECT anime, id FROM anime_catalog WHERE anime IN ({','.join('?' * len(animes))})",
+        animes
+    )
+    ids = dict(rows)
+    for anime in animes:
+        if anime not in ids:
+            ids[anime] = await get_or_create_anime_id(anime)
+    return ids
+
+
+def anime_card_callback(anime_id) -> str:
+    """callback_data кнопки, открывающей карточку тайтла."""
+    return f"anime_card|{anime_id}"
+
+
+async def resolve_anime_callback(data: str):
+    """Название тайтла по anime_card|<ID>.
+
+    Старые кнопки anime_index|N (позиция в алфавитном списке) в уже отправленных
+    сообщениях тоже понимаем: N-е название берём из снимка каталога.
+    """
+    kind, _, value = data.partition("|")
+    if kind == "anime_card":
+        return await DB.fetchval("SELECT anime FROM anime_catalog WHERE id=?", (value,))
+    if kind == "anime_index" and value.isdigit() and int(value) < len(CATALOG.animes):
+        return CATALOG.animes[int(value)]
+    return None
+
+
+async def anime_ids_to_names(anime_ids):
     """Преобразует выбранные ID в названия, сохраняя порядок и убирая дубли."""
     names = []
     seen = set()
     for anime_id in anime_ids:
-        anime = get_anime_name_by_id(anime_id)
+        anime = await get_anime_name_by_id(anime_id)
         if anime and anime not in seen:
             names.append(anime)
             seen.add(anime)
     return names
 
 
-def anime_names_to_ids(anime_names):
+async def anime_names_to_ids(anime_names):
     """Преобразует старый список названий в стабильные ID для редактора."""
     ids = []
     seen = set()
     for anime in anime_names:
-        anime_id = str(get_or_create_anime_id(anime))
+        anime_id = str(await get_or_create_anime_id(anime))
         if anime_id not in seen:
             ids.append(anime_id)
             seen.add(anime_id)
@@ -580,46 +1599,46 @@ def make_status_button(anime_id: str, current_status: str | None) -> InlineKeybo
         icon_custom_emoji_id=button["icon_custom_emoji_id"],
     )
 
-def toggle_bookmark(user_id, anime, status):
-    cursor.execute(
+def _toggle_bookmark(conn, user_id, anime, status):
+    cur = conn.execute(
         "DELETE FROM user_bookmarks WHERE user_id=? AND anime=? AND status=?",
         (user_id, anime, status)
     )
-    if cursor.rowcount == 0:
-        cursor.execute(
+    if cur.rowcount == 0:
+        conn.execute(
             "INSERT INTO user_bookmarks(user_id, anime, status) VALUES(?,?,?)",
             (user_id, anime, status)
         )
-        result = True
-    else:
-        result = False
-    db.commit()
-    return result
+        return True
+    return False
 
-def toggle_favorite(user_id, anime):
-    return toggle_bookmark(user_id, anime, "favorite")
+async def toggle_bookmark(user_id, anime, status):
+    return await DB.transaction(_toggle_bookmark, user_id, anime, status)
 
-def get_bookmark_status(user_id, anime):
-    cursor.execute(
+async def toggle_favorite(user_id, anime):
+    return await toggle_bookmark(user_id, anime, "favorite")
+
+async def get_bookmark_status(user_id, anime):
+    rows = await DB.fetchall(
         "SELECT status FROM user_bookmarks WHERE user_id=? AND anime=?",
         (user_id, anime)
     )
-    return [x[0] for x in cursor.fetchall()]
+    return [x[0] for x in rows]
 
 
 async def show_bookmark_list(call, status, page=0):
-    cursor.execute(
+    rows = await DB.fetchall(
         "SELECT anime FROM user_bookmarks WHERE user_id=? AND status=? ORDER BY created_at DESC",
         (call.from_user.id, status)
     )
-    animes = [x[0] for x in cursor.fetchall()]
+    animes = [x[0] for x in rows]
     start = page * ANIME_PER_PAGE
     items = animes[start:start+ANIME_PER_PAGE]
     group_emoji_id = BOOKMARK_GROUP_EMOJI_IDS.get(status, BOOKMARK_MENU_EMOJI_ID)
 
     builder = InlineKeyboardBuilder()
     for anime in items:
-        anime_id = get_or_create_anime_id(anime)
+        anime_id = await get_or_create_anime_id(anime)
         builder.row(InlineKeyboardButton(
             text=cut_title(format_anime_title(anime)),
             callback_data=f"anime_bookmark|{anime_id}",
@@ -642,10 +1661,9 @@ async def show_bookmark_list(call, status, page=0):
     )
 
 
-def has_access(user_id: int) -> bool:
+async def has_access(user_id: int) -> bool:
     now = int(time.time())
-    cursor.execute("SELECT paid_until FROM users WHERE user_id=?", (user_id,))
-    row = cursor.fetchone()
+    row = await DB.fetchone("SELECT paid_until FROM users WHERE user_id=?", (user_id,))
 
     if not row:
         return False
@@ -697,70 +1715,241 @@ class EditUserProfile(StatesGroup):
 # Shikimori API
 # =========================
 
-async def get_anilist_poster(title: str) -> str | None:
-    query = """
-    query ($search: String) {
-      Media (search: $search, type: ANIME) {
-        coverImage {
-          extraLarge
-          large
-        }
-      }
+class AniListPosterBatcher:
+    """Пакетный поиск постеров в AniList.
+
+    Несколько названий упаковываются в один GraphQL-документ с алиасами
+    (m0: Media(search: $s0 ...), m1: ...), ответ раскладывается обратно по
+    названиям. Одиночные resolve() в течение короткого окна склеиваются в
+    один такой запрос незаметно для вызывающего кода.
+    """
+
+    def __init__(self, window: float = 0.05, max_batch: int = 10):
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = {}   # title -> future
+        self._timer = None
+        self._tasks = set()
+
+    @staticmethod
+    def _build_query(count: int) -> str:
+        params = ", ".join(f"$s{i}: String" for i in range(count))
+        fields = "\n".join(
+            f"  m{i}: Media(search: $s{i}, type: ANIME) {{ coverImage {{ extraLarge large }} }}"
+            for i in range(count)
+        )
+        return f"query ({params}) {{\n{fields}\n}}"
+
+    async def fetch_batch(self, titles: list) -> dict:
+        """Один POST на весь список (не больше max_batch названий).
+
+        title -> url, или None, если AniList явно ответил null (тайтла нет).
+        Названий, про которые внятного ответа нет, в результате нет вовсе;
+        если сломан весь ответ — UpstreamUnavailable.
+        """
+        status, data = await HTTP.request_json(
+            "anilist", "POST", ANILIST_API,
+            json={
+                "query": self._build_query(len(titles)),
+                "variables": {f"s{i}": title for i, title in enumerate(titles)}
+            },
+            headers={"Content-Type": "application/json"}
+        )
+
+        # Ненайденные тайтлы приходят как null + запись в errors (и статус 404),
+        # найденные при этом всё равно лежат в data. Любой другой не-2xx (400, 401/403, ...)
+        # — это отказ в запросе, а не «постера нет».
+        if status != 404 and not 200 <= status < 300:
+            raise UpstreamUnavailable(f"anilist: HTTP {status}")
+
+        media = data.get("data") if isinstance(data, dict) else None
+        if not isinstance(media, dict):
+            raise UpstreamUnavailable(f"anilist: HTTP {status}, в ответе нет data")
+
+        result = {}
+        for i, title in enumerate(titles):
+            alias = f"m{i}"
+            if alias in media and media[alias] is None:
+                result[title] = None
+                continue
+            cover = (media.get(alias) or {}).get("coverImage") or {}
+            url = cover.get("extraLarge") or cover.get("large")
+            if url:
+                result[title] = url
+        return result
+
+    async def resolve_many(self, titles) -> dict:
+        """Постеры для списка названий, по max_batch в одном запросе."""
+        titles = list(dict.fromkeys(t for t in titles if t))
+        result = {}
+        for i in range(0, len(titles), self.max_batch):
+            result.update(await self.fetch_batch(titles[i:i + self.max_batch]))
+        return result
+
+    async def resolve(self, title: str) -> str | None:
+        """Постер одного названия; запрос уходит вместе с соседними в пределах окна."""
+        if not title:
+            return None
+
+        future = self._pending.get(title)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._pending[title] = future
+            if len(self._pending) >= self.max_batch:
+                self._flush()
+            elif self._timer is None:
+                self._timer = asyncio.get_running_loop().call_later(self.window, self._flush)
+
+        return await asyncio.shield(future)
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        batch, self._pending = self._pending, {}
+        if batch:
+            task = asyncio.create_task(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: dict):
+        try:
+            result = await self.fetch_batch(list(batch))
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for title, future in batch.items():
+            if future.done():
+                continue
+            if title in result:
+                future.set_result(result[title])
+            else:
+                future.set_exception(UpstreamUnavailable(f"anilist: нет ответа для {title!r}"))
+
+
+ANILIST_POSTERS = AniListPosterBatcher()
+
+
+async def get_anilist_poster(title: str) -> str | None:
+    return await ANILIST_POSTERS.resolve(title)
+
+
+async def _load_cached_anime_info(title: str, allow_stale: bool = False):
+    """Свежая запись из anime_info в формате get_anime_info или None.
+
+    allow_stale=True — отдать то, что есть в базе, независимо от возраста и
+    наличия описания (когда сеть недоступна или тайтл там не находится).
+    """
+    row = await DB.fetchone(
+        """
+        SELECT poster, score, genres, year, description, status_text, fetched_at
+        FROM anime_info
+        WHERE anime=?
+        """,
+        (title,)
+    )
+    if not row:
+        return None
+
+    poster, score, genres, year, description, status_text, fetched_at = row
+    if not allow_stale:
+        if description is None or fetched_at is None:
+            return None
+        try:
+            age = (datetime.now() - datetime.fromisoformat(fetched_at)).total_seconds()
+        except ValueError:
+            return None
+        if age > META_DB_TTL:
+            return None
+
+    return {
+        "title": title,
+        "score": score or "—",
+        "year": year or "—",
+        "genres": genres or "—",
+        "description": description,
+        "poster": poster,
+        "status_text": status_text or "Неизвестно"
     }
-    """
 
-    variables = {"search": title}
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(
-            ANILIST_API,
-            json={"query": query, "variables": variables},
-            headers={"Content-Type": "application/json"}
-        ) as resp:
+async def _store_anime_info(title: str, info: dict):
+    """Сохраняет ответ Shikimori в anime_info (свежие данные заменяют старые, постер не трогаем)."""
+    await DB.execute(
+        """
+        INSERT INTO anime_info (anime, score, genres, year, description, status_text, fetched_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(anime) DO UPDATE SET
+            score=excluded.score,
+            genres=excluded.genres,
+            year=excluded.year,
+            description=excluded.description,
+            status_text=excluded.status_text,
+            fetched_at=excluded.fetched_at
+        """,
+        (
+            title,
+            str(info.get("score", "—")),
+            info.get("genres") or "—",
+            str(info.get("year", "—")),
+            info.get("description"),
+            info.get("status_text"),
+            datetime.now().isoformat()
+        )
+    )
+
 
-            if resp.status != 200:
-                return None
+async def get_anime_info(title: str):
+    """Метаданные Shikimori: сначала LRU в памяти, затем anime_info, и только потом сеть."""
+    info = META_CACHE.get(title)
+    if info is not None:
+        META_CACHE_STATS["memory_hits"] += 1
+        return info
 
-            data = await resp.json()
-            media = data.get("data", {}).get("Media")
+    return await INFLIGHT.do(("shikimori", title), lambda: _fetch_anime_info(title))
 
-            if not media:
-                return None
 
-            cover = media.get("coverImage", {})
-            return cover.get("extraLarge") or cover.get("large")
+async def _fetch_anime_info(title: str):
+    info = await _load_cached_anime_info(title)
+    if info is not None:
+        META_CACHE_STATS["db_hits"] += 1
+        META_CACHE.set(title, info)
+        return info
 
+    META_CACHE_STATS["misses"] += 1
 
-async def get_anime_info(title: str):
-    if title in SHIKI_CACHE:
-        return SHIKI_CACHE[title]
+    # Тайтл недавно не нашёлся — не спрашиваем Shikimori снова, отдаём что есть в базе.
+    if NEGATIVE_CACHE.get(("shikimori", title)):
+        return await _load_cached_anime_info(title, allow_stale=True)
 
     url = "https://shikimori.one/api/animes"
     params = {"search": title, "limit": 1, "order": "ranked"}
     headers = {"User-Agent": "Mozilla/5.0 (Telegram Bot)"}
 
-    async with aiohttp.ClientSession() as session:
-
-        async with session.get(url, params=params, headers=headers) as resp:
-            if resp.status != 200:
-                return None
-
-            data = await resp.json()
-            if not data:
-                return None
-
-            anime = data[0]
-            anime_id = anime["id"]
-
-        async with session.get(
-            f"https://shikimori.one/api/animes/{anime_id}",
-            headers=headers
-        ) as resp:
+    full = None
+    try:
+        status, data = await HTTP.request_json("shikimori", "GET", url, params=params, headers=headers)
+        if status == 200 and data:
+            status, full = await HTTP.request_json(
+                "shikimori", "GET",
+                f"https://shikimori.one/api/animes/{data[0]['id']}",
+                headers=headers
+            )
+    except (UpstreamUnavailable, aiohttp.ClientError, asyncio.TimeoutError) as e:
+        # Shikimori лежит или ограничил нас — сразу работаем только с базой.
+        logging.warning(f"[Shikimori] {title}: {e}")
+        return await _load_cached_anime_info(title, allow_stale=True)
 
-            if resp.status != 200:
-                return None
+    if status >= 500:
+        return await _load_cached_anime_info(title, allow_stale=True)
 
-            full = await resp.json()
+    if status != 200 or not data or not full:
+        NEGATIVE_CACHE.set(("shikimori", title), True)
+        return await _load_cached_anime_info(title, allow_stale=True)
 
     shiki_status = full.get("status", "").lower()
 
@@ -785,7 +1974,8 @@ async def get_anime_info(title: str):
         "status_text": status_text
     }
 
-    SHIKI_CACHE[title] = info
+    META_CACHE.set(title, info)
+    await _store_anime_info(title, info)
     return info
 # =========================
 # Стартап
@@ -852,7 +2042,7 @@ async def start(message: types.Message, state: FSMContext):
     if args.startswith("anime_"):
         anime_name = urllib.parse.unquote(args.replace("anime_", "", 1))
 
-        if not has_active_sub(user_id):
+        if not await has_active_sub(user_id):
             kb = InlineKeyboardMarkup(
                 inline_keyboard=[
                     [InlineKeyboardButton(text=" Купить подписку", callback_data="choose_plan",style="success",icon_custom_emoji_id="5418115271267197333")],
@@ -869,7 +2059,7 @@ async def start(message: types.Message, state: FSMContext):
             )
             return
 
-        await show_anime_page(message, anime_name)
+        await show_anime_card(user_id, message, anime_name, replace=False)
         return
 
     # ===== ОБЫЧНЫЙ START =====
@@ -883,8 +2073,7 @@ async def start(message: types.Message, state: FSMContext):
         "Также переходите в наш новостной канал t.me/Aniimes4K"
     )
 
-    cursor.execute("SELECT user_id FROM users WHERE user_id=?", (user_id,))
-    exists = cursor.fetchone()
+    exists = await DB.fetchone("SELECT user_id FROM users WHERE user_id=?", (user_id,))
 
     if not exists:
         kb = InlineKeyboardMarkup(
@@ -913,52 +2102,48 @@ def generate_ref_code():
     chars = string.ascii_uppercase + string.digits
     return ''.join(random.choices(chars, k=6))
 
-def create_user_referral(user_id: int):
+def _create_user_referral(conn, user_id: int):
     # генерируем уникальный код
     while True:
         my_code = generate_ref_code()
 
-        cursor.execute(
-            "SELECT 1 FROM referrals WHERE my_code=?",
-            (my_code,)
-        )
-
-        if not cursor.fetchone():
+        if not conn.execute("SELECT 1 FROM referrals WHERE my_code=?", (my_code,)).fetchone():
             break
 
     # сохраняем
-    cursor.execute("""
+    conn.execute("""
         INSERT INTO referrals (user_id, my_code)
         VALUES (?, ?)
     """, (user_id, my_code))
 
-    db.commit()
 
-async def process_referral_bonus(user_id: int, period_key: str):
+async def create_user_referral(user_id: int):
+    # Проверка кода и вставка — одной транзакцией писателя, чтобы код не заняли между ними
+    await DB.transaction(_create_user_referral, user_id)
 
-    # бонус только для 30+ дней
-    if period_key not in ("30_days", "180_days", "360_days", "forever"):
-        return
+def _apply_referral_bonus(conn, user_id: int):
+    """Начисляет реферальный бонус; (inviter_id, выдан ли месяц) или None, если бонуса нет.
 
+    Всё одной транзакцией писателя: две оплаты подряд не выдадут бонус дважды.
+    """
     # получаем данные пользователя
-    cursor.execute("""
+    row = conn.execute("""
         SELECT referred_by, bonus_given
         FROM referrals
         WHERE user_id = ?
-    """, (user_id,))
-    row = cursor.fetchone()
+    """, (user_id,)).fetchone()
 
     if not row:
-        return
+        return None
 
     referred_by, bonus_given = row
 
     if not referred_by:
-        return
+        return None
 
     # если бонус уже выдан — выходим
     if bonus_given == 1:
-        return
+        return None
 
     inviter_id = referred_by
 
@@ -966,11 +2151,11 @@ async def process_referral_bonus(user_id: int, period_key: str):
     # 🎁 1 неделя обоим
     # ==============================
 
-    give_subscription(user_id, 7)
-    give_subscription(inviter_id, 7)
+    _give_subscription(conn, user_id, 7)
+    _give_subscription(conn, inviter_id, 7)
 
     # отмечаем бонус как использованный
-    cursor.execute("""
+    conn.execute("""
         UPDATE referrals
         SET bonus_given = 1
         WHERE user_id = ?
@@ -981,23 +2166,19 @@ async def process_referral_bonus(user_id: int, period_key: str):
     # ==============================
 
     # сколько рефералов выполнили условие
-    cursor.execute("""
+    count = conn.execute("""
         SELECT COUNT(*)
         FROM referrals
         WHERE referred_by = ?
           AND bonus_given = 1
-    """, (inviter_id,))
-
-    count = cursor.fetchone()[0]
+    """, (inviter_id,)).fetchone()[0]
 
     # сколько месяцев уже выдано
-    cursor.execute("""
+    row_months = conn.execute("""
         SELECT months_awarded
         FROM referrals
         WHERE user_id = ?
-    """, (inviter_id,))
-
-    row_months = cursor.fetchone()
+    """, (inviter_id,)).fetchone()
     months_awarded = row_months[0] if row_months else 0
 
     # сколько месяцев должно быть
@@ -1006,9 +2187,9 @@ async def process_referral_bonus(user_id: int, period_key: str):
     month_awarded = False
 
     if should_have_months > months_awarded:
-        give_subscription(inviter_id, 30)
+        _give_subscription(conn, inviter_id, 30)
 
-        cursor.execute("""
+        conn.execute("""
             UPDATE referrals
             SET months_awarded = ?
             WHERE user_id = ?
@@ -1016,7 +2197,19 @@ async def process_referral_bonus(user_id: int, period_key: str):
 
         month_awarded = True
 
-    db.commit()
+    return inviter_id, month_awarded
+
+
+async def process_referral_bonus(user_id: int, period_key: str):
+
+    # бонус только для 30+ дней
+    if period_key not in ("30_days", "180_days", "360_days", "forever"):
+        return
+
+    result = await DB.transaction(_apply_referral_bonus, user_id)
+    if result is None:
+        return
+    inviter_id, month_awarded = result
 
     # ==============================
     # 📩 Уведомления
@@ -1059,20 +2252,18 @@ async def referral_menu(call: types.CallbackQuery):
     # 🔹 Получаем или создаём код
     # ==============================
 
-    cursor.execute(
+    row = await DB.fetchone(
         "SELECT my_code FROM referrals WHERE user_id = ?",
         (user_id,)
     )
-    row = cursor.fetchone()
 
     if not row:
-        create_user_referral(user_id)
+        await create_user_referral(user_id)
 
-        cursor.execute(
+        row = await DB.fetchone(
             "SELECT my_code FROM referrals WHERE user_id = ?",
             (user_id,)
         )
-        row = cursor.fetchone()
 
     my_code = row[0]
 
@@ -1080,15 +2271,13 @@ async def referral_menu(call: types.CallbackQuery):
     # 🔹 Получаем список рефералов
     # ==============================
 
-    cursor.execute("""
+    invited_users = await DB.fetchall("""
         SELECT user_id
         FROM referrals
         WHERE referred_by = ?
           AND bonus_given = 1
     """, (user_id,))
 
-    invited_users = cursor.fetchall()
-
     # ==============================
     # 🔹 Формируем текст
     # ==============================
@@ -1172,11 +2361,10 @@ async def enter_ref_code(message: types.Message, state: FSMContext):
     code = message.text.strip().upper()
 
     # Проверяем существует ли код
-    cursor.execute(
+    result = await DB.fetchone(
         "SELECT user_id FROM referrals WHERE my_code = ?",
         (code,)
     )
-    result = cursor.fetchone()
 
     if not result:
         return await message.answer("<tg-emoji emoji-id=\"5210952531676504517\">👍</tg-emoji> Неверный код")
@@ -1188,23 +2376,21 @@ async def enter_ref_code(message: types.Message, state: FSMContext):
         return await message.answer("<tg-emoji emoji-id=\"5210952531676504517\">👍</tg-emoji> Нельзя использовать свой код")
 
     # Проверяем использовал ли уже
-    cursor.execute(
+    row = await DB.fetchone(
         "SELECT used_code FROM referrals WHERE user_id = ?",
         (user_id,)
     )
-    row = cursor.fetchone()
 
     if row and row[0]:
         return await message.answer("<tg-emoji emoji-id=\"5210952531676504517\">👍</tg-emoji> Вы уже использовали реферальный код")
 
     # Сохраняем связь
-    cursor.execute("""
+    await DB.execute("""
         UPDATE referrals
         SET used_code = ?, referred_by = ?
         WHERE user_id = ?
     """, (code, inviter_id, user_id))
 
-    db.commit()
 
     # Очищаем состояние 🔥
     await state.clear()
@@ -1215,8 +2401,7 @@ async def enter_ref_code(message: types.Message, state: FSMContext):
 async def my_code(message: types.Message):
     user_id = message.from_user.id
 
-    cursor.execute("SELECT my_code FROM referrals WHERE user_id = ?", (user_id,))
-    row = cursor.fetchone()
+    row = await DB.fetchone("SELECT my_code FROM referrals WHERE user_id = ?", (user_id,))
 
     if not row:
         return await message.answer("Код не найден.")
@@ -1232,8 +2417,7 @@ async def edit_name_cmd(message: types.Message):
         await message.reply("❌ У вас нет прав на редактирование.")
         return
 
-    cursor.execute("SELECT DISTINCT anime FROM videos ORDER BY anime")
-    animes = [row[0] for row in cursor.fetchall()]
+    animes = CATALOG.animes
 
     buttons = []
     row = []
@@ -1255,9 +2439,8 @@ async def edit_name_cmd(message: types.Message):
     )
 
 
-async def add_subscription(user_id: int, plan_type: str, days: int):
-    cursor.execute("SELECT expire_date FROM subscriptions WHERE user_id=?", (user_id,))
-    row = cursor.fetchone()
+def _add_subscription(conn, user_id: int, plan_type: str, days: int):
+    row = conn.execute("SELECT expire_date FROM subscriptions WHERE user_id=?", (user_id,)).fetchone()
 
     now = datetime.now()
 
@@ -1269,22 +2452,25 @@ async def add_subscription(user_id: int, plan_type: str, days: int):
         else:
             new_expire = now + timedelta(days=days)
 
-        cursor.execute(
+        conn.execute(
             "UPDATE subscriptions SET type=?, expire_date=? WHERE user_id=?",
             (plan_type, new_expire.isoformat(), user_id)
         )
     else:
         new_expire = now + timedelta(days=days)
 
-        cursor.execute(
+        conn.execute(
             "INSERT INTO subscriptions (user_id, type, expire_date) VALUES (?, ?, ?)",
             (user_id, plan_type, new_expire.isoformat())
         )
 
-    db.commit()
     return new_expire
 
 
+async def add_subscription(user_id: int, plan_type: str, days: int):
+    return await DB.transaction(_add_subscription, user_id, plan_type, days)
+
+
 # =========================
 # выбор тарифа
 # =========================
@@ -1325,39 +2511,95 @@ async def choose_plan(call: types.CallbackQuery):
 
     await call.answer()
 
-def get_crypto_amount(rub_amount: int, crypto: str) -> str:
-    try:
-        headers = {
-            "Crypto-Pay-API-Token": CRYPTOBOT_TOKEN
-        }
+class ExchangeRateService:
+    """Курсы CryptoBot (getExchangeRates) в памяти.
 
-        response = requests.get(
-            "https://pay.crypt.bot/api/getExchangeRates",
-            headers=headers,
-            timeout=5
-        )
+    Обновляются фоновой задачей run() раз в interval секунд, поэтому расчёт
+    цены в криптовалюте не делает сетевых запросов. Если обновления падают,
+    последние курсы отдаются не дольше max_age секунд.
+    """
+
+    def __init__(self, interval: float, max_age: float):
+        self.interval = interval
+        self.max_age = max_age
+        self.rates = {}          # (source, target) -> Decimal
+        self.updated_at = None
+
+    def age(self) -> float | None:
+        """Сколько секунд назад загружены курсы; None, если ещё ни разу."""
+        if self.updated_at is None:
+            return None
+        return (datetime.now() - self.updated_at).total_seconds()
+
+    def is_fresh(self) -> bool:
+        age = self.age()
+        return age is not None and age <= self.max_age
+
+    def _log_fallback(self):
+        age = self.age()
+        if age is None:
+            print("[ExchangeRates] Курсов нет: ни одна загрузка не удалась")
+        elif age <= self.max_age:
+            print(f"[ExchangeRates] Используем прошлые курсы, возраст {age:.0f} с")
+        else:
+            print(f"[ExchangeRates] Прошлым курсам {age:.0f} с (> {self.max_age:.0f} с) — расчёт цены недоступен")
 
-        data = response.json()
+    async def refresh(self):
+        status, data = await HTTP.request_json(
+            "cryptobot", "GET", f"{CRYPTOBOT_API_BASE}/getExchangeRates",
+            headers={"Crypto-Pay-API-Token": CRYPTOBOT_TOKEN}
+        )
 
-        if not data.get("ok"):
+        if status >= 400 or not data or not data.get("ok"):
             print("Ошибка получения курсов:", data)
-            return "0.00000000"
+            self._log_fallback()
+            return
+
+        self.rates = {
+            (rate["source"], rate["target"]): Decimal(rate["rate"])
+            for rate in data["result"]
+            if rate.get("is_valid", True)
+        }
+        self.updated_at = datetime.now()
+
+    def get(self, source: str, target: str) -> Decimal | None:
+        """Курс source -> target; None, если его нет или курсы старше max_age."""
+        if not self.is_fresh():
+            return None
+        return self.rates.get((source, target))
 
-        rates = data["result"]
+    async def run(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                print(f"[ExchangeRates] Ошибка обновления курсов: {e}")
+                self._log_fallback()
+            await asyncio.sleep(self.interval)
+
+
+EXCHANGE_RATES = ExchangeRateService(CRYPTO_RATES_REFRESH, RATE_MAX_AGE)
 
-        usd_rub = None
-        crypto_usd = None
 
-        for rate in rates:
-            if rate["source"] == "USD" and rate["target"] == "RUB":
-                usd_rub = Decimal(rate["rate"])
+async def get_crypto_amount(rub_amount: int, crypto: str) -> str | None:
+    """Цена в криптовалюте по курсам CryptoBot; None, если свежих курсов нет."""
+    try:
+        # Курсов нет (бот только что стартовал) или они устарели — пробуем загрузить сейчас.
+        if not EXCHANGE_RATES.is_fresh():
+            try:
+                await INFLIGHT.do(("cryptobot", "rates"), EXCHANGE_RATES.refresh)
+            except Exception as e:
+                print(f"[get_crypto_amount] Не удалось обновить курсы: {e}")
+        if not EXCHANGE_RATES.is_fresh():
+            print(f"[get_crypto_amount] Курсы недоступны, цена в {crypto} не рассчитана")
+            return None
 
-            if rate["source"] == crypto.upper() and rate["target"] == "USD":
-                crypto_usd = Decimal(rate["rate"])
+        usd_rub = EXCHANGE_RATES.get("USD", "RUB")
+        crypto_usd = EXCHANGE_RATES.get(crypto.upper(), "USD")
 
         if not usd_rub or not crypto_usd:
             print(f"Не найден курс для {crypto}")
-            return "0.00000000"
+            return None
 
         usd_amount = Decimal(rub_amount * (1 + CRYPTO_MARGIN)) / usd_rub
         crypto_amount = usd_amount / crypto_usd
@@ -1366,11 +2608,11 @@ def get_crypto_amount(rub_amount: int, crypto: str) -> str:
 
     except Exception as e:
         print(f"[get_crypto_amount] Ошибка: {e}")
-        return "0.00000000"
+        return None
 
 
 # ===== Генерация счета Crypto.bot =====
-def create_crypto_invoice(user_id: int, rub_amount: int, period_key: str) -> str:
+async def create_crypto_invoice(user_id: int, rub_amount: int, period_key: str) -> str:
     try:
         headers = {
             "Crypto-Pay-API-Token": CRYPTOBOT_TOKEN
@@ -1384,16 +2626,13 @@ def create_crypto_invoice(user_id: int, rub_amount: int, period_key: str) -> str
             "hidden_message": f"user:{user_id}|period:{period_key}"
         }
 
-        response = requests.post(
-            "https://pay.crypt.bot/api/createInvoice",
+        status, data = await HTTP.request_json(
+            "cryptobot", "POST", f"{CRYPTOBOT_API_BASE}/createInvoice",
             headers=headers,
-            json=payload,
-            timeout=10
+            json=payload
         )
 
-        data = response.json()
-
-        if data.get("ok"):
+        if data and data.get("ok"):
             return data["result"]["pay_url"]
         else:
             print("Ошибка createInvoice:", data)
@@ -1448,7 +2687,7 @@ async def give_subscription_cmd(message: types.Message):
             period_key = None
 
     # 🔹 выдаём подписку
-    give_subscription(target_id, days)
+    await give_subscription(target_id, days)
 
     # 🔥 вызываем реферальную систему
     if period_key:
@@ -1475,6 +2714,100 @@ async def give_subscription_cmd(message: types.Message):
 
     await message.answer(f"✅ Подписка выдана пользователю {target_id}")
 
+def _claim_pending_videos(conn, limit: int, claim_token: str) -> list:
+    """Атомарно помечает до limit самых старых видео очереди как claimed.
+
+    Зависшие claimed (упали посреди /darling) через PENDING_CLAIM_TIMEOUT снова доступны.
+    Оба запроса идут по idx_pending_videos_status_date: сначала зависшие claimed
+    возвращаются в pending, затем берутся первые pending по (date, message_id) —
+    без OR по двум статусам, который индекс не покрывает.
+    """
+    now = datetime.now()
+    stale_before = (now - timedelta(seconds=PENDING_CLAIM_TIMEOUT)).isoformat()
+    conn.execute(
+        """
+        UPDATE pending_videos
+        SET status='pending', claim_token=NULL, claimed_at=NULL
+        WHERE status='claimed' AND claimed_at < ?
+        """,
+        (stale_before,)
+    )
+    conn.execute(
+        """
+        UPDATE pending_videos
+        SET status='claimed', claim_token=?, claimed_at=?
+        WHERE message_id IN (
+            SELECT message_id
+            FROM pending_videos
+            WHERE status='pending'
+            ORDER BY date, message_id
+            LIMIT ?
+        )
+        """,
+        (claim_token, now.isoformat(), limit)
+    )
+    return conn.execute(
+        "SELECT message_id, file_id FROM pending_videos WHERE claim_token=? ORDER BY date, message_id",
+        (claim_token,)
+    ).fetchall()
+
+
+def _ingest_claimed_videos(conn, videos, claim_token, anime_key, dub, season, start_episode, english_name):
+    """Загружает забранные видео. Возвращает (загружено ли, номера уже существующих серий).
+
+    Если claim потерян (зависший claim перехватил другой /darling) или часть
+    номеров серий уже занята, ничего не вставляем и возвращаем видео в очередь:
+    иначе те же файлы попали бы в базу второй раз или пропали бы молча.
+    Проверки и вставка — одна транзакция писателя.
+    """
+    owned = conn.execute(
+        "SELECT COUNT(*) FROM pending_videos WHERE claim_token=? AND status='claimed'",
+        (claim_token,)
+    ).fetchone()[0]
+
+    existing = []
+    if owned == len(videos):
+        kind, season_number = _season_columns(season)
+        existing = [row[0] for row in conn.execute(
+            """
+            SELECT episode FROM episodes
+            WHERE title_id = (SELECT id FROM titles WHERE name = ?)
+              AND dub_id = (SELECT id FROM dubs WHERE name = ?)
+              AND kind = ? AND season = ?
+              AND episode BETWEEN ? AND ?
+            ORDER BY episode
+            """,
+            (anime_key, dub, kind, season_number, start_episode, start_episode + len(videos) - 1)
+        )]
+
+    if owned != len(videos) or existing:
+        conn.execute(
+            "UPDATE pending_videos SET status='pending', claim_token=NULL, claimed_at=NULL "
+            "WHERE claim_token=? AND status='claimed'",
+            (claim_token,)
+        )
+        return False, existing
+
+    conn.executemany(
+        """
+        INSERT INTO videos (anime, dub, season, episode, file_id, english_name)
+        VALUES (?, ?, ?, ?, ?, ?)
+        """,
+        [
+            (anime_key, dub, season, i, file_id, english_name)
+            for i, (_, file_id) in enumerate(videos, start=start_episode)
+        ]
+    )
+
+    # english_name хранится один раз на тайтл (titles), вставка через videos его уже обновила.
+
+    conn.execute(
+        "UPDATE pending_videos SET status='ingested', ingested_at=? WHERE claim_token=?",
+        (datetime.now().isoformat(), claim_token)
+    )
+    return True, []
+
+
 @router.message(Command("darling"))
 async def darling_add_from_pending(message: types.Message):
 
@@ -1527,11 +2860,11 @@ async def darling_add_from_pending(message: types.Message):
         return
 
     anime_key = anime.lower()
-    get_or_create_anime_id(anime_key)
+    await get_or_create_anime_id(anime_key)
 
     # Если english_name не указали в команде, берём уже существующее значение из базы.
     if not english_name:
-        cursor.execute(
+        row = await DB.fetchone(
             """
             SELECT english_name
             FROM videos
@@ -1542,44 +2875,41 @@ async def darling_add_from_pending(message: types.Message):
             """,
             (anime_key,)
         )
-        row = cursor.fetchone()
         english_name = row[0] if row else None
 
-    cursor.execute(
-        "SELECT message_id, file_id FROM pending_videos ORDER BY date ASC LIMIT ?",
-        (num_episodes,)
-    )
-
-    videos = cursor.fetchall()
+    # Забираем самые старые видео из очереди; новые, пришедшие в это время, не заденем.
+    claim_token = uuid4().hex
+    videos = await DB.transaction(_claim_pending_videos, num_episodes, claim_token)
 
     if not videos:
         await message.answer("❌ Нет видео для добавления!")
         return
 
-    for i, (msg_id, file_id) in enumerate(videos, start=start_episode):
-        cursor.execute(
-            """
-            INSERT INTO videos (anime, dub, season, episode, file_id, english_name)
-            VALUES (?, ?, ?, ?, ?, ?)
-            """,
-            (anime_key, dub, season, i, file_id, english_name)
+    try:
+        ingested, existing = await DB.transaction(
+            _ingest_claimed_videos, videos, claim_token,
+            anime_key, dub, season, start_episode, english_name
         )
-
-    # Если english_name указали/нашли — синхронизируем его для всех уже существующих серий этого аниме.
-    if english_name:
-        cursor.execute(
-            "UPDATE videos SET english_name=? WHERE anime=?",
-            (english_name, anime_key)
+    except Exception:
+        await DB.execute(
+            "UPDATE pending_videos SET status='pending', claim_token=NULL, claimed_at=NULL "
+            "WHERE claim_token=?",
+            (claim_token,)
         )
+        raise
 
-    video_ids = [v[0] for v in videos]
-
-    cursor.execute(
-        f"DELETE FROM pending_videos WHERE message_id IN ({','.join(['?']*len(video_ids))})",
-        video_ids
-    )
+    if existing:
+        await message.answer(
+            f"❌ Серии {', '.join(map(str, existing))} уже есть в базе — ничего не добавлено, "
+            "видео остались в очереди.\n"
+            "Укажи другой стартовый номер или сначала удали эти серии через /delete."
+        )
+        return
+    if not ingested:
+        await message.answer("❌ Видео из очереди успели забрать заново — повтори /darling.")
+        return
 
-    db.commit()
+    await on_catalog_changed(anime_key)
 
     season_display = "🎬 Фильм" if season == "Фильм" else f"📺 Сезон: {season}"
     english_display = f"\n🇬🇧 English name: {english_name}" if english_name else ""
@@ -1593,29 +2923,26 @@ async def darling_add_from_pending(message: types.Message):
         f"{english_display}"
     )
 
-def give_subscription(user_id: int, days: int | None):
+def _give_subscription(conn, user_id: int, days: int | None):
     now = datetime.now()
 
-    cursor.execute(
+    row = conn.execute(
         "SELECT expire_date FROM subscriptions WHERE user_id=?",
         (user_id,)
-    )
-    row = cursor.fetchone()
+    ).fetchone()
 
     # ===== FOREVER покупка =====
     if days is None:
         if row:
-            cursor.execute(
+            conn.execute(
                 "UPDATE subscriptions SET type=?, expire_date=? WHERE user_id=?",
                 ("forever", "forever", user_id)
             )
         else:
-            cursor.execute(
+            conn.execute(
                 "INSERT INTO subscriptions (user_id, type, expire_date) VALUES (?, ?, ?)",
                 (user_id, "forever", "forever")
             )
-
-        db.commit()
         return
 
     # ===== Если уже FOREVER — ничего не делаем =====
@@ -1631,31 +2958,33 @@ def give_subscription(user_id: int, days: int | None):
         else:
             new_expire = now + timedelta(days=days)
 
-        cursor.execute(
+        conn.execute(
             "UPDATE subscriptions SET type=?, expire_date=? WHERE user_id=?",
             (f"{days}_days", new_expire.isoformat(), user_id)
         )
     else:
         new_expire = now + timedelta(days=days)
 
-        cursor.execute(
+        conn.execute(
             "INSERT INTO subscriptions (user_id, type, expire_date) VALUES (?, ?, ?)",
             (user_id, f"{days}_days", new_expire.isoformat())
         )
 
-    db.commit()
+
+async def give_subscription(user_id: int, days: int | None):
+    # Чтение срока и продление — одна транзакция, два начисления подряд не затрут друг друга
+    await DB.transaction(_give_subscription, user_id, days)
 
 
 # =========================
 # /remove_sub
 # =========================
 
-def has_multi_episode_access(user_id: int) -> bool:
-    cursor.execute(
+async def has_multi_episode_access(user_id: int) -> bool:
+    row = await DB.fetchone(
         "SELECT type, expire_date FROM subscriptions WHERE user_id=?",
         (user_id,)
     )
-    row = cursor.fetchone()
 
     if not row:
         return False
@@ -1685,7 +3014,7 @@ def has_multi_episode_access(user_id: int) -> bool:
 async def multi_episodes_start(call: types.CallbackQuery, state: FSMContext):
     user_id = call.from_user.id
 
-    if not has_multi_episode_access(user_id):
+    if not await has_multi_episode_access(user_id):
         await call.answer("❌ Только подписка 30+ дней", show_alert=True)
         return
 
@@ -1745,29 +3074,14 @@ async def process_multi_range(message: types.Message, state: FSMContext):
         await state.clear()
         return
 
-    cursor.execute("SELECT anime, dub, season FROM videos")
-
-    anime = dub = season = None
-
-    for a, d, s in cursor.fetchall():
-        if make_cb_id(a, d, str(s)) == dub_hash:
-            anime, dub, season = a, d, s
-            break
+    anime, dub, season = resolve_dub_hash(dub_hash) or (None, None, None)
 
     if not anime:
         await message.answer("❌ не найдено")
         await state.clear()
         return
 
-    cursor.execute("""
-        SELECT episode, file_id
-        FROM videos
-        WHERE anime=? AND dub=? AND season=?
-          AND CAST(episode AS INTEGER) BETWEEN ? AND ?
-        ORDER BY CAST(episode AS INTEGER)
-    """, (anime, dub, season, start_ep, end_ep))
-
-    episodes = cursor.fetchall()
+    episodes = CATALOG.episode_range(anime, dub, season, start_ep, end_ep)
 
     if not episodes:
         await message.answer("❌ пусто")
@@ -1892,8 +3206,7 @@ async def remove_sub(message: types.Message):
 
     target_id = message.reply_to_message.from_user.id
 
-    cursor.execute("DELETE FROM subscriptions WHERE user_id=?", (target_id,))
-    db.commit()
+    await DB.execute("DELETE FROM subscriptions WHERE user_id=?", (target_id,))
 
     await message.reply(f"✅ Подписка у пользователя {target_id} успешно удалена")
 
@@ -1907,8 +3220,7 @@ async def burmaldod_start(message: types.Message):
 
 
 async def show_anime_page(target, page: int):
-    cursor.execute("SELECT DISTINCT anime FROM videos ORDER BY anime")
-    animes = [row[0] for row in cursor.fetchall()]
+    animes = CATALOG.animes
 
     start = page * ANIME_PER_PAGI
     end = start + ANIME_PER_PAGI
@@ -1973,8 +3285,7 @@ async def burmaldod_choose(call: types.CallbackQuery):
     _, idx_str = call.data.split("|")
     idx = int(idx_str)
 
-    cursor.execute("SELECT DISTINCT anime FROM videos ORDER BY anime")
-    animes = [row[0] for row in cursor.fetchall()]
+    animes = CATALOG.animes
 
     if idx < 0 or idx >= len(animes):
         await call.answer("❌ Аниме не найдено", show_alert=True)
@@ -2007,12 +3318,12 @@ async def burmaldod_save(message: types.Message):
         await message.answer("⚠ Название не может быть пустым")
         return
 
-    cursor.execute(
-        "UPDATE videos SET english_name=? WHERE anime=?",
+    await DB.execute(
+        "UPDATE titles SET english_name=? WHERE name=?",
         (new_name, anime)
     )
 
-    db.commit()
+    await on_catalog_changed(anime)
 
     BURMALDOD_EDIT.pop(user_id, None)
 
@@ -2029,13 +3340,11 @@ async def get_video(message: types.Message):
     if message.from_user.id not in ADMINS:
         return
 
-    cursor.execute(
+    await DB.execute(
         "INSERT OR IGNORE INTO pending_videos (message_id, file_id, date) VALUES (?, ?, ?)",
         (message.message_id, message.video.file_id, str(message.date))
     )
 
-    db.commit()
-
     await send_and_track(
         message.from_user.id,
         message.answer,
@@ -2050,13 +3359,11 @@ async def get_video_link(message: types.Message):
 
     url = URL_RE.search(message.text).group(0)
 
-    cursor.execute(
+    await DB.execute(
         "INSERT OR IGNORE INTO pending_videos (message_id, file_id, date) VALUES (?, ?, ?)",
         (message.message_id, url, str(message.date))
     )
 
-    db.commit()
-
     await send_and_track(
         message.from_user.id,
         message.answer,
@@ -2086,8 +3393,8 @@ async def send_video_or_link(chat_id, video_value, caption=None, reply_markup=No
     )
 
 
-def save_watch_progress(user_id, anime, dub, season, episode):
-    cursor.execute("""
+async def save_watch_progress(user_id, anime, dub, season, episode):
+    await DB.execute("""
         INSERT INTO watch_history (user_id, anime, dub, season, episode)
         VALUES (?, ?, ?, ?, ?)
         ON CONFLICT(user_id, anime, dub, season)
@@ -2096,8 +3403,6 @@ def save_watch_progress(user_id, anime, dub, season, episode):
             updated_at=CURRENT_TIMESTAMP
     """, (user_id, anime, dub, season, episode))
 
-    db.commit()  # ✅ ВАЖНО: db, а не conn
-
 async def get_anime_poster(anime_name):
 
     info = await get_anime_info(anime_name)
@@ -2126,14 +3431,11 @@ def format_episode_caption(season, episode):
 
 
 async def send_video_by_params(call: types.CallbackQuery, anime, dub, season, ep):
-    cursor.execute("SELECT file_id FROM videos WHERE anime=? AND dub=? AND season=? AND episode=?",
-                   (anime, dub, season, ep))
-    row = cursor.fetchone()
-    if not row:
+    file_id = CATALOG.file_id(anime, dub, season, ep)
+    if file_id is None:
         await call.answer("❌ Видео не найдено", show_alert=True)
         return
 
-    file_id = row[0]
     episode_caption = format_episode_caption(season, ep)
     caption = f"<b>{anime}</b>\n<b><i>{dub}</i></b>\n<i>{episode_caption}</i>"
 
@@ -2141,15 +3443,14 @@ async def send_video_by_params(call: types.CallbackQuery, anime, dub, season, ep
 
     # Навигация
     nav_buttons = []
-    cursor.execute("SELECT 1 FROM videos WHERE anime=? AND dub=? AND season=? AND episode=?", (anime, dub, season, ep - 1))
-    if cursor.fetchone():
-        nav_buttons.append(InlineKeyboardButton(text=f" {ep-1} серия",
-                                                callback_data=f"ep|{make_cb_id(anime,dub,str(season),str(ep-1))}|0",
+    prev_ep, next_ep = CATALOG.neighbours(anime, dub, season, ep)
+    if prev_ep is not None:
+        nav_buttons.append(InlineKeyboardButton(text=f" {prev_ep} серия",
+                                                callback_data=f"ep|{make_cb_id(anime,dub,str(season),str(prev_ep))}|0",
                                                 style="primary"))
-    cursor.execute("SELECT 1 FROM videos WHERE anime=? AND dub=? AND season=? AND episode=?", (anime, dub, season, ep + 1))
-    if cursor.fetchone():
-        nav_buttons.append(InlineKeyboardButton(text=f"{ep+1} серия ",
-                                                callback_data=f"ep|{make_cb_id(anime,dub,str(season),str(ep+1))}|0",
+    if next_ep is not None:
+        nav_buttons.append(InlineKeyboardButton(text=f"{next_ep} серия ",
+                                                callback_data=f"ep|{make_cb_id(anime,dub,str(season),str(next_ep))}|0",
                                                 style="primary"))
     if nav_buttons:
         builder.row(*nav_buttons)
@@ -2168,7 +3469,7 @@ async def send_video_by_params(call: types.CallbackQuery, anime, dub, season, ep
         await call.message.answer_video(file_id, caption=caption, parse_mode="HTML", reply_markup=kb)
 
     # Сохраняем прогресс
-    save_watch_progress(call.from_user.id, anime, dub, season, ep)
+    await save_watch_progress(call.from_user.id, anime, dub, season, ep)
     await call.answer()
 
 @router.callback_query(F.data == "clear_history")
@@ -2176,8 +3477,7 @@ async def clear_history(call: types.CallbackQuery):
     user_id = call.from_user.id
 
     # Удаляем все записи истории пользователя
-    cursor.execute("DELETE FROM watch_history WHERE user_id = ?", (user_id,))
-    db.commit()
+    await DB.execute("DELETE FROM watch_history WHERE user_id = ?", (user_id,))
 
     # Формируем пустое меню истории
     buttons = [
@@ -2213,25 +3513,23 @@ async def watch_history(call: types.CallbackQuery):
     limit = 10
     offset = page * limit
 
-    cursor.execute("""
+    rows = await DB.fetchall("""
         SELECT anime, dub, season, episode
         FROM watch_history
         WHERE user_id = ?
         ORDER BY updated_at DESC
         LIMIT ? OFFSET ?
     """, (user_id, limit, offset))
-    rows = cursor.fetchall()
 
     if not rows and page == 0:
         await call.answer("История пуста", show_alert=True)
         return
 
-    cursor.execute("""
+    total = await DB.fetchval("""
         SELECT COUNT(*)
         FROM watch_history
         WHERE user_id = ?
     """, (user_id,))
-    total = cursor.fetchone()[0]
 
     buttons = []
 
@@ -2285,7 +3583,7 @@ async def show_picker(target, state, page=0, update_existing=False):
     selected_pairs = []
     valid_ids = []
     for anime_id in selected_ids:
-        anime = get_anime_name_by_id(anime_id)
+        anime = await get_anime_name_by_id(anime_id)
         if anime:
             selected_pairs.append((anime_id, anime))
             valid_ids.append(anime_id)
@@ -2394,7 +3692,7 @@ async def show_picker(target, state, page=0, update_existing=False):
 async def pick_from_inline(message: types.Message, state: FSMContext):
     # Inline-поиск отправляет стабильный ID из anime_catalog, а не название.
     anime_id = message.text.strip()
-    anime = get_anime_name_by_id(anime_id)
+    anime = await get_anime_name_by_id(anime_id)
 
     if not anime:
         await send_and_track(
@@ -2468,15 +3766,14 @@ async def pick_anime(call: types.CallbackQuery, state: FSMContext):
     page = int(page)
 
     # Берём аниме по индексу
-    cursor.execute("SELECT DISTINCT anime FROM videos ORDER BY anime")
-    all_animes = [r[0] for r in cursor.fetchall()]
+    all_animes = CATALOG.animes
 
     if idx >= len(all_animes):
         await call.answer("<tg-emoji emoji-id=\"5210952531676504517\">👍</tg-emoji> Аниме не найдено", show_alert=True,parse_mode="HTML")
         return
 
     anime = all_animes[idx]
-    anime_id = str(get_or_create_anime_id(anime))
+    anime_id = str(await get_or_create_anime_id(anime))
 
     data = await state.get_data()
     selected = [str(value) for value in data.get("selected", [])]
@@ -2538,6 +3835,20 @@ async def send_collection_to_admins(collection_id, title, description, photo, se
         except:
             pass
 
+def _create_collection(conn, owner_id: int, title: str, description, photo: str, selected: list[str]) -> int:
+    collection_id = conn.execute(
+        "INSERT INTO collections (owner_id, title, description, photo, status) VALUES (?, ?, ?, ?, 'pending')",
+        (owner_id, title, description, photo)
+    ).lastrowid
+
+    # 🎬 сохраняем аниме
+    conn.executemany(
+        "INSERT INTO collection_items (collection_id, anime, position) VALUES (?, ?, ?)",
+        [(collection_id, anime, i) for i, anime in enumerate(selected)]
+    )
+    return collection_id
+
+
 @router.callback_query(F.data == "finish_collection")
 async def finish_collection(call: types.CallbackQuery, state: FSMContext):
     data = await state.get_data()
@@ -2546,7 +3857,7 @@ async def finish_collection(call: types.CallbackQuery, state: FSMContext):
     description = data.get("description")  # 👈 добавили
     photo = data.get("photo")
     selected_ids = [str(value) for value in data.get("selected", [])]
-    selected = anime_ids_to_names(selected_ids)
+    selected = await anime_ids_to_names(selected_ids)
 
     if not title or not photo:
         await call.answer(
@@ -2568,21 +3879,11 @@ async def finish_collection(call: types.CallbackQuery, state: FSMContext):
     if description and len(description) > 500:
         description = description[:500].rstrip() + "…"
 
-    # 💾 сохраняем подборку
-    cursor.execute(
-        "INSERT INTO collections (owner_id, title, description, photo, status) VALUES (?, ?, ?, ?, 'pending')",
-        (call.from_user.id, title, description, photo)
+    # 💾 сохраняем подборку вместе с аниме
+    collection_id = await DB.transaction(
+        _create_collection, call.from_user.id, title, description, photo, selected
     )
-    collection_id = cursor.lastrowid
-
-    # 🎬 сохраняем аниме
-    for i, anime in enumerate(selected):
-        cursor.execute(
-            "INSERT INTO collection_items (collection_id, anime, position) VALUES (?, ?, ?)",
-            (collection_id, anime, i)
-        )
 
-    db.commit()
     await state.clear()
 
     # 📩 отправка админам (тоже передаём description)
@@ -2619,22 +3920,20 @@ async def cancel_collection(call: types.CallbackQuery, state: FSMContext):
 async def approve_collection(call: types.CallbackQuery):
     collection_id = int(call.data.split("|")[1])
 
-    cursor.execute(
+    collection = await DB.fetchone(
         "SELECT owner_id, title, status FROM collections WHERE id=?",
         (collection_id,)
     )
-    collection = cursor.fetchone()
     if not collection:
         await call.answer("Подборка не найдена", show_alert=True)
         return
 
     owner_id, title, old_status = collection
 
-    cursor.execute(
+    await DB.execute(
         "UPDATE collections SET status='approved' WHERE id=?",
         (collection_id,)
     )
-    db.commit()
 
     await call.message.edit_caption(
         call.message.caption + "\n\n <b>Одобрено</b>",
@@ -2667,22 +3966,20 @@ async def approve_collection(call: types.CallbackQuery):
 async def reject_collection(call: types.CallbackQuery):
     collection_id = int(call.data.split("|")[1])
 
-    cursor.execute(
+    collection = await DB.fetchone(
         "SELECT owner_id, title, status FROM collections WHERE id=?",
         (collection_id,)
     )
-    collection = cursor.fetchone()
     if not collection:
         await call.answer("Подборка не найдена", show_alert=True)
         return
 
     owner_id, title, old_status = collection
 
-    cursor.execute(
+    await DB.execute(
         "UPDATE collections SET status='rejected' WHERE id=?",
         (collection_id,)
     )
-    db.commit()
 
     await call.message.edit_caption(
         call.message.caption + "\n\n <b>Отклонено</b>",
@@ -2720,26 +4017,24 @@ async def curated_lists(call: types.CallbackQuery):
     offset = page * limit
 
     # получаем подборки
-    cursor.execute("""
+    rows = await DB.fetchall("""
         SELECT id, title
         FROM collections
         WHERE status = 'approved'
         ORDER BY id DESC
         LIMIT ? OFFSET ?
     """, (limit, offset))
-    rows = cursor.fetchall()
 
     if not rows and page == 0:
         await call.answer("Список пуст", show_alert=True)
         return
 
     # общее количество
-    cursor.execute("""
+    total = await DB.fetchval("""
         SELECT COUNT(*)
         FROM collections
         WHERE status = 'approved'
     """)
-    total = cursor.fetchone()[0]
 
     buttons = []
 
@@ -2824,8 +4119,8 @@ COLLECTION_STATUS_NAMES = {
 }
 
 
-def get_owned_collection(collection_id: int, user_id: int):
-    cursor.execute(
+async def get_owned_collection(collection_id: int, user_id: int):
+    return await DB.fetchone(
         """
         SELECT id, title, description, photo, status
         FROM collections
@@ -2833,15 +4128,14 @@ def get_owned_collection(collection_id: int, user_id: int):
         """,
         (collection_id, user_id)
     )
-    return cursor.fetchone()
 
 
-def get_collection_animes(collection_id: int):
-    cursor.execute(
+async def get_collection_animes(collection_id: int):
+    rows = await DB.fetchall(
         "SELECT anime FROM collection_items WHERE collection_id=? ORDER BY position",
         (collection_id,)
     )
-    return [row[0] for row in cursor.fetchall()]
+    return [row[0] for row in rows]
 
 
 @router.callback_query(F.data == "user_collections_menu")
@@ -2905,13 +4199,12 @@ async def show_owned_collections(call: types.CallbackQuery, mode: str, page: int
     limit = 10
     offset = page * limit
 
-    cursor.execute(
+    total = await DB.fetchval(
         "SELECT COUNT(*) FROM collections WHERE owner_id=?",
         (user_id,)
     )
-    total = cursor.fetchone()[0]
 
-    cursor.execute(
+    rows = await DB.fetchall(
         """
         SELECT id, title, status
         FROM collections
@@ -2921,12 +4214,11 @@ async def show_owned_collections(call: types.CallbackQuery, mode: str, page: int
         """,
         (user_id, limit, offset)
     )
-    rows = cursor.fetchall()
 
     if not rows and page > 0:
         page = max(0, (total - 1) // limit) if total else 0
         offset = page * limit
-        cursor.execute(
+        rows = await DB.fetchall(
             """
             SELECT id, title, status
             FROM collections
@@ -2936,7 +4228,6 @@ async def show_owned_collections(call: types.CallbackQuery, mode: str, page: int
             """,
             (user_id, limit, offset)
         )
-        rows = cursor.fetchall()
 
     buttons = []
     callback_prefix = "edit_collection_open" if mode == "edit" else "my_collection_open"
@@ -3085,7 +4376,7 @@ async def show_collection_edit_menu(target, state: FSMContext, notice: str = "")
 @router.callback_query(F.data.startswith("edit_collection_open|"))
 async def edit_collection_open(call: types.CallbackQuery, state: FSMContext):
     collection_id = int(call.data.split("|", 1)[1])
-    row = get_owned_collection(collection_id, call.from_user.id)
+    row = await get_owned_collection(collection_id, call.from_user.id)
 
     if not row:
         await call.answer("Подборка не найдена", show_alert=True)
@@ -3099,7 +4390,7 @@ async def edit_collection_open(call: types.CallbackQuery, state: FSMContext):
         "title": title,
         "description": description or "",
         "photo": photo,
-        "selected": anime_names_to_ids(get_collection_animes(collection_id)),
+        "selected": await anime_names_to_ids(await get_collection_animes(collection_id)),
         "original_status": status,
     })
     await show_collection_edit_menu(call, state)
@@ -3120,7 +4411,7 @@ edit_input_back_kb = InlineKeyboardMarkup(inline_keyboard=[
 async def edit_collection_field(call: types.CallbackQuery, state: FSMContext):
     data = await state.get_data()
     collection_id = data.get("collection_id")
-    if not collection_id or not get_owned_collection(collection_id, call.from_user.id):
+    if not collection_id or not await get_owned_collection(collection_id, call.from_user.id):
         await state.clear()
         await call.answer("Подборка не найдена", show_alert=True)
         return
@@ -3238,11 +4529,27 @@ async def edit_picker_done(call: types.CallbackQuery, state: FSMContext):
     await call.answer()
 
 
+def _update_collection(conn, collection_id: int, owner_id: int, title: str, description: str, photo: str, selected: list[str]):
+    conn.execute(
+        """
+        UPDATE collections
+        SET title=?, description=?, photo=?, status='pending'
+        WHERE id=? AND owner_id=?
+        """,
+        (title, description, photo, collection_id, owner_id)
+    )
+    conn.execute("DELETE FROM collection_items WHERE collection_id=?", (collection_id,))
+    conn.executemany(
+        "INSERT INTO collection_items (collection_id, anime, position) VALUES (?, ?, ?)",
+        [(collection_id, anime, position) for position, anime in enumerate(selected)]
+    )
+
+
 @router.callback_query(F.data == "save_collection_edit")
 async def save_collection_edit(call: types.CallbackQuery, state: FSMContext):
     data = await state.get_data()
     collection_id = data.get("collection_id")
-    row = get_owned_collection(collection_id, call.from_user.id) if collection_id else None
+    row = await get_owned_collection(collection_id, call.from_user.id) if collection_id else None
     if not row:
         await state.clear()
         await call.answer("Подборка не найдена", show_alert=True)
@@ -3252,27 +4559,15 @@ async def save_collection_edit(call: types.CallbackQuery, state: FSMContext):
     description = str(data.get("description", "")).strip()
     photo = data.get("photo")
     selected_ids = [str(value) for value in data.get("selected", [])]
-    selected = anime_ids_to_names(selected_ids)
+    selected = await anime_ids_to_names(selected_ids)
 
     if not title or not photo or not selected:
         await call.answer("Заполни название, фото и выбери хотя бы одно аниме", show_alert=True)
         return
 
-    cursor.execute(
-        """
-        UPDATE collections
-        SET title=?, description=?, photo=?, status='pending'
-        WHERE id=? AND owner_id=?
-        """,
-        (title, description[:500], photo, collection_id, call.from_user.id)
+    await DB.transaction(
+        _update_collection, collection_id, call.from_user.id, title, description[:500], photo, selected
     )
-    cursor.execute("DELETE FROM collection_items WHERE collection_id=?", (collection_id,))
-    for position, anime in enumerate(selected):
-        cursor.execute(
-            "INSERT INTO collection_items (collection_id, anime, position) VALUES (?, ?, ?)",
-            (collection_id, anime, position)
-        )
-    db.commit()
     await state.clear()
 
     await send_collection_to_admins(
@@ -3308,26 +4603,22 @@ async def cancel_collection_edit(call: types.CallbackQuery, state: FSMContext):
 @router.callback_query(F.data.startswith("my_collection_open|"))
 async def my_collection_open(call: types.CallbackQuery):
     collection_id = int(call.data.split("|", 1)[1])
-    row = get_owned_collection(collection_id, call.from_user.id)
+    row = await get_owned_collection(collection_id, call.from_user.id)
     if not row:
         await call.answer("Подборка не найдена", show_alert=True)
         return
 
     _, title, description, photo, status = row
-    animes = get_collection_animes(collection_id)
+    animes = await get_collection_animes(collection_id)
 
-    cursor.execute("SELECT DISTINCT anime FROM videos ORDER BY anime")
-    all_animes = [r[0] for r in cursor.fetchall()]
-    anime_map = {anime: index for index, anime in enumerate(all_animes)}
+    anime_ids = await get_anime_ids(animes)
 
     buttons = []
     for anime in animes:
-        index = anime_map.get(anime)
-        if index is not None:
-            buttons.append([InlineKeyboardButton(
-                text=string.capwords(anime),
-                callback_data=f"anime_index|{index}"
-            )])
+        buttons.append([InlineKeyboardButton(
+            text=string.capwords(anime),
+            callback_data=anime_card_callback(anime_ids[anime])
+        )])
 
     buttons.extend([
         [InlineKeyboardButton(
@@ -3367,7 +4658,7 @@ async def my_collection_open(call: types.CallbackQuery):
 @router.callback_query(F.data.startswith("delete_my_collection|"))
 async def delete_my_collection(call: types.CallbackQuery):
     collection_id = int(call.data.split("|", 1)[1])
-    row = get_owned_collection(collection_id, call.from_user.id)
+    row = await get_owned_collection(collection_id, call.from_user.id)
     if not row:
         await call.answer("Подборка не найдена", show_alert=True)
         return
@@ -3402,20 +4693,23 @@ async def delete_my_collection(call: types.CallbackQuery):
     await call.answer()
 
 
+def _delete_collection(conn, collection_id: int, owner_id: int):
+    conn.execute("DELETE FROM collection_likes WHERE collection_id=?", (collection_id,))
+    conn.execute("DELETE FROM collection_items WHERE collection_id=?", (collection_id,))
+    conn.execute(
+        "DELETE FROM collections WHERE id=? AND owner_id=?",
+        (collection_id, owner_id)
+    )
+
+
 @router.callback_query(F.data.startswith("confirm_delete_my_collection|"))
 async def confirm_delete_my_collection(call: types.CallbackQuery):
     collection_id = int(call.data.split("|", 1)[1])
-    if not get_owned_collection(collection_id, call.from_user.id):
+    if not await get_owned_collection(collection_id, call.from_user.id):
         await call.answer("Подборка не найдена", show_alert=True)
         return
 
-    cursor.execute("DELETE FROM collection_likes WHERE collection_id=?", (collection_id,))
-    cursor.execute("DELETE FROM collection_items WHERE collection_id=?", (collection_id,))
-    cursor.execute(
-        "DELETE FROM collections WHERE id=? AND owner_id=?",
-        (collection_id, call.from_user.id)
-    )
-    db.commit()
+    await DB.transaction(_delete_collection, collection_id, call.from_user.id)
 
     try:
         await call.message.delete()
@@ -3514,32 +4808,33 @@ async def set_photo(message: types.Message, state: FSMContext):
     await state.set_state(CreateCollection.picking)
     await show_picker(message, state)
 
-@router.callback_query(F.data.startswith("like_collection"))
-async def like_collection(call: types.CallbackQuery):
-    user_id = call.from_user.id
-    collection_id = int(call.data.split("|")[1])
-
+def _toggle_collection_like(conn, collection_id: int, user_id: int):
     # проверяем есть ли лайк
-    cursor.execute(
+    exists = conn.execute(
         "SELECT 1 FROM collection_likes WHERE collection_id=? AND user_id=?",
         (collection_id, user_id)
-    )
-    exists = cursor.fetchone()
+    ).fetchone()
 
     if exists:
         # убрать лайк
-        cursor.execute(
+        conn.execute(
             "DELETE FROM collection_likes WHERE collection_id=? AND user_id=?",
             (collection_id, user_id)
         )
     else:
         # поставить лайк
-        cursor.execute(
+        conn.execute(
             "INSERT INTO collection_likes (collection_id, user_id) VALUES (?, ?)",
             (collection_id, user_id)
         )
 
-    db.commit()
+
+@router.callback_query(F.data.startswith("like_collection"))
+async def like_collection(call: types.CallbackQuery):
+    user_id = call.from_user.id
+    collection_id = int(call.data.split("|")[1])
+
+    await DB.transaction(_toggle_collection_like, collection_id, user_id)
 
     # просто обновляем меню
     await open_collection(call)
@@ -3550,11 +4845,10 @@ async def open_collection(call: types.CallbackQuery):
     collection_id = int(call.data.split("|")[1])
 
     # Берём данные подборки и владельца для кнопки профиля автора.
-    cursor.execute(
+    row = await DB.fetchone(
         "SELECT title, description, photo, owner_id FROM collections WHERE id=? AND status='approved'",
         (collection_id,)
     )
-    row = cursor.fetchone()
 
     if not row:
         await call.answer("Подборка не найдена", show_alert=True)
@@ -3563,42 +4857,35 @@ async def open_collection(call: types.CallbackQuery):
     title, description, photo, owner_id = row
 
     # 📊 лайки
-    cursor.execute(
+    likes = await DB.fetchval(
         "SELECT COUNT(*) FROM collection_likes WHERE collection_id=?",
         (collection_id,)
     )
-    likes = cursor.fetchone()[0]
 
-    cursor.execute(
+    row = await DB.fetchone(
         "SELECT 1 FROM collection_likes WHERE collection_id=? AND user_id=?",
         (collection_id, user_id)
     )
-    liked = cursor.fetchone() is not None
+    liked = row is not None
 
     like_text = f" {likes}" if not liked else f" {likes}"
 
     # 📺 аниме
-    cursor.execute(
+    rows = await DB.fetchall(
         "SELECT anime FROM collection_items WHERE collection_id=? ORDER BY position",
         (collection_id,)
     )
-    animes = [r[0] for r in cursor.fetchall()]
+    animes = [r[0] for r in rows]
 
-    cursor.execute("SELECT DISTINCT anime FROM videos ORDER BY anime")
-    all_animes = [r[0] for r in cursor.fetchall()]
-    anime_map = {a: i for i, a in enumerate(all_animes)}
+    anime_ids = await get_anime_ids(animes)
 
     buttons = []
 
     for anime in animes:
-        idx = anime_map.get(anime)
-        if idx is None:
-            continue
-
         buttons.append([
             InlineKeyboardButton(
                 text=string.capwords(anime),
-                callback_data=f"anime_index|{idx}"
+                callback_data=anime_card_callback(anime_ids[anime])
             )
         ])
 
@@ -3667,7 +4954,7 @@ async def open_collection(call: types.CallbackQuery):
 async def collection_author_profile(call: types.CallbackQuery):
     collection_id = int(call.data.split("|", 1)[1])
 
-    cursor.execute(
+    collection = await DB.fetchone(
         """
         SELECT owner_id, title
         FROM collections
@@ -3675,14 +4962,13 @@ async def collection_author_profile(call: types.CallbackQuery):
         """,
         (collection_id,)
     )
-    collection = cursor.fetchone()
 
     if not collection or not collection[0]:
         await call.answer("Профиль автора недоступен", show_alert=True)
         return
 
     owner_id, collection_title = collection
-    nickname_html, description_html, profile_photo = get_user_profile(owner_id)
+    nickname_html, description_html, profile_photo = await get_user_profile(owner_id)
 
     if not nickname_html:
         author_name = "Автор подборки"
@@ -3784,8 +5070,8 @@ async def broadcast(message: types.Message):
         await asyncio.sleep(delay)
 
         if target == "all":
-            cursor.execute("SELECT DISTINCT user_id FROM users")
-            users = [row[0] for row in cursor.fetchall()]
+            rows = await DB.fetchall("SELECT DISTINCT user_id FROM users")
+            users = [row[0] for row in rows]
 
             total = len(users)
             sent = 0
@@ -3841,41 +5127,36 @@ PROFILE_DESCRIPTION_MAX_LENGTH = 500
 PROFILE_NICKNAME_MAX_LENGTH = 50
 
 
-def get_user_profile(user_id: int):
-    cursor.execute(
+async def get_user_profile(user_id: int):
+    row = await DB.fetchone(
         "SELECT nickname_html, description_html, photo FROM user_profiles WHERE user_id=?",
         (user_id,)
     )
-    row = cursor.fetchone()
     return row if row else (None, None, None)
 
 
-def update_user_profile_field(user_id: int, field: str, value):
+async def update_user_profile_field(user_id: int, field: str, value):
     allowed_fields = {"nickname_html", "description_html", "photo"}
     if field not in allowed_fields:
         raise ValueError("Недопустимое поле профиля")
 
-    cursor.execute(
-        "INSERT OR IGNORE INTO user_profiles (user_id, updated_at) VALUES (?, ?)",
-        (user_id, datetime.now().isoformat())
+    now = datetime.now().isoformat()
+    await DB.execute(
+        f"INSERT INTO user_profiles (user_id, {field}, updated_at) VALUES (?, ?, ?) "
+        f"ON CONFLICT(user_id) DO UPDATE SET {field}=excluded.{field}, updated_at=excluded.updated_at",
+        (user_id, value, now)
     )
-    cursor.execute(
-        f"UPDATE user_profiles SET {field}=?, updated_at=? WHERE user_id=?",
-        (value, datetime.now().isoformat(), user_id)
-    )
-    db.commit()
 
 
-def can_use_profile_nickname_emoji(user_id: int) -> bool:
+async def can_use_profile_nickname_emoji(user_id: int) -> bool:
     """Анимированные эмодзи в нике доступны админам и владельцам forever."""
     if user_id in ADMINS:
         return True
 
-    cursor.execute(
+    row = await DB.fetchone(
         "SELECT type, expire_date FROM subscriptions WHERE user_id=?",
         (user_id,)
     )
-    row = cursor.fetchone()
     if not row:
         return False
 
@@ -3899,9 +5180,9 @@ def message_as_safe_html(message: types.Message) -> str:
     return html_text or html.escape(message.text or "")
 
 
-def get_profile_anime_counts(user_id: int):
+async def get_profile_anime_counts(user_id: int):
     counts = {"favorite": 0, "watching": 0, "completed": 0, "planned": 0, "dropped": 0}
-    cursor.execute(
+    rows = await DB.fetchall(
         """
         SELECT status, COUNT(DISTINCT anime)
         FROM user_bookmarks
@@ -3910,15 +5191,15 @@ def get_profile_anime_counts(user_id: int):
         """,
         (user_id,)
     )
-    for status, amount in cursor.fetchall():
+    for status, amount in rows:
         if status in counts:
             counts[status] = amount
     return counts
 
 
-def get_completed_anime_episode_count(user_id: int) -> int:
+async def get_completed_anime_episode_count(user_id: int) -> int:
     """Считает все серии аниме, находящихся у пользователя в «Просмотрено»."""
-    cursor.execute(
+    row = await DB.fetchone(
         """
         SELECT COUNT(*)
         FROM (
@@ -3932,7 +5213,6 @@ def get_completed_anime_episode_count(user_id: int) -> int:
         """,
         (user_id,)
     )
-    row = cursor.fetchone()
     return int(row[0] or 0)
 
 
@@ -3975,12 +5255,12 @@ profile_input_back_kb = InlineKeyboardMarkup(inline_keyboard=[
 async def show_profile_edit_menu(target, state: FSMContext, notice: str = ""):
     await state.clear()
     user_id = target.from_user.id
-    nickname_html, description_html, photo = get_user_profile(user_id)
+    nickname_html, description_html, photo = await get_user_profile(user_id)
 
     fallback_name = target.from_user.full_name or target.from_user.username or "Пользователь"
     nickname_display = nickname_html or html.escape(fallback_name)
     description_display = description_html or "— не указано —"
-    nickname_emoji_access = "доступны" if can_use_profile_nickname_emoji(user_id) else "только с подпиской навсегда"
+    nickname_emoji_access = "доступны" if await can_use_profile_nickname_emoji(user_id) else "только с подпиской навсегда"
 
     text = "<b>Редактирование профиля</b>\n\n"
     if notice:
@@ -4020,9 +5300,9 @@ async def show_profile_edit_menu(target, state: FSMContext, notice: str = ""):
 async def account_menu(call: types.CallbackQuery, state: FSMContext):
     await state.clear()
     user_id = call.from_user.id
-    nickname_html, description_html, photo = get_user_profile(user_id)
-    counts = get_profile_anime_counts(user_id)
-    completed_episodes = get_completed_anime_episode_count(user_id)
+    nickname_html, description_html, photo = await get_user_profile(user_id)
+    counts = await get_profile_anime_counts(user_id)
+    completed_episodes = await get_completed_anime_episode_count(user_id)
 
     fallback_name = call.from_user.full_name or call.from_user.username or "Пользователь"
     nickname_display = nickname_html or html.escape(fallback_name)
@@ -4173,7 +5453,7 @@ async def save_profile_nickname(message: types.Message, state: FSMContext):
         return
 
     has_custom_emoji = message_has_custom_emoji(message)
-    emoji_allowed = can_use_profile_nickname_emoji(message.from_user.id)
+    emoji_allowed = await can_use_profile_nickname_emoji(message.from_user.id)
     if has_custom_emoji and not emoji_allowed:
         await send_and_track(
             message.from_user.id,
@@ -4184,7 +5464,7 @@ async def save_profile_nickname(message: types.Message, state: FSMContext):
         return
 
     nickname_html = message_as_safe_html(message) if emoji_allowed else html.escape(nickname)
-    update_user_profile_field(message.from_user.id, "nickname_html", nickname_html)
+    await update_user_profile_field(message.from_user.id, "nickname_html", nickname_html)
     await delete_profile_input_messages(message, state)
     await show_profile_edit_menu(message, state, "Ник сохранён")
 
@@ -4203,7 +5483,7 @@ async def save_profile_description(message: types.Message, state: FSMContext):
 
     # html_text сохраняет custom_emoji entities; это разрешено всем пользователям.
     description_html = message_as_safe_html(message)
-    update_user_profile_field(message.from_user.id, "description_html", description_html)
+    await update_user_profile_field(message.from_user.id, "description_html", description_html)
     await delete_profile_input_messages(message, state)
     await show_profile_edit_menu(message, state, "Описание сохранено")
 
@@ -4219,7 +5499,7 @@ async def save_profile_photo(message: types.Message, state: FSMContext):
         )
         return
 
-    update_user_profile_field(message.from_user.id, "photo", message.photo[-1].file_id)
+    await update_user_profile_field(message.from_user.id, "photo", message.photo[-1].file_id)
     await delete_profile_input_messages(message, state)
     await show_profile_edit_menu(message, state, "Фото сохранено")
 
@@ -4322,17 +5602,14 @@ async def bookmark_list(call: types.CallbackQuery):
 async def anime_bookmark(call: types.CallbackQuery):
     anime_id = call.data.split("|", 1)[1]
 
-    cursor.execute(
-        "SELECT anime FROM anime_catalog WHERE id=?",
-        (anime_id,)
-    )
-    row = cursor.fetchone()
+    anime = await resolve_anime_callback(anime_card_callback(anime_id))
 
-    if not row:
+    if not anime:
         await call.answer("❌ Аниме не найдено", show_alert=True)
         return
 
-    await show_anime_page(call.message, row[0])
+    await show_anime_card(call.from_user.id, call.message, anime)
+    await call.answer()
 
 @router.callback_query(F.data.startswith("top_rated"))
 async def top_rated_menu(call: types.CallbackQuery):
@@ -4342,40 +5619,28 @@ async def top_rated_menu(call: types.CallbackQuery):
     page = int(parts[1]) if len(parts) > 1 else 0
     offset = page * PAGE_SIZI
 
-    # Получаем список всех аниме, отсортированных по алфавиту
-    cursor.execute("SELECT DISTINCT anime FROM videos ORDER BY anime")
-    all_animes = [row[0] for row in cursor.fetchall()]
-
     # Берем топ аниме по рейтингу из anime_info
-    cursor.execute("""
+    rows = await DB.fetchall("""
         SELECT anime, score
         FROM anime_info
         ORDER BY CAST(score AS REAL) DESC
         LIMIT ? OFFSET ?
     """, (PAGE_SIZI, offset))
-    rows = cursor.fetchall()
 
     if not rows and page == 0:
         await call.answer("Список пуст", show_alert=True)
         return
 
     # Общее количество для пагинации
-    cursor.execute("SELECT COUNT(*) FROM anime_info")
-    total = cursor.fetchone()[0]
+    total = await DB.fetchval("SELECT COUNT(*) FROM anime_info")
 
     buttons = []
+    anime_ids = await get_anime_ids(anime for anime, _ in rows)
 
     for anime, score in rows:
         anime_title = string.capwords(anime)  # заглавные буквы
         text = f"{score} {anime_title}"
-
-        # Определяем индекс аниме для anime_selected
-        try:
-            idx = all_animes.index(anime)
-        except ValueError:
-            idx = 0  # на всякий случай
-
-        cb = f"anime_index|{idx}"
+        cb = anime_card_callback(anime_ids[anime])
 
         buttons.append([InlineKeyboardButton(text=text, callback_data=cb, icon_custom_emoji_id="5438496463044752972")])
 
@@ -4589,39 +5854,28 @@ async def vpn_menu(call: types.CallbackQuery):
 
     await call.answer()
 
-@router.callback_query(F.data == "register")
-async def register_user(call: types.CallbackQuery):
-
-    import time
-    import random
-    import string
-    from datetime import datetime, timedelta
-
-    user_id = call.from_user.id
-
-    cursor.execute(
+def _register_user(conn, user_id: int, trial_days: int) -> bool:
+    """Создаёт пользователя, trial-подписку и реферальный код; False, если он уже есть."""
+    row = conn.execute(
         "SELECT user_id FROM users WHERE user_id=?",
         (user_id,)
-    )
+    ).fetchone()
 
-    if cursor.fetchone():
-        await call.answer("Ты уже зарегистрирован 😉", show_alert=True)
-        return
+    if row:
+        return False
 
     # ==============================
     # 🔹 Создаём пользователя
     # ==============================
 
     now_ts = int(time.time())
-    trial_days = 7
     trial_until = now_ts + trial_days * 24 * 60 * 60
 
-    cursor.execute(
+    conn.execute(
         "INSERT INTO users (user_id, first_start, paid_until) VALUES (?, ?, ?)",
         (user_id, now_ts, trial_until)
     )
 
-    db.commit()
 
     # ==============================
     # 🔹 Trial подписка
@@ -4629,12 +5883,11 @@ async def register_user(call: types.CallbackQuery):
 
     expire_date = (datetime.now() + timedelta(days=trial_days)).isoformat()
 
-    cursor.execute(
+    conn.execute(
         "INSERT INTO subscriptions (user_id, type, expire_date) VALUES (?, ?, ?)",
         (user_id, "trial", expire_date)
     )
 
-    db.commit()
 
     # ==============================
     # 🔥 СОЗДАНИЕ РЕФЕРАЛЬНОГО КОДА
@@ -4646,21 +5899,35 @@ async def register_user(call: types.CallbackQuery):
     while True:
         my_code = ''.join(random.choices(chars, k=6))
 
-        cursor.execute(
+        row = conn.execute(
             "SELECT 1 FROM referrals WHERE my_code=?",
             (my_code,)
-        )
+        ).fetchone()
 
-        if not cursor.fetchone():
+        if not row:
             break
 
     # сохраняем код пользователю
-    cursor.execute("""
+    conn.execute("""
         INSERT INTO referrals (user_id, my_code)
         VALUES (?, ?)
     """, (user_id, my_code))
 
-    db.commit()
+    return True
+
+
+@router.callback_query(F.data == "register")
+async def register_user(call: types.CallbackQuery):
+
+    user_id = call.from_user.id
+
+    # ==============================
+    # 🔹 Пользователь, trial и реферальный код — одной транзакцией
+    # ==============================
+
+    if not await DB.transaction(_register_user, user_id, 7):
+        await call.answer("Ты уже зарегистрирован 😉", show_alert=True)
+        return
 
     # ==============================
 
@@ -4722,11 +5989,18 @@ async def add_video(message: types.Message):
 
     file_id = message.reply_to_message.video.file_id
 
-    cursor.execute(
-        "INSERT INTO videos (anime, dub, season, episode, file_id) VALUES (?, ?, ?, ?, ?)",
-        (anime.lower(), dub, int(season), int(episode), file_id)
-    )
-    db.commit()
+    try:
+        await DB.execute(
+            "INSERT INTO videos (anime, dub, season, episode, file_id) VALUES (?, ?, ?, ?, ?)",
+            (anime.lower(), dub, int(season), int(episode), file_id)
+        )
+    except sqlite3.IntegrityError:
+        await message.answer(
+            f"❌ Серия уже есть: {anime.title()} | {dub} | Сезон {season} Серия {episode}\n"
+            "Чтобы заменить видео, сначала удали серию через /delete."
+        )
+        return
+    await on_catalog_changed(anime.lower())
 
     await message.answer(f"✅ Серия добавлена:\n{anime.title()} | {dub} | Сезон {season} Серия {episode}")
 
@@ -4781,36 +6055,65 @@ def _delete_scope_title(scope: str) -> str:
     }.get(scope, "записи")
 
 
+def _season_columns(season):
+    """Сезон из videos/callback ("Фильм", 2, "2") -> (kind, season) для episodes. None, если это не сезон."""
+    if str(season).strip().lower() in ("фильм", "film", "movie"):
+        return "film", 0
+    try:
+        return "series", int(str(season).strip())
+    except ValueError:
+        return None
+
+
+def _delete_key(action: dict):
+    """(kind, season, episode) из action в типах episodes. None, если такой записи быть не может."""
+    scope = action.get("scope")
+    kind = season = episode = None
+
+    if scope in ("season", "episode"):
+        key = _season_columns(action.get("season"))
+        if key is None:
+            return None
+        kind, season = key
+
+    if scope == "episode":
+        try:
+            episode = int(str(action.get("episode")).strip())
+        except ValueError:
+            return None
+
+    return kind, season, episode
+
+
 def _delete_where(action: dict):
+    """Условие по episodes: всё по целым колонкам ключа, чтобы шёл поиск по индексу."""
     scope = action.get("scope")
-    anime = action.get("anime")
-    dub = action.get("dub")
-    season = action.get("season")
-    episode = action.get("episode")
+    key = _delete_key(action)
+    if key is None:
+        return "0", []
+    kind, season, episode = key
 
-    where = ["anime = ?"]
-    params = [anime]
+    where = ["title_id = (SELECT id FROM titles WHERE name = ?)"]
+    params = [action.get("anime")]
 
     if scope in ("dub", "season", "episode"):
-        where.append("dub = ?")
-        params.append(dub)
+        where.append("dub_id = (SELECT id FROM dubs WHERE name = ?)")
+        params.append(action.get("dub"))
 
     if scope in ("season", "episode"):
-        where.append("CAST(season AS TEXT) = ?")
-        params.append(str(season))
+        where.append("kind = ? AND season = ?")
+        params.extend((kind, season))
 
     if scope == "episode":
-        where.append("CAST(episode AS TEXT) = ?")
-        params.append(str(episode))
+        where.append("episode = ?")
+        params.append(episode)
 
     return " AND ".join(where), params
 
 
-def _delete_count(action: dict) -> int:
+async def _delete_count(action: dict) -> int:
     where, params = _delete_where(action)
-    cursor.execute(f"SELECT COUNT(*) FROM videos WHERE {where}", params)
-    row = cursor.fetchone()
-    return int(row[0] or 0)
+    return int(await DB.fetchval(f"SELECT COUNT(*) FROM episodes WHERE {where}", params) or 0)
 
 
 def _delete_describe(action: dict) -> str:
@@ -4835,14 +6138,6 @@ def _delete_season_sort_key(value):
         return (1, s.lower())
 
 
-def _delete_episode_sort_key(value):
-    s = str(value)
-    try:
-        return (0, int(s))
-    except Exception:
-        return (1, s.lower())
-
-
 async def _delete_send_or_edit(target, text: str, kb: InlineKeyboardMarkup | None = None):
     if isinstance(target, types.CallbackQuery):
         try:
@@ -4857,8 +6152,8 @@ async def _delete_send_or_edit(target, text: str, kb: InlineKeyboardMarkup | Non
 async def _delete_show_anime_page(target, page: int = 0):
     user_id = target.from_user.id if isinstance(target, types.CallbackQuery) else target.from_user.id
 
-    cursor.execute("SELECT DISTINCT anime FROM videos ORDER BY anime")
-    animes = [row[0] for row in cursor.fetchall()]
+    rows = await DB.fetchall("SELECT DISTINCT anime FROM videos ORDER BY anime")
+    animes = [row[0] for row in rows]
 
     if not animes:
         await _delete_send_or_edit(target, "❌ В базе нет аниме для удаления.")
@@ -4900,11 +6195,10 @@ async def _delete_show_anime_actions(call: types.CallbackQuery, payload: dict):
     anime_name = payload["anime"]
     user_id = call.from_user.id
 
-    cursor.execute("SELECT COUNT(*) FROM videos WHERE anime=?", (anime_name,))
-    total = cursor.fetchone()[0]
+    total = await DB.fetchval("SELECT COUNT(*) FROM videos WHERE anime=?", (anime_name,))
 
-    cursor.execute("SELECT DISTINCT dub FROM videos WHERE anime=? ORDER BY dub", (anime_name,))
-    dubs = [row[0] for row in cursor.fetchall()]
+    rows = await DB.fetchall("SELECT DISTINCT dub FROM videos WHERE anime=? ORDER BY dub", (anime_name,))
+    dubs = [row[0] for row in rows]
 
     buttons = []
     action_token = _delete_token(user_id, {"scope": "anime", "anime": anime_name}, action=True)
@@ -4930,11 +6224,10 @@ async def _delete_show_dub_actions(call: types.CallbackQuery, payload: dict):
     dub = payload["dub"]
     user_id = call.from_user.id
 
-    cursor.execute("SELECT COUNT(*) FROM videos WHERE anime=? AND dub=?", (anime_name, dub))
-    total = cursor.fetchone()[0]
+    total = await DB.fetchval("SELECT COUNT(*) FROM videos WHERE anime=? AND dub=?", (anime_name, dub))
 
-    cursor.execute("SELECT DISTINCT season FROM videos WHERE anime=? AND dub=?", (anime_name, dub))
-    seasons = sorted([row[0] for row in cursor.fetchall()], key=_delete_season_sort_key)
+    rows = await DB.fetchall("SELECT DISTINCT season FROM videos WHERE anime=? AND dub=?", (anime_name, dub))
+    seasons = sorted([row[0] for row in rows], key=_delete_season_sort_key)
 
     buttons = []
     action_token = _delete_token(user_id, {"scope": "dub", "anime": anime_name, "dub": dub}, action=True)
@@ -4963,17 +6256,10 @@ async def _delete_show_season_actions(call: types.CallbackQuery, payload: dict,
     season = str(payload["season"])
     user_id = call.from_user.id
 
-    cursor.execute(
-        "SELECT COUNT(*) FROM videos WHERE anime=? AND dub=? AND CAST(season AS TEXT)=?",
-        (anime_name, dub, season)
-    )
-    total = cursor.fetchone()[0]
-
-    cursor.execute(
-        "SELECT DISTINCT episode FROM videos WHERE anime=? AND dub=? AND CAST(season AS TEXT)=?",
-        (anime_name, dub, season)
-    )
-    episodes = sorted([row[0] for row in cursor.fetchall()], key=_delete_episode_sort_key)
+    where, params = _delete_where({"scope": "season", "anime": anime_name, "dub": dub, "season": season})
+    rows = await DB.fetchall(f"SELECT episode FROM episodes WHERE {where} ORDER BY episode", params)
+    episodes = [row[0] for row in rows]
+    total = len(episodes)
 
     page = max(0, page)
     start = page * DELETE_EPISODES_PER_PAGE
@@ -5019,7 +6305,7 @@ async def _delete_show_season_actions(call: types.CallbackQuery, payload: dict,
 
 async def _delete_show_confirm(target, action: dict):
     user_id = target.from_user.id
-    count = _delete_count(action)
+    count = await _delete_count(action)
 
     if count <= 0:
         await _delete_send_or_edit(target, "❌ Ничего не найдено для удаления.")
@@ -5041,43 +6327,63 @@ async def _delete_show_confirm(target, action: dict):
     await _delete_send_or_edit(target, text, kb)
 
 
-async def _delete_execute(call: types.CallbackQuery, action: dict):
-    count = _delete_count(action)
-    if count <= 0:
-        await _delete_send_or_edit(call, "❌ Ничего не найдено для удаления.")
-        return
-
+def _delete_records(conn, action: dict) -> int:
+    """Удаляет серии и всё, что на них ссылается, одной транзакцией. Возвращает число удалённых серий."""
     where, params = _delete_where(action)
 
-    # Удаляем из основной таблицы серий
-    cursor.execute(f"DELETE FROM videos WHERE {where}", params)
-    deleted_videos = cursor.rowcount
+    # Удаляем из основной таблицы серий, тайтл без серий — следом.
+    deleted_videos = conn.execute(f"DELETE FROM episodes WHERE {where}", params).rowcount
+    conn.execute(
+        "DELETE FROM titles WHERE name=? AND NOT EXISTS (SELECT 1 FROM episodes WHERE title_id = titles.id)",
+        (action.get("anime"),)
+    )
+
+    key = _delete_key(action)
+    if key is None:
+        return deleted_videos
 
     scope = action.get("scope")
     anime_name = action.get("anime")
     dub = action.get("dub")
-    season = str(action.get("season")) if action.get("season") is not None else None
-    episode = str(action.get("episode")) if action.get("episode") is not None else None
+    kind, season, episode = key
+    # В watch_history сезон хранится как в videos: номер или "Фильм"
+    if kind == "film":
+        season = "Фильм"
 
-    # Чистим историю просмотра по тем же условиям
+    # Чистим историю просмотра по тем же условиям, что и episodes
     if scope == "anime":
-        cursor.execute("DELETE FROM watch_history WHERE anime=?", (anime_name,))
-        cursor.execute("DELETE FROM collection_items WHERE anime=?", (anime_name,))
-        cursor.execute("DELETE FROM anime_info WHERE anime=?", (anime_name,))
+        conn.execute("DELETE FROM watch_history WHERE anime=?", (anime_name,))
+        conn.execute("DELETE FROM collection_items WHERE anime=?", (anime_name,))
+        conn.execute("DELETE FROM anime_info WHERE anime=?", (anime_name,))
     elif scope == "dub":
-        cursor.execute("DELETE FROM watch_history WHERE anime=? AND dub=?", (anime_name, dub))
+        conn.execute("DELETE FROM watch_history WHERE anime=? AND dub=?", (anime_name, dub))
     elif scope == "season":
-        cursor.execute(
-            "DELETE FROM watch_history WHERE anime=? AND dub=? AND CAST(season AS TEXT)=?",
+        conn.execute(
+            "DELETE FROM watch_history WHERE anime=? AND dub=? AND season=?",
             (anime_name, dub, season)
         )
     elif scope == "episode":
-        cursor.execute(
-            "DELETE FROM watch_history WHERE anime=? AND dub=? AND CAST(season AS TEXT)=? AND CAST(episode AS TEXT)=?",
+        conn.execute(
+            "DELETE FROM watch_history WHERE anime=? AND dub=? AND season=? AND episode=?",
             (anime_name, dub, season, episode)
         )
 
-    db.commit()
+    return deleted_videos
+
+
+async def _delete_execute(call: types.CallbackQuery, action: dict):
+    count = await _delete_count(action)
+    if count <= 0:
+        await _delete_send_or_edit(call, "❌ Ничего не найдено для удаления.")
+        return
+
+    deleted_videos = await DB.transaction(_delete_records, action)
+
+    anime_name = action.get("anime")
+    if action.get("scope") == "anime":
+        META_CACHE.pop(anime_name)
+
+    await on_catalog_changed(anime_name)
 
     text = (
         "✅ <b>Удаление выполнено</b>\n\n"
@@ -5106,8 +6412,7 @@ async def _delete_from_args(message: types.Message, args: str):
         return
 
     anime_raw = parts[0].lower()
-    cursor.execute("SELECT DISTINCT anime FROM videos WHERE LOWER(anime)=LOWER(?) LIMIT 1", (anime_raw,))
-    row = cursor.fetchone()
+    row = await DB.fetchone("SELECT DISTINCT anime FROM videos WHERE LOWER(anime)=LOWER(?) LIMIT 1", (anime_raw,))
     if not row:
         await message.answer("❌ Аниме не найдено. Для выбора из списка используй просто <code>/delete</code>.", parse_mode="HTML")
         return
@@ -5117,11 +6422,10 @@ async def _delete_from_args(message: types.Message, args: str):
 
     if len(parts) >= 2:
         dub_raw = parts[1]
-        cursor.execute(
+        row = await DB.fetchone(
             "SELECT DISTINCT dub FROM videos WHERE anime=? AND LOWER(dub)=LOWER(?) LIMIT 1",
             (anime_name, dub_raw)
         )
-        row = cursor.fetchone()
         if not row:
             await message.answer("❌ Озвучка не найдена. Для выбора из списка используй просто <code>/delete</code>.", parse_mode="HTML")
             return
@@ -5129,30 +6433,19 @@ async def _delete_from_args(message: types.Message, args: str):
         action = {"scope": "dub", "anime": anime_name, "dub": dub}
 
     if len(parts) >= 3:
-        season_raw = parts[2]
-        cursor.execute(
-            "SELECT DISTINCT season FROM videos WHERE anime=? AND dub=? AND CAST(season AS TEXT)=? LIMIT 1",
-            (anime_name, dub, str(season_raw))
-        )
-        row = cursor.fetchone()
-        if not row:
+        season_key = _season_columns(parts[2])
+        season = ("Фильм" if season_key[0] == "film" else str(season_key[1])) if season_key else parts[2]
+        action = {"scope": "season", "anime": anime_name, "dub": dub, "season": season}
+        if await _delete_count(action) <= 0:
             await message.answer("❌ Сезон/фильм не найден. Для выбора из списка используй просто <code>/delete</code>.", parse_mode="HTML")
             return
-        season = str(row[0])
-        action = {"scope": "season", "anime": anime_name, "dub": dub, "season": season}
 
     if len(parts) >= 4:
-        episode_raw = parts[3]
-        cursor.execute(
-            "SELECT DISTINCT episode FROM videos WHERE anime=? AND dub=? AND CAST(season AS TEXT)=? AND CAST(episode AS TEXT)=? LIMIT 1",
-            (anime_name, dub, season, str(episode_raw))
-        )
-        row = cursor.fetchone()
-        if not row:
+        episode = parts[3].lstrip("0") or "0"
+        action = {"scope": "episode", "anime": anime_name, "dub": dub, "season": season, "episode": episode}
+        if await _delete_count(action) <= 0:
             await message.answer("❌ Серия не найдена. Для выбора из списка используй просто <code>/delete</code>.", parse_mode="HTML")
             return
-        episode = str(row[0])
-        action = {"scope": "episode", "anime": anime_name, "dub": dub, "season": season, "episode": episode}
 
     await _delete_show_confirm(message, action)
 
@@ -5299,6 +6592,126 @@ async def search_menu(call: types.CallbackQuery):
 # =========================
 # Проверка статуса подписки
 # =========================
+@router.message(Command("cachestats"))
+async def cache_stats(message: types.Message):
+    if message.from_user.id not in ADMINS:
+        await message.answer("❌ У вас нет доступа к этой команде.")
+        return
+
+    stats = META_CACHE_STATS
+    total = sum(stats.values()) or 1
+    await message.answer(
+        "📊 <b>Кэш метаданных</b>\n\n"
+        f"В памяти: {len(META_CACHE)} / {META_CACHE.maxsize}\n"
+        f"Попадания (память): {stats['memory_hits']}\n"
+        f"Попадания (anime_info): {stats['db_hits']}\n"
+        f"Промахи (сеть): {stats['misses']}\n"
+        f"Hit rate: {(stats['memory_hits'] + stats['db_hits']) * 100 // total}%\n"
+        f"Негативный кэш: {len(NEGATIVE_CACHE)}\n\n"
+        + "\n".join(f"{name}: {breaker.state}" for name, breaker in HTTP.breakers.items()),
+        parse_mode="HTML"
+    )
+
+
+# Частые запросы хэндлеров: (название, SQL, параметры из образца в базе).
+DB_BENCH_QUERIES = [
+    ("серии озвучки",
+     "SELECT episode, file_id FROM episodes WHERE title_id=? AND dub_id=? AND kind=? AND season=? ORDER BY episode",
+     lambda s: (s["title_id"], s["dub_id"], s["kind"], s["season"])),
+    ("соседняя серия",
+     "SELECT 1 FROM episodes WHERE title_id=? AND dub_id=? AND kind=? AND season=? AND episode=?",
+     lambda s: (s["title_id"], s["dub_id"], s["kind"], s["season"], s["episode"])),
+    ("озвучки сезона",
+     "SELECT DISTINCT dub_id FROM episodes WHERE title_id=? AND kind=? AND season=?",
+     lambda s: (s["title_id"], s["kind"], s["season"])),
+    ("закладки по статусу",
+     "SELECT anime FROM user_bookmarks WHERE user_id=? AND status=? ORDER BY created_at DESC",
+     lambda s: (s["user_id"], "favorite")),
+    ("история просмотра",
+     "SELECT anime, dub, season, episode FROM watch_history WHERE user_id=? "
+     "ORDER BY updated_at DESC LIMIT 10",
+     lambda s: (s["user_id"],)),
+    ("состав подборки",
+     "SELECT anime FROM collection_items WHERE collection_id=? ORDER BY position",
+     lambda s: (s["collection_id"],)),
+    ("лайки подборки",
+     "SELECT COUNT(*) FROM collection_likes WHERE collection_id=?",
+     lambda s: (s["collection_id"],)),
+    ("топ по рейтингу",
+     "SELECT anime, score FROM anime_info ORDER BY CAST(score AS REAL) DESC LIMIT 10",
+     lambda s: ()),
+]
+
+
+def _bench_sample(conn) -> dict:
+    sample = {"title_id": 0, "dub_id": 0, "kind": "series", "season": 1, "episode": 1, "user_id": 0, "collection_id": 0}
+    # Самый длинный сезон — на нём разница в планах заметнее всего
+    row = conn.execute(
+        "SELECT title_id, dub_id, kind, season, MIN(episode) FROM episodes "
+        "GROUP BY title_id, dub_id, kind, season ORDER BY COUNT(*) DESC LIMIT 1"
+    ).fetchone()
+    if row:
+        sample.update(title_id=row[0], dub_id=row[1], kind=row[2], season=row[3], episode=row[4])
+    row = conn.execute("SELECT user_id FROM watch_history LIMIT 1").fetchone()
+    if row:
+        sample["user_id"] = row[0]
+    row = conn.execute("SELECT collection_id FROM collection_items LIMIT 1").fetchone()
+    if row:
+        sample["collection_id"] = row[0]
+    return sample
+
+
+def _bench_run(conn, sample: dict, repeat: int) -> list:
+    results = []
+    for name, sql, params in DB_BENCH_QUERIES:
+        args = params(sample)
+        plan = " / ".join(row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, args))
+        started = time.perf_counter()
+        for _ in range(repeat):
+            conn.execute(sql, args).fetchall()
+        results.append((name, plan, (time.perf_counter() - started) * 1000 / repeat))
+    return results
+
+
+def run_db_benchmark(conn, repeat: int = 50) -> list:
+    """План и среднее время частых запросов без индексов SCHEMA_INDEXES и с ними.
+
+    Обе стороны меряются на копиях базы в памяти, рабочую базу не трогаем.
+    Запросы по PRIMARY KEY episodes в обеих колонках одинаковы — ключ часть таблицы.
+    """
+    before = sqlite3.connect(":memory:")
+    after = sqlite3.connect(":memory:")
+    try:
+        conn.backup(before)
+        conn.backup(after)
+        for name, _ in SCHEMA_INDEXES:
+            before.execute(f"DROP INDEX IF EXISTS {name}")
+        sample = _bench_sample(after)
+        return list(zip(_bench_run(before, sample, repeat), _bench_run(after, sample, repeat)))
+    finally:
+        before.close()
+        after.close()
+
+
+@router.message(Command("dbbench"))
+async def db_bench(message: types.Message):
+    if message.from_user.id not in ADMINS:
+        await message.answer("❌ У вас нет доступа к этой команде.")
+        return
+
+    version = await DB.fetchval("SELECT MAX(version) FROM schema_version")
+    results = await DB.read(run_db_benchmark)
+
+    lines = [f"🗄 <b>Запросы к БД</b> (схема v{version})\n"]
+    for (name, plan_before, ms_before), (_, plan_after, ms_after) in results:
+        lines.append(
+            f"<b>{name}</b>: {ms_before:.2f} → {ms_after:.2f} мс\n"
+            f"до: <code>{html.escape(plan_before)}</code>\n"
+            f"после: <code>{html.escape(plan_after)}</code>\n"
+        )
+    await message.answer("\n".join(lines), parse_mode="HTML")
+
+
 @router.message(Command("getid"))
 async def get_file_id(message: types.Message):
 
@@ -5331,11 +6744,10 @@ async def sub_status(call: types.CallbackQuery):
     user_id = call.from_user.id
     chat_id = call.message.chat.id
 
-    cursor.execute(
+    row = await DB.fetchone(
         "SELECT type, expire_date FROM subscriptions WHERE user_id=?",
         (user_id,)
     )
-    row = cursor.fetchone()
 
     # Кнопка назад
     kb = InlineKeyboardMarkup(
@@ -5509,13 +6921,14 @@ async def get_yookassa_payment(payment_id: str):
 
     try:
         auth = aiohttp.BasicAuth(YOOKASSA_SHOP_ID, YOOKASSA_SECRET_KEY)
-        async with aiohttp.ClientSession(auth=auth) as session:
-            async with session.get(f"{YOOKASSA_API_PAYMENTS}/{payment_id}", timeout=15) as resp:
-                data = await resp.json(content_type=None)
-                if resp.status >= 400:
-                    logging.error(f"[YooKassa] get payment error {resp.status}: {data}")
-                    return None
-                return data
+        status, data = await HTTP.request_json(
+            "yookassa", "GET", f"{YOOKASSA_API_PAYMENTS}/{payment_id}",
+            auth=auth, timeout=aiohttp.ClientTimeout(total=15)
+        )
+        if status >= 400:
+            logging.error(f"[YooKassa] get payment error {status}: {data}")
+            return None
+        return data
     except Exception as e:
         logging.error(f"[YooKassa] get payment exception: {e}")
         return None
@@ -5552,45 +6965,55 @@ async def create_yookassa_payment_async(user_id: int, rub_amount: int, period_ke
 
     try:
         auth = aiohttp.BasicAuth(YOOKASSA_SHOP_ID, YOOKASSA_SECRET_KEY)
-        async with aiohttp.ClientSession(auth=auth) as session:
-            async with session.post(YOOKASSA_API_PAYMENTS, json=payload, headers=headers, timeout=20) as resp:
-                data = await resp.json(content_type=None)
+        status, data = await HTTP.request_json(
+            "yookassa", "POST", YOOKASSA_API_PAYMENTS,
+            json=payload, headers=headers, auth=auth
+        )
 
-                if resp.status >= 400:
-                    logging.error(f"[YooKassa] create payment error {resp.status}: {data}")
-                    return None, None
+        if status >= 400 or not data:
+            logging.error(f"[YooKassa] create payment error {status}: {data}")
+            return None, None
 
-                payment_id = data.get("id")
-                confirmation_url = data.get("confirmation", {}).get("confirmation_url")
+        payment_id = data.get("id")
+        confirmation_url = data.get("confirmation", {}).get("confirmation_url")
 
-                if not payment_id or not confirmation_url:
-                    logging.error(f"[YooKassa] Нет payment_id или confirmation_url: {data}")
-                    return None, None
+        if not payment_id or not confirmation_url:
+            logging.error(f"[YooKassa] Нет payment_id или confirmation_url: {data}")
+            return None, None
 
-                cursor.execute(
-                    "INSERT OR REPLACE INTO pending_payments (user_id, period_key, invoice_id, pay_url, created_at) "
-                    "VALUES (?, ?, ?, ?, ?)",
-                    (user_id, period_key, payment_id, confirmation_url, datetime.now().isoformat())
-                )
-                db.commit()
+        await DB.execute(
+            "INSERT OR REPLACE INTO pending_payments (user_id, period_key, invoice_id, pay_url, created_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (user_id, period_key, payment_id, confirmation_url, datetime.now().isoformat())
+        )
 
-                logging.info(f"[YooKassa] Payment created user={user_id}, period={period_key}, payment_id={payment_id}")
-                return payment_id, confirmation_url
+        logging.info(f"[YooKassa] Payment created user={user_id}, period={period_key}, payment_id={payment_id}")
+        return payment_id, confirmation_url
 
     except Exception as e:
         logging.error(f"[YooKassa] create payment exception: {e}")
         return None, None
 
 
+def _apply_paid_subscription(conn, processed_id: str, user_id: int, period_key: str, days: int | None) -> bool:
+    """Отмечает платёж обработанным и выдаёт подписку; False, если платёж уже был."""
+    row = conn.execute("SELECT 1 FROM processed_invoices WHERE invoice_id=?", (processed_id,)).fetchone()
+    if row:
+        return False
+
+    conn.execute(
+        "INSERT INTO processed_invoices (invoice_id, user_id, period_key, created_at) VALUES (?, ?, ?, ?)",
+        (processed_id, user_id, period_key, datetime.now().isoformat())
+    )
+    conn.execute("DELETE FROM pending_payments WHERE user_id=?", (user_id,))
+    _give_subscription(conn, user_id, days)
+    return True
+
+
 async def activate_paid_subscription(user_id: int, period_key: str, payment_id: str, provider: str = "yookassa"):
     """Единая выдача подписки после успешной оплаты. Защищает от повторной обработки."""
     processed_id = f"{provider}:{payment_id}"
 
-    cursor.execute("SELECT 1 FROM processed_invoices WHERE invoice_id=?", (processed_id,))
-    if cursor.fetchone():
-        logging.warning(f"[{provider}] Payment already processed: {processed_id}")
-        return False
-
     if period_key == "forever":
         days = None
     else:
@@ -5600,14 +7023,10 @@ async def activate_paid_subscription(user_id: int, period_key: str, payment_id:
             logging.error(f"[{provider}] Invalid period_key: {period_key}")
             return False
 
-    cursor.execute(
-        "INSERT INTO processed_invoices (invoice_id, user_id, period_key, created_at) VALUES (?, ?, ?, ?)",
-        (processed_id, user_id, period_key, datetime.now().isoformat())
-    )
-    cursor.execute("DELETE FROM pending_payments WHERE user_id=?", (user_id,))
-    db.commit()
+    if not await DB.transaction(_apply_paid_subscription, processed_id, user_id, period_key, days):
+        logging.warning(f"[{provider}] Payment already processed: {processed_id}")
+        return False
 
-    give_subscription(user_id, days)
     await process_referral_bonus(user_id, period_key)
 
     try:
@@ -5662,7 +7081,7 @@ def parse_yoomoney_label(label: str):
         return None, None
 
 
-def create_yoomoney_payment_link(user_id: int, rub_amount: int, period_key: str):
+async def create_yoomoney_payment_link(user_id: int, rub_amount: int, period_key: str):
     """Создаёт ссылку на оплату ЮMoney и сохраняет ожидающий платёж в базу."""
     if not YOOMONEY_RECEIVER:
         logging.error("[YooMoney] Не задан YOOMONEY_RECEIVER")
@@ -5685,12 +7104,11 @@ def create_yoomoney_payment_link(user_id: int, rub_amount: int, period_key: str)
 
     pay_url = YOOMONEY_QUICKPAY_URL + "?" + urllib.parse.urlencode(params)
 
-    cursor.execute(
+    await DB.execute(
         "INSERT OR REPLACE INTO pending_payments (user_id, period_key, invoice_id, pay_url, created_at) "
         "VALUES (?, ?, ?, ?, ?)",
         (user_id, period_key, label, pay_url, datetime.now().isoformat())
     )
-    db.commit()
 
     logging.info(f"[YooMoney] Payment link created user={user_id}, period={period_key}, label={label}")
     return label, pay_url
@@ -5783,11 +7201,10 @@ async def handle_yoomoney_webhook(request):
             logging.warning(f"[YOOMONEY_WEBHOOK] Платёж с codepro operation_id={operation_id}")
             return web.Response(text="Codepro")
 
-        cursor.execute(
+        row = await DB.fetchone(
             "SELECT user_id, period_key FROM pending_payments WHERE invoice_id=?",
             (label,)
         )
-        row = cursor.fetchone()
 
         user_id = None
         period_key = None
@@ -5965,12 +7382,11 @@ async def pay_stars_handler(call: types.CallbackQuery):
 
     payload = make_stars_payload(user_id, period_key)
 
-    cursor.execute(
+    await DB.execute(
         "INSERT OR REPLACE INTO pending_payments (user_id, period_key, invoice_id, pay_url, created_at) "
         "VALUES (?, ?, ?, ?, ?)",
         (user_id, period_key, payload, "telegram_stars", datetime.now().isoformat())
     )
-    db.commit()
 
     try:
         msg = await bot.send_invoice(
@@ -6102,36 +7518,33 @@ async def create_crypto_invoice_async(user_id: int, rub_amount: int, period_key:
     }
 
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, json=payload, headers=headers, timeout=20) as resp:
-                result = await resp.json(content_type=None)
-
-                if resp.status >= 400 or not result.get("ok"):
-                    logging.error(f"[CryptoBot] createInvoice error {resp.status}: {result}")
-                    return None, None
-
-                invoice = result.get("result") or {}
-                invoice_id = str(invoice.get("invoice_id") or "").strip()
-                invoice_url = (
-                    invoice.get("bot_invoice_url")
-                    or invoice.get("mini_app_invoice_url")
-                    or invoice.get("web_app_invoice_url")
-                    or invoice.get("pay_url")
-                )
+        status, result = await HTTP.request_json("cryptobot", "POST", url, json=payload, headers=headers)
 
-                if not invoice_id or not invoice_url:
-                    logging.error(f"[CryptoBot] Нет invoice_id или invoice_url: {invoice}")
-                    return None, None
+        if status >= 400 or not result or not result.get("ok"):
+            logging.error(f"[CryptoBot] createInvoice error {status}: {result}")
+            return None, None
 
-                cursor.execute(
-                    "INSERT OR REPLACE INTO pending_payments (user_id, period_key, invoice_id, pay_url, created_at) "
-                    "VALUES (?, ?, ?, ?, ?)",
-                    (user_id, period_key, invoice_id, invoice_url, datetime.now().isoformat())
-                )
-                db.commit()
+        invoice = result.get("result") or {}
+        invoice_id = str(invoice.get("invoice_id") or "").strip()
+        invoice_url = (
+            invoice.get("bot_invoice_url")
+            or invoice.get("mini_app_invoice_url")
+            or invoice.get("web_app_invoice_url")
+            or invoice.get("pay_url")
+        )
+
+        if not invoice_id or not invoice_url:
+            logging.error(f"[CryptoBot] Нет invoice_id или invoice_url: {invoice}")
+            return None, None
+
+        await DB.execute(
+            "INSERT OR REPLACE INTO pending_payments (user_id, period_key, invoice_id, pay_url, created_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (user_id, period_key, invoice_id, invoice_url, datetime.now().isoformat())
+        )
 
-                logging.info(f"[CryptoBot] Invoice created user={user_id}, period={period_key}, invoice_id={invoice_id}")
-                return invoice_id, invoice_url
+        logging.info(f"[CryptoBot] Invoice created user={user_id}, period={period_key}, invoice_id={invoice_id}")
+        return invoice_id, invoice_url
 
     except Exception as e:
         logging.error(f"[CryptoBot] createInvoice exception: {e}")
@@ -6149,23 +7562,24 @@ async def get_crypto_invoice(invoice_id: str):
     params = {"invoice_ids": str(invoice_id)}
 
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, params=params, headers=headers, timeout=15) as resp:
-                result = await resp.json(content_type=None)
+        status, result = await HTTP.request_json(
+            "cryptobot", "GET", url,
+            params=params, headers=headers, timeout=aiohttp.ClientTimeout(total=15)
+        )
 
-                if resp.status >= 400 or not result.get("ok"):
-                    logging.error(f"[CryptoBot] getInvoices error {resp.status}: {result}")
-                    return None
+        if status >= 400 or not result or not result.get("ok"):
+            logging.error(f"[CryptoBot] getInvoices error {status}: {result}")
+            return None
 
-                data = result.get("result")
-                if isinstance(data, dict):
-                    items = data.get("items") or data.get("invoices") or []
-                elif isinstance(data, list):
-                    items = data
-                else:
-                    items = []
+        data = result.get("result")
+        if isinstance(data, dict):
+            items = data.get("items") or data.get("invoices") or []
+        elif isinstance(data, list):
+            items = data
+        else:
+            items = []
 
-                return items[0] if items else None
+        return items[0] if items else None
 
     except Exception as e:
         logging.error(f"[CryptoBot] getInvoices exception: {e}")
@@ -6287,18 +7701,17 @@ async def check_crypto_handler(call: types.CallbackQuery):
         await call.answer("Ошибка счёта", show_alert=True)
         return
 
-    cursor.execute(
+    row = await DB.fetchone(
         "SELECT user_id, period_key FROM pending_payments WHERE invoice_id=?",
         (invoice_id,)
     )
-    row = cursor.fetchone()
 
     if not row:
-        cursor.execute(
+        row = await DB.fetchone(
             "SELECT 1 FROM processed_invoices WHERE invoice_id=?",
             (f"cryptobot:{invoice_id}",)
         )
-        if cursor.fetchone():
+        if row:
             await call.answer("✅ Эта оплата уже была обработана", show_alert=True)
         else:
             await call.answer("Счёт не найден в ожидании оплаты", show_alert=True)
@@ -6357,11 +7770,10 @@ async def handle_crypto_webhook(request):
             return web.Response(text="Not paid")
 
         # Сначала пытаемся найти ожидаемый платёж по invoice_id.
-        cursor.execute(
+        row = await DB.fetchone(
             "SELECT user_id, period_key FROM pending_payments WHERE invoice_id=?",
             (invoice_id,)
         )
-        row = cursor.fetchone()
 
         user_id = None
         period_key = None
@@ -6443,6 +7855,112 @@ async def test(request):
     return web.Response(text="Server OK")
 
 # ===== Регистрация вебхуков =====
+# =========================
+# Telegram webhook
+# =========================
+# У каждого пользователя/чата своя очередь и свой обработчик-задача: его апдейты
+# идут строго по порядку (FSM, мульти-выбор), а разные пользователи не ждут
+# друг друга. Слот TELEGRAM_UPDATE_SEMAPHORE берётся только на сам
+# dp.feed_update, так что пользователь, засыпавший бота апдейтами, занимает
+# не больше одного слота. Обработчик завершается, когда его очередь пуста.
+TELEGRAM_USER_QUEUES = {}
+TELEGRAM_WORKER_TASKS = set()
+TELEGRAM_UPDATE_SEMAPHORE = asyncio.Semaphore(max(1, TELEGRAM_MAX_CONCURRENT_UPDATES))
+TELEGRAM_PENDING_UPDATES = 0
+TELEGRAM_DROPPED_UPDATES = 0
+
+
+def _update_user_key(data: dict) -> int:
+    for key, value in data.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        user = value.get("from") or value.get("user") or {}
+        chat = value.get("chat") or (value.get("message") or {}).get("chat") or {}
+        return user.get("id") or chat.get("id") or data.get("update_id", 0)
+    return data.get("update_id", 0)
+
+
+def enqueue_telegram_update(data: dict) -> bool:
+    """Ставит апдейт в очередь его пользователя. False — очередь полна, апдейт отброшен."""
+    global TELEGRAM_PENDING_UPDATES, TELEGRAM_DROPPED_UPDATES
+
+    key = _update_user_key(data)
+    queue = TELEGRAM_USER_QUEUES.get(key)
+    if TELEGRAM_PENDING_UPDATES >= TELEGRAM_QUEUE_SIZE or (queue is not None and queue.full()):
+        TELEGRAM_DROPPED_UPDATES += 1
+        logging.warning(
+            f"[TG_WEBHOOK] Очередь переполнена, update_id={data.get('update_id')} от {key} отброшен "
+            f"(всего отброшено: {TELEGRAM_DROPPED_UPDATES})"
+        )
+        return False
+
+    if queue is None:
+        queue = TELEGRAM_USER_QUEUES[key] = asyncio.Queue(maxsize=max(1, TELEGRAM_USER_QUEUE_SIZE))
+        task = asyncio.create_task(telegram_update_worker(key, queue))
+        TELEGRAM_WORKER_TASKS.add(task)
+        task.add_done_callback(TELEGRAM_WORKER_TASKS.discard)
+
+    queue.put_nowait(data)
+    TELEGRAM_PENDING_UPDATES += 1
+    return True
+
+
+async def handle_telegram_webhook(request):
+    if TELEGRAM_WEBHOOK_SECRET and not hmac.compare_digest(
+        request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""),
+        TELEGRAM_WEBHOOK_SECRET
+    ):
+        return web.Response(text="Bad secret", status=403)
+
+    try:
+        data = await request.json()
+    except Exception as e:
+        logging.error(f"[TG_WEBHOOK] Ошибка JSON: {e}")
+        return web.Response(text="Invalid JSON", status=400)
+
+    # Отвечаем сразу и всегда 200, даже если апдейт отброшен
+    enqueue_telegram_update(data)
+    return web.Response(text="OK")
+
+
+async def process_telegram_update(data: dict):
+    try:
+        update = types.Update.model_validate(data, context={"bot": bot})
+        async with TELEGRAM_UPDATE_SEMAPHORE:
+            await dp.feed_update(bot, update)
+    except Exception as e:
+        logging.exception(f"[TG_WEBHOOK] Ошибка обработки update_id={data.get('update_id')}: {e}")
+
+
+async def telegram_update_worker(key: int, queue: asyncio.Queue):
+    global TELEGRAM_PENDING_UPDATES
+
+    try:
+        # Проверка пустоты и удаление очереди — без await между ними,
+        # поэтому новый апдейт не попадёт в уже брошенную очередь.
+        while not queue.empty():
+            data = queue.get_nowait()
+            TELEGRAM_PENDING_UPDATES -= 1
+            await process_telegram_update(data)
+    finally:
+        if TELEGRAM_USER_QUEUES.get(key) is queue:
+            del TELEGRAM_USER_QUEUES[key]
+        TELEGRAM_PENDING_UPDATES -= queue.qsize()
+
+
+async def stop_telegram_workers():
+    """Даёт начатым апдейтам TELEGRAM_SHUTDOWN_TIMEOUT секунд на завершение, остальные отменяет."""
+    if not TELEGRAM_WORKER_TASKS:
+        return
+
+    _, pending = await asyncio.wait(set(TELEGRAM_WORKER_TASKS), timeout=TELEGRAM_SHUTDOWN_TIMEOUT)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    if pending:
+        logging.warning(f"[TG_WEBHOOK] Прервано обработчиков при остановке: {len(pending)}")
+
+
 app = web.Application()
 
 # Для совместимости старый /webhook оставлен под CryptoBot.
@@ -6453,6 +7971,8 @@ app.router.add_post("/webhook", handle_crypto_webhook)
 app.router.add_post("/cryptobot", handle_crypto_webhook)
 app.router.add_post("/yookassa", handle_yookassa_webhook)
 app.router.add_post("/yoomoney", handle_yoomoney_webhook)
+if TELEGRAM_DELIVERY == "webhook":
+    app.router.add_post(TELEGRAM_WEBHOOK_PATH, handle_telegram_webhook)
 
 @router.callback_query(F.data == "confirm_payment")
 async def confirm_payment(call: types.CallbackQuery):
@@ -6547,8 +8067,7 @@ async def live_search(message: types.Message, state: FSMContext):
     if not query.isdigit() or len(query) != 6:
         return
 
-    cursor.execute("SELECT anime FROM anime_catalog WHERE id=?", (query,))
-    row = cursor.fetchone()
+    row = await DB.fetchone("SELECT anime FROM anime_catalog WHERE id=?", (query,))
     found_animes = [row[0]] if row else []
 
     if not found_animes:
@@ -6568,19 +8087,11 @@ async def live_search(message: types.Message, state: FSMContext):
         )
         return
 
-    cursor.execute("SELECT DISTINCT anime FROM videos ORDER BY anime")
-    all_animes = [row[0] for row in cursor.fetchall()]
-
     for anime in found_animes:
-        try:
-            anime_idx = all_animes.index(anime)
-        except ValueError:
-            continue
-
         builder = InlineKeyboardBuilder()
         builder.row(InlineKeyboardButton(
             text=" Открыть",
-            callback_data=f"anime_index|{anime_idx}",
+            callback_data=anime_card_callback(query),
             style="danger",
             icon_custom_emoji_id="5348125953090403204"
         ))
@@ -6613,19 +8124,17 @@ async def live_search(message: types.Message, state: FSMContext):
         # 🔥 ЛОГИКА ПОСТЕРА (НЕ ТРОГАЕМ)
         # ==============================
 
-        cursor.execute(
+        row = await DB.fetchone(
             "SELECT poster FROM anime_info WHERE anime=?",
             (anime,)
         )
-        row = cursor.fetchone()
         poster_url = row[0] if row and row[0] else None
 
         if not poster_url and info:
-            cursor.execute(
+            r = await DB.fetchone(
                 "SELECT english_name FROM videos WHERE anime=? LIMIT 1",
                 (anime,)
             )
-            r = cursor.fetchone()
             english_name = r[0] if r and r[0] else anime
 
             try:
@@ -6643,12 +8152,11 @@ async def live_search(message: types.Message, state: FSMContext):
                 poster_url = fix_shiki_poster(info.get("poster"))
 
             if poster_url:
-                cursor.execute(
+                await DB.execute(
                     "INSERT INTO anime_info (anime, poster) VALUES (?, ?) "
-                    "ON CONFLICT(anime) DO UPDATE SET poster=excluded.poster",
+                    "ON CONFLICT(anime) DO UPDATE SET poster=excluded.poster, poster_file_id=NULL",
                     (anime, poster_url)
                 )
-                db.commit()
 
         # ==============================
         # 🔥 НОВЫЙ ТЕКСТ (как inline)
@@ -6662,21 +8170,12 @@ async def live_search(message: types.Message, state: FSMContext):
         )
 
         try:
-            if poster_url:
-                await send_and_track(
-                    user_id,
-                    message.answer_photo,
-                    photo=poster_url,
-                    caption=text,
-                    parse_mode="HTML",
-                    reply_markup=kb,
-                    protect_content=True
-                )
-            elif info and info.get("poster"):
-                await send_and_track(
+            if poster_url or (info and info.get("poster")):
+                await send_anime_poster(
                     user_id,
                     message.answer_photo,
-                    photo=fix_shiki_poster(info.get("poster")),
+                    anime,
+                    poster_url or fix_shiki_poster(info.get("poster")),
                     caption=text,
                     parse_mode="HTML",
                     reply_markup=kb,
@@ -6701,49 +8200,24 @@ async def live_search(message: types.Message, state: FSMContext):
 # =========================
 
 async def search_anilist_poster(title_en: str) -> str | None:
-    query = '''
-    query ($search: String) {
-      Media(search: $search, type: ANIME) {
-        coverImage {
-          extraLarge
-          large
-        }
-      }
-    }
-    '''
+    if NEGATIVE_CACHE.get(("anilist", title_en)):
+        return None
+    return await INFLIGHT.do(("anilist", title_en), lambda: _search_anilist_poster(title_en))
 
-    variables = {"search": title_en}  # ✅ FIX
 
+async def _search_anilist_poster(title_en: str) -> str | None:
+    # Запрос уходит через ANILIST_POSTERS вместе с другими названиями из того же окна.
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                "https://graphql.anilist.co",
-                json={"query": query, "variables": variables},
-                timeout=aiohttp.ClientTimeout(total=10)
-            ) as resp:
-
-                if resp.status != 200:
-                    return None
-
-                data = await resp.json()
-
-                if "errors" in data:
-                    return None
-
-                media = data.get("data", {}).get("Media")
-                if not media:
-                    return None
-
-                cover = media.get("coverImage")
-                if not cover:
-                    return None
-
-                return cover.get("extraLarge") or cover.get("large")
-
+        poster = await ANILIST_POSTERS.resolve(title_en)
     except Exception as e:
-        print(f"[AniList ERROR] {title_en}: {e}")  # тоже поправил
+        print(f"[AniList ERROR] {title_en}: {e}")
         return None
 
+    # Сюда None доходит, только если AniList явно ответил null — сбои уходят в except выше.
+    if not poster:
+        NEGATIVE_CACHE.set(("anilist", title_en), True)
+    return poster
+
 def fix_shiki_poster(url: str | None) -> str | None:
     """Фиксируем URL постера с Shikimori, получаем оригинальное качество"""
     if not url:
@@ -6757,19 +8231,21 @@ def fix_shiki_poster(url: str | None) -> str | None:
 
 async def load_anime_info(anime_name: str):
     """Загрузка информации о аниме из базы и внешних источников"""
+    return await INFLIGHT.do(("anime_info", anime_name), lambda: _load_anime_info(anime_name))
+
+
+async def _load_anime_info(anime_name: str):
     # Проверка базы
-    cursor.execute(
+    row = await DB.fetchone(
         "SELECT poster, score, genres, year FROM anime_info WHERE anime=?",
         (anime_name,)
     )
-    row = cursor.fetchone()
 
     # Получаем английское название из videos
-    cursor.execute(
+    r = await DB.fetchone(
         "SELECT english_name FROM videos WHERE anime=? LIMIT 1",
         (anime_name,)
     )
-    r = cursor.fetchone()
     english_name = r[0] if r and r[0] else anime_name
 
     # ---------- ЕСЛИ АНИМЕ УЖЕ В БАЗЕ ----------
@@ -6786,11 +8262,10 @@ async def load_anime_info(anime_name: str):
                 poster_url = fix_shiki_poster(info.get("poster"))
 
             if poster_url:
-                cursor.execute(
-                    "UPDATE anime_info SET poster=? WHERE anime=?",
+                await DB.execute(
+                    "UPDATE anime_info SET poster=?, poster_file_id=NULL WHERE anime=?",
                     (poster_url, anime_name)
                 )
-                db.commit()
 
         return anime_name, poster_url, score, genres, year
 
@@ -6807,12 +8282,12 @@ async def load_anime_info(anime_name: str):
     score = str(info.get("score", "—"))
     year = str(info.get("year", "—"))
 
-    # Сохраняем в базе
-    cursor.execute(
-        "INSERT OR IGNORE INTO anime_info (anime, poster, score, genres, year) VALUES (?, ?, ?, ?, ?)",
+    # Сохраняем в базе (строку с описанием мог уже создать get_anime_info)
+    await DB.execute(
+        "INSERT INTO anime_info (anime, poster, score, genres, year) VALUES (?, ?, ?, ?, ?) "
+        "ON CONFLICT(anime) DO UPDATE SET poster=COALESCE(anime_info.poster, excluded.poster)",
         (anime_name, poster_url, score, genres, year)
     )
-    db.commit()
 
     return anime_name, poster_url, score, genres, year
 
@@ -6843,49 +8318,373 @@ def ru_to_latin(text: str | None) -> str:
     return "".join(RU_TO_LAT.get(ch, ch) for ch in normalized)
 
 
-def compact_search_text(text: str | None) -> str:
-    return normalize_search_text(text).replace(" ", "")
+def compact_search_text(text: str | None) -> str:
+    return normalize_search_text(text).replace(" ", "")
+
+
+# ---------- Оценка похожести ----------
+# Итоговая оценка — difflib.SequenceMatcher.ratio() * 100, как и раньше: пороги
+# 58/70/82 подобраны под неё. Но считать её для каждого алиаса дорого, поэтому
+# сначала идёт indel-ratio через длину LCS (бит-параллельный алгоритм Hyyrö):
+# 200 * LCS / (len(a) + len(b)). Совпадения difflib — общая подпоследовательность,
+# так что indel-ratio никогда не меньше ratio(): пары, где он ниже порога,
+# отбрасываются без потерь, и difflib считается только для оставшихся.
+
+_RATIO_EPS = 1e-9            # разные формулы округляются по-разному
+
+_BATCH_MAX_QUERY = 63        # uint64: v + u не должно переполниться
+_BATCH_MIN_ROWS = 32         # на паре десятков строк numpy не окупается
+_CODE_LIMIT = ord("я") + 1   # нормализованный текст: пробел, 0-9, a-z, а-я
+
+
+def _bit_pattern(text: str) -> tuple:
+    """Битовые маски позиций символов строки запроса."""
+    masks = {}
+    for i, ch in enumerate(text):
+        masks[ch] = masks.get(ch, 0) | (1 << i)
+    return masks, len(text)
+
+
+def _bounded_ratio(pattern: tuple, text: str, min_score: float = 0.0) -> float:
+    """indel-ratio запроса (pattern) и text; 0.0, если min_score недостижим."""
+    masks, n = pattern
+    m = len(text)
+    if not n or not m:
+        return 0.0
+
+    total = n + m
+    if 200.0 * min(n, m) / total < min_score:
+        return 0.0
+
+    need = min_score * total / 200.0
+    full = (1 << n) - 1
+    v = full
+    for i, ch in enumerate(text):
+        u = v & masks.get(ch, 0)
+        v = ((v + u) | (v - u)) & full
+        if i & 7 == 7 and (n - v.bit_count()) + (m - i - 1) < need:
+            return 0.0
+
+    return 200.0 * (n - v.bit_count()) / total
+
+
+def _encode_rows(texts) -> "np.ndarray":
+    """Строки -> матрица кодов символов для пакетной оценки (0 — добивка)."""
+    width = max((len(t) for t in texts), default=0)
+    codes = np.zeros((len(texts), max(width, 1)), dtype=np.uint16)
+    for row, text in enumerate(texts):
+        codes[row, :len(text)] = [min(ord(ch), _CODE_LIMIT) for ch in text]
+    return codes
+
+
+def _batch_ratio(query: str, codes, lengths) -> "np.ndarray":
+    """indel-ratio одного запроса (<= 63 символов) сразу для всех строк матрицы."""
+    n = len(query)
+    table = np.zeros(_CODE_LIMIT + 1, dtype=np.uint64)
+    for i, ch in enumerate(query):
+        code = ord(ch)
+        if code < _CODE_LIMIT:
+            table[code] |= np.uint64(1 << i)
+
+    full = np.uint64((1 << n) - 1)
+    v = np.full(len(codes), full, dtype=np.uint64)
+    for column in codes.T:
+        u = v & table[column]
+        v = ((v + u) | (v - u)) & full
+
+    if hasattr(np, "bitwise_count"):
+        ones = np.bitwise_count(v).astype(np.int64)
+    else:
+        ones = np.unpackbits(v.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+    return 200.0 * (n - ones) / (n + lengths)
+
+
+def _difflib_ratio(a: str, b: str) -> float:
+    return difflib.SequenceMatcher(None, a, b).ratio() * 100.0
+
+
+def _exact_tier_score(q: str, q_tokens: list, c: str, c_tokens: list) -> float:
+    """Совпадение целиком / по префиксу / подстроке / словам, иначе 0."""
+    if q == c:
+        return 100.0
+    if c.startswith(q):
+        return 96.0
+    if q in c:
+        return 91.0
+    if q_tokens and all(any(token in c_token for c_token in c_tokens) for token in q_tokens):
+        return 88.0
+    return 0.0
+
+
+def _match_score_prepared(q: str, q_tokens: list, q_compact: str, c: str, c_tokens: list, c_compact: str) -> float:
+    """title_match_score для уже нормализованных строк (без повторной нормализации)."""
+    if not q or not c:
+        return 0.0
+
+    score = _exact_tier_score(q, q_tokens, c, c_tokens)
+    if score:
+        return score
+
+    ratio = _difflib_ratio(q, c)
+    if q_compact and c_compact:
+        ratio = max(ratio, _difflib_ratio(q_compact, c_compact))
+
+    return ratio
 
 
 def title_match_score(query: str, candidate: str) -> float:
     """Оценка похожести запроса и одного варианта названия."""
     q = normalize_search_text(query)
     c = normalize_search_text(candidate)
+    return _match_score_prepared(q, q.split(), q.replace(" ", ""), c, c.split(), c.replace(" ", ""))
 
-    if not q or not c:
-        return 0.0
 
-    if q == c:
-        return 100.0
-    if c.startswith(q):
-        return 96.0
-    if q in c:
-        return 91.0
+def _prepare_search_text(text: str) -> tuple:
+    """(нормализованная строка, токены, без пробелов) — всё, что нужно для оценки."""
+    normalized = normalize_search_text(text)
+    return normalized, normalized.split(), normalized.replace(" ", "")
 
-    q_tokens = q.split()
-    c_tokens = c.split()
-    if q_tokens and all(any(token in c_token for c_token in c_tokens) for token in q_tokens):
-        return 88.0
 
-    ratio = difflib.SequenceMatcher(None, q, c).ratio() * 100.0
+def _trigrams(text: str) -> set:
+    """Триграммы по словам с дополнением пробелами (как в pg_trgm): "  w", " wo", ..., "rd "."""
+    grams = set()
+    for word in text.split():
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
 
-    q_compact = q.replace(" ", "")
-    c_compact = c.replace(" ", "")
-    if q_compact and c_compact:
-        ratio = max(ratio, difflib.SequenceMatcher(None, q_compact, c_compact).ratio() * 100.0)
 
-    return ratio
+class SearchIndex:
+    """Заранее подготовленные варианты названий для fuzzy_search_anime.
 
+    Для каждого аниме хранятся нормализованные алиасы (русское название,
+    все english_name, транслит и слитные варианты), чтобы при вводе запроса
+    не прогонять их заново через регулярки. Обновляется точечно через
+    on_catalog_changed.
 
-def fuzzy_search_anime(query_text: str, offset: int = 0, limit: int = PAGE_SIZE):
+    Поверх алиасов построен триграммный индекс: оценку получают только
+    кандидаты, у которых есть общая триграмма с запросом. Совпадение целиком,
+    по префиксу, подстроке и словам так не теряется. Похожие по ratio
+    названия без общих триграмм добираются по длине алиаса: ratio не больше
+    200 * min(n, m) / (n + m), так что за пределами окна длин порог
+    недостижим. Выдача совпадает с полным перебором всех алиасов.
+    """
+
+    def __init__(self):
+        self.aliases = {}    # anime -> tuple[(c, c_tokens, c_compact), ...]
+        self.trigrams = {}   # триграмма -> set(anime)
+        self.by_length = {}  # длина алиаса (обычного и слитного) -> set(anime)
+        self._matrix = None  # кэш для пакетной оценки через numpy
+        self.ready = False
+
+    @staticmethod
+    def _build_aliases(anime_name: str, english_names) -> tuple:
+        raw = {anime_name, ru_to_latin(anime_name), compact_search_text(anime_name)}
+        for english_name in english_names:
+            raw.add(english_name or "")
+            raw.add(compact_search_text(english_name or ""))
+
+        prepared = {}
+        for alias in raw:
+            c, c_tokens, c_compact = _prepare_search_text(alias)
+            if c:
+                prepared[c] = (c, c_tokens, c_compact)
+        return tuple(prepared.values())
+
+    @staticmethod
+    def _alias_keys(aliases) -> tuple:
+        grams = set()
+        lengths = set()
+        for c, _, c_compact in aliases:
+            grams |= _trigrams(c)
+            grams |= _trigrams(c_compact)
+            lengths.add(len(c))
+            lengths.add(len(c_compact))
+        return grams, lengths
+
+    def _put(self, anime_name: str, aliases: tuple):
+        self._matrix = None
+        self.aliases[anime_name] = aliases
+        grams, lengths = self._alias_keys(aliases)
+        for gram in grams:
+            self.trigrams.setdefault(gram, set()).add(anime_name)
+        for length in lengths:
+            self.by_length.setdefault(length, set()).add(anime_name)
+
+    def _drop(self, anime_name: str):
+        self._matrix = None
+        aliases = self.aliases.pop(anime_name, None)
+        if not aliases:
+            return
+        grams, lengths = self._alias_keys(aliases)
+        for index, keys in ((self.trigrams, grams), (self.by_length, lengths)):
+            for key in keys:
+                postings = index.get(key)
+                if postings is not None:
+                    postings.discard(anime_name)
+                    if not postings:
+                        del index[key]
+
+    async def rebuild(self):
+        rows = await DB.fetchall("SELECT DISTINCT anime, COALESCE(english_name, '') FROM videos")
+        names = {}
+        for anime_name, english_name in rows:
+            if anime_name:
+                names.setdefault(anime_name, set()).add(english_name)
+
+        self.aliases = {}
+        self.trigrams = {}
+        self.by_length = {}
+        for anime_name, english_names in names.items():
+            self._put(anime_name, self._build_aliases(anime_name, english_names))
+        self.ready = True
+
+    async def refresh(self, anime_name: str):
+        """Пересобирает алиасы одного аниме (или убирает его, если серий не осталось)."""
+        if not self.ready:
+            return
+        rows = await DB.fetchall(
+            "SELECT DISTINCT COALESCE(english_name, '') FROM videos WHERE anime=?",
+            (anime_name,)
+        )
+        english_names = {row[0] for row in rows}
+        self._drop(anime_name)
+        if english_names:
+            self._put(anime_name, self._build_aliases(anime_name, english_names))
+
+    def _candidates(self, prepared_q, threshold: float) -> set:
+        """Аниме, которые вообще могут набрать threshold хотя бы по одному варианту запроса."""
+        candidates = set()
+
+        for q, q_tokens, q_compact in prepared_q:
+            for gram in _trigrams(q) | _trigrams(q_compact):
+                candidates |= self.trigrams.get(gram, set())
+
+            # ratio(q, c) <= 200 * min(n, m) / (n + m): порог достижим только при
+            # n * t / (200 - t) <= m <= n * (200 - t) / t. Границы округляем наружу.
+            # Остальные длины отсекаются без потерь.
+            for n in {len(q), len(q_compact)}:
+                if not n:
+                    continue
+                min_len = math.floor(n * threshold / (200.0 - threshold))
+                max_len = math.ceil(n * (200.0 - threshold) / threshold)
+                for length, animes in self.by_length.items():
+                    if min_len <= length <= max_len:
+                        candidates |= animes
+
+            if max(len(token) for token in q_tokens) >= 3:
+                continue
+
+            # Все слова запроса короче трёх букв — совпадение по словам
+            # триграммами не гарантируется, проверяем его полным проходом.
+            for anime_name, aliases in self.aliases.items():
+                if anime_name in candidates:
+                    continue
+                for c, c_tokens, c_compact in aliases:
+                    if all(any(token in c_token for c_token in c_tokens) for token in q_tokens):
+                        candidates.add(anime_name)
+                        break
+
+        return candidates
+
+    def _batch_matrix(self):
+        """Матрица кодов всех алиасов для numpy-оценки (пересобирается после изменений)."""
+        if self._matrix is None:
+            texts = sorted({text for aliases in self.aliases.values()
+                            for c, _, c_compact in aliases for text in (c, c_compact)})
+            self._matrix = (
+                {text: row for row, text in enumerate(texts)},
+                _encode_rows(texts),
+                np.array([len(t) for t in texts], dtype=np.int64),
+            )
+        return self._matrix
+
+    def _batch_scores(self, prepared_q, candidates) -> dict:
+        """(запрос, алиас) -> ratio для всех кандидатов одним проходом numpy."""
+        rows_of, codes, lengths = self._batch_matrix()
+        texts = {text for anime_name in candidates
+                 for c, _, c_compact in self.aliases[anime_name] for text in (c, c_compact)}
+        texts = sorted(texts)
+        rows = np.array([rows_of[text] for text in texts], dtype=np.int64)
+        sub_lengths = lengths[rows]
+        sub_codes = codes[rows, :int(sub_lengths.max())]
+
+        scores = {}
+        for query in {p[0] for p in prepared_q} | {p[2] for p in prepared_q}:
+            if query:
+                for text, ratio in zip(texts, _batch_ratio(query, sub_codes, sub_lengths).tolist()):
+                    scores[query, text] = ratio
+        return scores
+
+    def search(self, q_variants, threshold: float) -> list:
+        """Возвращает [(score, anime), ...] для всех аниме с оценкой >= threshold."""
+        # Индекс строит main() до приёма апдейтов; до этого искать не в чем.
+        if not self.ready:
+            return []
+
+        prepared_q = [_prepare_search_text(qv) for qv in q_variants]
+        prepared_q = [p for p in prepared_q if p[0]]
+        if not prepared_q:
+            return []
+
+        candidates = self._candidates(prepared_q, threshold)
+
+        batch = None
+        if (np is not None and len(candidates) * 2 >= _BATCH_MIN_ROWS
+                and max(len(p[0]) for p in prepared_q) <= _BATCH_MAX_QUERY):
+            batch = self._batch_scores(prepared_q, candidates)
+
+        patterns = {}
+        if batch is None:
+            for q, _, q_compact in prepared_q:
+                patterns[q] = _bit_pattern(q)
+                patterns[q_compact] = _bit_pattern(q_compact)
+
+        scored = []
+        for anime_name in candidates:
+            best = 0.0
+            for q, q_tokens, q_compact in prepared_q:
+                for c, c_tokens, c_compact in self.aliases[anime_name]:
+                    score = _exact_tier_score(q, q_tokens, c, c_tokens)
+                    if score:
+                        best = max(best, score)
+                    else:
+                        # difflib только там, где верхняя оценка LCS ещё достаёт до порога
+                        for a, b in ((q, c), (q_compact, c_compact)):
+                            if not a or not b:
+                                continue
+                            floor = max(best, threshold) - _RATIO_EPS
+                            if batch is not None:
+                                bound = batch[a, b]
+                            else:
+                                bound = _bounded_ratio(patterns[a], b, floor)
+                            if bound >= floor:
+                                best = max(best, _difflib_ratio(a, b))
+                    if best >= 100.0:
+                        break
+                if best >= 100.0:
+                    break
+
+            if best >= threshold:
+                scored.append((best, anime_name))
+
+        return scored
+
+
+SEARCH_INDEX = SearchIndex()
+
+
+def fuzzy_rank_anime(query_text: str) -> list:
     """Ищет аниме по русскому названию, english_name и опечаткам.
 
-    Работает без внешних библиотек, через difflib.
-    Возвращает: (anime_names, next_offset)
+    Работает через заранее подготовленный SEARCH_INDEX; numpy необязателен
+    (с ним похожесть считается пакетно для всех кандидатов сразу).
+    Возвращает полный список названий, от лучшего совпадения к худшему.
     """
     q = normalize_search_text(query_text)
     if not q:
-        return [], ""
+        return []
 
     # Для очень коротких запросов оставляем более строгий порог, чтобы не выдавать мусор.
     if len(q) <= 2:
@@ -6898,42 +8697,21 @@ def fuzzy_search_anime(query_text: str, offset: int = 0, limit: int = PAGE_SIZE)
     q_variants = {q, compact_search_text(q), ru_to_latin(q)}
     q_variants = {x for x in q_variants if x}
 
-    cursor.execute(
-        """
-        SELECT DISTINCT anime, COALESCE(english_name, '')
-        FROM videos
-        ORDER BY anime
-        """
-    )
-
-    scored = []
-    seen = set()
+    scored = SEARCH_INDEX.search(q_variants, threshold)
 
-    for anime_name, english_name in cursor.fetchall():
-        if not anime_name or anime_name in seen:
-            continue
+    scored.sort(key=lambda x: (-x[0], x[1]))
+    return [anime for _, anime in scored]
 
-        aliases = {
-            anime_name,
-            english_name or "",
-            ru_to_latin(anime_name),
-            compact_search_text(anime_name),
-            compact_search_text(english_name or ""),
-        }
-        aliases = {a for a in aliases if a}
 
-        best = 0.0
-        for qv in q_variants:
-            for alias in aliases:
-                best = max(best, title_match_score(qv, alias))
+def fuzzy_search_anime(query_text: str, offset: int = 0, limit: int = PAGE_SIZE):
+    """Страница результатов fuzzy_rank_anime.
 
-        if best >= threshold:
-            scored.append((best, anime_name))
-            seen.add(anime_name)
+    Возвращает: (anime_names, next_offset)
+    """
+    return paginate_names(fuzzy_rank_anime(query_text), offset, limit)
 
-    scored.sort(key=lambda x: (-x[0], x[1]))
-    matched = [anime for _, anime in scored]
 
+def paginate_names(matched: list, offset: int, limit: int = PAGE_SIZE):
     page = matched[offset:offset + limit]
     next_offset = str(offset + limit) if offset + limit < len(matched) else ""
     return page, next_offset
@@ -6959,6 +8737,96 @@ def parse_genre_inline_query(raw_query: str) -> tuple[bool, str]:
     return False, ""
 
 
+HYDRATE_SEMAPHORE = asyncio.Semaphore(INLINE_HYDRATE_CONCURRENCY)
+HYDRATION_TASKS = set()  # догрузки, не успевшие к ответу (держим ссылки до завершения)
+
+
+async def _hydrate_anime(anime_name: str):
+    async with HYDRATE_SEMAPHORE:
+        try:
+            return await load_anime_info(anime_name)
+        except Exception as e:
+            logging.warning(f"[inline] Не удалось загрузить данные для {anime_name}: {e}")
+            return None
+
+
+async def hydrate_inline_cards(anime_names: list) -> tuple[list, bool]:
+    """Данные карточек для страницы inline-результатов, в том же порядке.
+
+    Загрузка идёт параллельно (не больше INLINE_HYDRATE_CONCURRENCY запросов).
+    Что не успело за INLINE_HYDRATE_DEADLINE секунд, отдаётся заглушкой и
+    догружается в фоне — к следующему запросу данные уже будут в anime_info.
+    Возвращает: (cards, complete) — complete=False, если были заглушки.
+    """
+    if not anime_names:
+        return [], True
+
+    tasks = [asyncio.create_task(_hydrate_anime(anime_name)) for anime_name in anime_names]
+    done, _ = await asyncio.wait(tasks, timeout=INLINE_HYDRATE_DEADLINE)
+
+    cards = []
+    for anime_name, task in zip(anime_names, tasks):
+        if task in done:
+            cards.append(task.result())
+        else:
+            HYDRATION_TASKS.add(task)
+            task.add_done_callback(HYDRATION_TASKS.discard)
+            cards.append((anime_name, None, "—", "—", "—"))
+
+    return cards, len(done) == len(tasks)
+
+
+async def inline_ranking(mode: str, text: str) -> list:
+    """Полный ранжированный список аниме для inline-запроса (с кэшем).
+
+    mode: "genre" — по жанру, "all" — весь каталог, "search" — умный поиск.
+    """
+    if mode == "search":
+        # Умный поиск: название + исправление случайной раскладки.
+        fixed_search_text = fix_keyboard_layout(text)
+        key = (CATALOG.version, mode, normalize_search_text(fixed_search_text), normalize_search_text(text))
+    else:
+        key = (CATALOG.version, mode, text.casefold())
+
+    matched_animes = INLINE_RESULTS_CACHE.get(key)
+    if matched_animes is not None:
+        return matched_animes
+
+    if mode == "genre":
+        # Ищем именно по базе anime_info.genres. Фильтрация через Python/casefold,
+        # чтобы русские жанры искались без проблем с регистром SQLite.
+        rows = await DB.fetchall(
+            """
+            SELECT DISTINCT v.anime, COALESCE(ai.genres, '')
+            FROM videos v
+            JOIN anime_info ai ON ai.anime = v.anime
+            WHERE ai.genres IS NOT NULL
+              AND ai.genres != ''
+              AND ai.genres != '—'
+            ORDER BY v.anime
+            """
+        )
+
+        genre_key = text.casefold()
+        matched_animes = []
+        for anime_name, genres in rows:
+            if genre_key in (genres or "").casefold():
+                matched_animes.append(anime_name)
+
+    elif mode == "all":
+        matched_animes = list(CATALOG.animes)
+
+    else:
+        matched_animes = fuzzy_rank_anime(fixed_search_text)
+
+        # Если после исправления ничего нет — пробуем оригинальный текст.
+        if not matched_animes and fixed_search_text != text:
+            matched_animes = fuzzy_rank_anime(text)
+
+    INLINE_RESULTS_CACHE.set(key, matched_animes)
+    return matched_animes
+
+
 @router.inline_query(F.query)
 async def inline_search(query: types.InlineQuery):
     raw_text = query.query.strip()
@@ -6992,57 +8860,26 @@ async def inline_search(query: types.InlineQuery):
             )
             return
 
-        # Ищем именно по базе anime_info.genres. Фильтрация через Python/casefold,
-        # чтобы русские жанры искались без проблем с регистром SQLite.
-        cursor.execute(
-            """
-            SELECT DISTINCT v.anime, COALESCE(ai.genres, '')
-            FROM videos v
-            JOIN anime_info ai ON ai.anime = v.anime
-            WHERE ai.genres IS NOT NULL
-              AND ai.genres != ''
-              AND ai.genres != '—'
-            ORDER BY v.anime
-            """
-        )
-
-        genre_key = genre_text.casefold()
-        matched_animes = []
-        for anime_name, genres in cursor.fetchall():
-            if genre_key in (genres or "").casefold():
-                matched_animes.append(anime_name)
-
-        page_items = matched_animes[offset:offset + PAGE_SIZE]
-        rows = [(anime_name,) for anime_name in page_items]
-        next_offset = str(offset + PAGE_SIZE) if offset + PAGE_SIZE < len(matched_animes) else ""
+        matched_animes = await inline_ranking("genre", genre_text)
 
     elif search_text == "all":
-        cursor.execute(
-            "SELECT DISTINCT anime FROM videos ORDER BY anime LIMIT ? OFFSET ?",
-            (PAGE_SIZE, offset)
-        )
-        rows = cursor.fetchall()
-        next_offset = str(offset + PAGE_SIZE) if len(rows) == PAGE_SIZE else ""
+        matched_animes = await inline_ranking("all", search_text)
 
     else:
-        # Умный поиск: название + исправление случайной раскладки.
-        fixed_search_text = fix_keyboard_layout(search_text)
+        matched_animes = await inline_ranking("search", search_text)
 
-        matched_animes, next_offset = fuzzy_search_anime(fixed_search_text, offset, PAGE_SIZE)
-
-        # Если после исправления ничего нет — пробуем оригинальный текст.
-        if not matched_animes and fixed_search_text != search_text:
-            matched_animes, next_offset = fuzzy_search_anime(search_text, offset, PAGE_SIZE)
-
-        rows = [(anime_name,) for anime_name in matched_animes]
+    # Следующие страницы берутся срезом из закэшированного списка.
+    page_items, next_offset = paginate_names(matched_animes, offset, PAGE_SIZE)
+    rows = [(anime_name,) for anime_name in page_items]
 
     if not rows:
         await query.answer([], cache_time=1, is_personal=True)
         return
 
+    cards, complete = await hydrate_inline_cards([anime_name for (anime_name,) in rows])
+
     results = []
-    for (anime_name,) in rows:
-        data = await load_anime_info(anime_name)
+    for data in cards:
         if not data:
             continue
 
@@ -7056,7 +8893,7 @@ async def inline_search(query: types.InlineQuery):
         else:
             description = f"⭐ {score} | 🎭 {genres} | 📅 {year}"
 
-        anime_id = get_or_create_anime_id(anime_name)
+        anime_id = await get_or_create_anime_id(anime_name)
 
         results.append(
             InlineQueryResultArticle(
@@ -7071,10 +8908,12 @@ async def inline_search(query: types.InlineQuery):
             )
         )
 
+    # Результаты одинаковы для всех пользователей — пусть Telegram кэширует их сам.
+    # Страницу с заглушками надолго не кэшируем: через пару секунд данные догрузятся.
     await query.answer(
         results=results,
-        cache_time=1,
-        is_personal=True,
+        cache_time=INLINE_CACHE_TIME if complete else 1,
+        is_personal=False,
         next_offset=next_offset
     )
 
@@ -7084,37 +8923,21 @@ async def show_ranges(call: types.CallbackQuery):
     user_id = call.from_user.id
     _, dub_hash = call.data.split("|")
 
-    cursor.execute("SELECT anime, dub, season FROM videos")
-    rows = cursor.fetchall()
-
-    anime = dub = season = None
-    for a, d, s in rows:
-        if make_cb_id(a, d, str(s)) == dub_hash:
-            anime, dub, season = a, d, s
-            break
+    anime, dub, season = resolve_dub_hash(dub_hash) or (None, None, None)
 
     if not anime:
         await call.answer("❌ Ошибка данных", show_alert=True)
         return
 
-    cursor.execute(
-        "SELECT episode FROM videos WHERE anime=? AND dub=? AND season=? ORDER BY episode",
-        (anime, dub, season)
-    )
-    episodes = [row[0] for row in cursor.fetchall()]
-    if not episodes:
+    # Блок = страница списка серий; подписи — реальные номера первой и последней серии
+    blocks = CATALOG.episode_blocks(anime, dub, season, EPISODES_PER_PAGE)
+    if not blocks:
         await call.answer("❌ Серий нет", show_alert=True)
         return
 
-    EPISODES_PER_BLOCK = 50
-    total_blocks = (len(episodes) + EPISODES_PER_BLOCK - 1) // EPISODES_PER_BLOCK
-
     builder = InlineKeyboardBuilder()
 
-    for block in range(total_blocks):
-        start_ep = block * EPISODES_PER_BLOCK + 1
-        end_ep = min((block + 1) * EPISODES_PER_BLOCK, len(episodes))
-
+    for block, (start_ep, end_ep) in enumerate(blocks):
         builder.add(
             InlineKeyboardButton(
                 text=f"{start_ep}–{end_ep}",
@@ -7167,28 +8990,28 @@ async def inline_trigger_to_search(message: types.Message):
         await live_search(message)
 
 # =========================
-# Твой существующий callback без изменений
+# Карточка аниме
 # =========================
-@router.callback_query(lambda c: c.data.startswith("anime_index|"))
+@router.callback_query(F.data.startswith("anime_card|") | F.data.startswith("anime_index|"))
 async def anime_selected(call: types.CallbackQuery):
-    user_id = call.from_user.id
-
-    _, idx_str = call.data.split("|")
-    idx = int(idx_str)
-
-    cursor.execute("SELECT DISTINCT anime FROM videos ORDER BY anime")
-    animes = [row[0] for row in cursor.fetchall()]
-
-    if idx < 0 or idx >= len(animes):
+    anime = await resolve_anime_callback(call.data)
+    if not anime:
         await call.answer("❌ Ошибка: аниме не найдено", show_alert=True)
         return
 
-    anime = animes[idx]
+    await show_anime_card(call.from_user.id, call.message, anime)
+    await call.answer()
+
+
+async def show_anime_card(user_id: int, message: types.Message, anime: str, replace: bool = True):
+    """Карточка тайтла: постер, рейтинг, описание, закладки и сезоны.
 
+    replace=True — удалить message (сообщение бота, из которого пришли).
+    """
     # ✅ ОСНОВНЫЕ ДАННЫЕ (как в inline)
     data = await load_anime_info(anime)
     if not data:
-        await send_and_track(user_id, call.message.answer, "❌ Не удалось получить информацию об аниме")
+        await send_and_track(user_id, message.answer, "❌ Не удалось получить информацию об аниме")
         return
 
     anime_name, poster_url, score, genres, year = data
@@ -7222,15 +9045,14 @@ async def anime_selected(call: types.CallbackQuery):
         text += f"\n\n<tg-emoji emoji-id=\"5253742260054409879\">👍</tg-emoji> {first_paragraph}"
 
     # ===== сезоны (НЕ ТРОГАЕМ)
-    cursor.execute("SELECT DISTINCT season FROM videos WHERE anime=? ORDER BY season", (anime,))
-    seasons = [row[0] for row in cursor.fetchall()]
+    seasons = CATALOG.seasons(anime)
 
     builder = InlineKeyboardBuilder()
 
     # --- Статус просмотра и избранное прямо в карточке аниме ---
-    statuses = get_bookmark_status(user_id, anime)
+    statuses = await get_bookmark_status(user_id, anime)
     current = next((s for s in BOOKMARK_STATUSES if s in statuses), None)
-    anime_id = get_or_create_anime_id(anime)
+    anime_id = await get_or_create_anime_id(anime)
 
     builder.row(
         make_status_button(anime_id, current),
@@ -7268,17 +9090,19 @@ async def anime_selected(call: types.CallbackQuery):
 
     kb = builder.as_markup()
 
-    try:
-        await call.message.delete()
-    except:
-        pass
+    if replace:
+        try:
+            await message.delete()
+        except:
+            pass
 
-    # ===== отправка (НЕ ТРОГАЕМ)
+    # ===== отправка (постер по сохранённому file_id, если есть)
     if poster_url:
-        await send_and_track(
+        await send_anime_poster(
             user_id,
-            call.message.answer_photo,
-            photo=poster_url,
+            message.answer_photo,
+            anime,
+            poster_url,
             caption=text,
             parse_mode="HTML",
             reply_markup=kb,
@@ -7287,15 +9111,13 @@ async def anime_selected(call: types.CallbackQuery):
     else:
         await send_and_track(
             user_id,
-            call.message.answer,
+            message.answer,
             text,
             parse_mode="HTML",
             reply_markup=kb,
             protect_content=True
         )
 
-    await call.answer()
-
 
 
 
@@ -7312,22 +9134,21 @@ async def back_to_anime(call: types.CallbackQuery):
     if "|" in call.data:
         page = int(call.data.split("|")[1])
 
-    cursor.execute("SELECT DISTINCT anime FROM videos ORDER BY anime")
-    animes = [row[0] for row in cursor.fetchall()]
+    animes = CATALOG.animes
+    start = page * ANIME_PER_PAGE
+    current_animes = animes[start:start + ANIME_PER_PAGE]
+    anime_ids = await get_anime_ids(current_animes)
 
     total_pages = (len(animes) - 1) // ANIME_PER_PAGE + 1
-    start = page * ANIME_PER_PAGE
-    end = start + ANIME_PER_PAGE
-    current_animes = animes[start:end]
 
     builder = InlineKeyboardBuilder()
 
     # --- Кнопки аниме по одной ---
-    for i, anime in enumerate(current_animes, start=start):
+    for anime in current_animes:
         title = anime.title()
         if len(title) > MAX_TITLE_LEN:
             title = title[:MAX_TITLE_LEN - 3] + "..."
-        builder.row(InlineKeyboardButton(text=title, callback_data=f"anime_index|{i}"))
+        builder.row(InlineKeyboardButton(text=title, callback_data=anime_card_callback(anime_ids[anime])))
 
     # --- Навигационные кнопки на одной строке ---
     nav_buttons = []
@@ -7364,24 +9185,16 @@ async def choose_dub_after_season(call: types.CallbackQuery):
         anime_name = None
 
     # Находим anime и season по хэшу
-    cursor.execute("SELECT anime, season FROM videos")
-    rows = cursor.fetchall()
-
     season = None
-    for a, s in rows:
-        if make_cb_id(a, str(s)) == season_hash:
-            anime_name, season = a, s
-            break
+    found = resolve_season_hash(season_hash)
+    if found:
+        anime_name, season = found
 
     if not anime_name or not season:
         await call.answer("❌ Ошибка данных", show_alert=True)
         return
 
-    cursor.execute(
-        "SELECT DISTINCT dub FROM videos WHERE anime=? AND season=? ORDER BY dub",
-        (anime_name, season)
-    )
-    dubs = [row[0] for row in cursor.fetchall()]
+    dubs = CATALOG.dubs(anime_name, season)
 
     if not dubs:
         await call.answer("❌ Озвучек нет", show_alert=True)
@@ -7394,18 +9207,10 @@ async def choose_dub_after_season(call: types.CallbackQuery):
         cb_id = make_cb_id(anime_name, dub, str(season))
         builder.row(InlineKeyboardButton(text=f" {dub}", callback_data=f"dub|{cb_id}", style="primary"))
 
-    # Получаем индекс аниме для кнопки "К аниме"
-    cursor.execute("SELECT DISTINCT anime FROM videos ORDER BY anime")
-    all_animes = [row[0] for row in cursor.fetchall()]
-
-    try:
-        anime_idx = all_animes.index(anime_name)
-    except ValueError:
-        await call.answer("❌ Ошибка данных", show_alert=True)
-        return
+    anime_id = await get_or_create_anime_id(anime_name)
 
     # --- Кнопки возврата на отдельных строках ---
-    builder.row(InlineKeyboardButton(text=" К аниме", callback_data=f"anime_index|{anime_idx}",style="danger",icon_custom_emoji_id="5352759161945867747"))
+    builder.row(InlineKeyboardButton(text=" К аниме", callback_data=anime_card_callback(anime_id),style="danger",icon_custom_emoji_id="5352759161945867747"))
     builder.row(InlineKeyboardButton(text=" Меню", callback_data="back_menu",style="success",icon_custom_emoji_id="5312486108309757006"))
 
     kb = builder.as_markup(row_width=1)
@@ -7430,9 +9235,9 @@ async def refresh_anime_buttons(
     update_favorite: bool = False,
 ):
     """Заменяет только нажатую кнопку, не изменяя остальные кнопки сообщения."""
-    statuses = get_bookmark_status(call.from_user.id, anime)
+    statuses = await get_bookmark_status(call.from_user.id, anime)
     current = next((s for s in BOOKMARK_STATUSES if s in statuses), None)
-    anime_id = get_or_create_anime_id(anime)
+    anime_id = await get_or_create_anime_id(anime)
     markup = call.message.reply_markup
 
     if not markup or not markup.inline_keyboard:
@@ -7472,12 +9277,26 @@ async def refresh_anime_buttons(
             raise
 
 
+def _set_bookmark_status(conn, user_id: int, anime: str, status: str):
+    # Убираем старую категорию просмотра
+    conn.executemany(
+        "DELETE FROM user_bookmarks WHERE user_id=? AND anime=? AND status=?",
+        [(user_id, anime, s) for s in BOOKMARK_STATUSES]
+    )
+
+    # none = отсутствие категории
+    if status != "none":
+        conn.execute(
+            "INSERT OR IGNORE INTO user_bookmarks(user_id, anime, status) VALUES(?,?,?)",
+            (user_id, anime, status)
+        )
+
+
 @router.callback_query(F.data.startswith("set_status|"))
 async def set_status(call: types.CallbackQuery):
     _, anime_id, status = call.data.split("|", 2)
 
-    cursor.execute("SELECT anime FROM anime_catalog WHERE id=?", (anime_id,))
-    row = cursor.fetchone()
+    row = await DB.fetchone("SELECT anime FROM anime_catalog WHERE id=?", (anime_id,))
 
     if not row:
         await call.answer("Аниме не найдено", show_alert=True)
@@ -7485,21 +9304,7 @@ async def set_status(call: types.CallbackQuery):
 
     anime = row[0]
 
-    # Убираем старую категорию просмотра
-    for s in BOOKMARK_STATUSES:
-        cursor.execute(
-            "DELETE FROM user_bookmarks WHERE user_id=? AND anime=? AND status=?",
-            (call.from_user.id, anime, s)
-        )
-
-    # none = отсутствие категории
-    if status != "none":
-        cursor.execute(
-            "INSERT OR IGNORE INTO user_bookmarks(user_id, anime, status) VALUES(?,?,?)",
-            (call.from_user.id, anime, status)
-        )
-
-    db.commit()
+    await DB.transaction(_set_bookmark_status, call.from_user.id, anime, status)
 
     await refresh_anime_buttons(call, anime, update_status=True)
     await call.answer("Сохранено")
@@ -7509,15 +9314,14 @@ async def set_status(call: types.CallbackQuery):
 async def favorite_handler(call: types.CallbackQuery):
     anime_id = call.data.split("|", 1)[1]
 
-    cursor.execute("SELECT anime FROM anime_catalog WHERE id=?", (anime_id,))
-    row = cursor.fetchone()
+    row = await DB.fetchone("SELECT anime FROM anime_catalog WHERE id=?", (anime_id,))
 
     if not row:
         await call.answer("Аниме не найдено", show_alert=True)
         return
 
     anime = row[0]
-    toggle_favorite(call.from_user.id, anime)
+    await toggle_favorite(call.from_user.id, anime)
 
     await refresh_anime_buttons(call, anime, update_favorite=True)
     await call.answer("Избранное изменено")
@@ -7531,44 +9335,23 @@ async def show_episodes_after_dub(call: types.CallbackQuery):
     page = int(parts[2]) if len(parts) > 2 else 0
 
     # Определяем anime, dub, season
-    cursor.execute("SELECT anime, dub, season FROM videos")
-    rows = cursor.fetchall()
-
-    anime = dub = season = None
-
-    for a, d, s in rows:
-        if make_cb_id(a, d, str(s)) == dub_hash:
-            anime, dub, season = a, d, s
-            break
+    anime, dub, season = resolve_dub_hash(dub_hash) or (None, None, None)
 
     if not anime:
         await call.answer("❌ Ошибка данных", show_alert=True)
         return
 
     # Получаем серии
-    cursor.execute(
-        """
-        SELECT episode, file_id
-        FROM videos
-        WHERE anime=? AND dub=? AND season=?
-        ORDER BY episode
-        """,
-        (anime, dub, season)
-    )
-
-    episodes = [(r[0], r[1]) for r in cursor.fetchall()]
+    episodes = CATALOG.episodes(anime, dub, season)
 
     if not episodes:
         await call.answer("❌ Серий нет", show_alert=True)
         return
 
-    EPISODES_PER_PAGE = 50
-    EPISODES_PER_ROW = 5
-
     start = page * EPISODES_PER_PAGE
     end = start + EPISODES_PER_PAGE
 
-    page_episodes = episodes[start:end]
+    page_episodes = CATALOG.episode_page(anime, dub, season, page, EPISODES_PER_PAGE)
 
     builder = InlineKeyboardBuilder()
 
@@ -7620,7 +9403,7 @@ async def show_episodes_after_dub(call: types.CallbackQuery):
     )
 
     # Новая кнопка просмотра нескольких серий
-    if has_multi_episode_access(user_id):
+    if await has_multi_episode_access(user_id):
         builder.row(
             InlineKeyboardButton(
                 text="Смотреть несколько серий",
@@ -7678,8 +9461,7 @@ async def send_video(call: types.CallbackQuery):
         pass
 
     # Проверка подписки
-    cursor.execute("SELECT expire_date FROM subscriptions WHERE user_id=?", (user_id,))
-    row = cursor.fetchone()
+    row = await DB.fetchone("SELECT expire_date FROM subscriptions WHERE user_id=?", (user_id,))
 
     has_sub = False
 
@@ -7732,20 +9514,14 @@ async def send_video(call: types.CallbackQuery):
     _, ep_hash, page = call.data.split("|")
     page = int(page)
 
-    cursor.execute("SELECT anime, dub, season, episode, file_id FROM videos")
-    rows = cursor.fetchall()
-    anime = dub = season = ep = file_id = None
-    for a, d, s, e, f in rows:
-        if make_cb_id(a, d, str(s), str(e)) == ep_hash:
-            anime, dub, season, ep, file_id = a, d, s, e, f
-            break
+    anime, dub, season, ep, file_id = resolve_episode_hash(ep_hash) or (None,) * 5
 
     if not file_id:
         await call.answer("❌ Видео не найдено", show_alert=True)
         return
       
     # 🔥 СОХРАНЯЕМ ПРОГРЕСС
-    save_watch_progress(user_id, anime, dub, season, ep)
+    await save_watch_progress(user_id, anime, dub, season, ep)
 
     episode_caption = format_episode_caption(season, ep)
     caption = f"<b>{anime.title()}</b>\n<b><i>{dub}</i></b>\n<i>{episode_caption}</i>"
@@ -7754,25 +9530,26 @@ async def send_video(call: types.CallbackQuery):
     builder = InlineKeyboardBuilder()
     nav_buttons = []
 
-    cursor.execute("SELECT 1 FROM videos WHERE anime=? AND dub=? AND season=? AND episode=?", (anime, dub, season, ep - 1))
-    prev_exists = cursor.fetchone()
-    cursor.execute("SELECT 1 FROM videos WHERE anime=? AND dub=? AND season=? AND episode=?", (anime, dub, season, ep + 1))
-    next_exists = cursor.fetchone()
+    # Ближайшие существующие серии: пропуск в нумерации не прячет кнопку.
+    # Страница в callback — та, на которой серия стоит в списке.
+    prev_ep, next_ep = CATALOG.neighbours(anime, dub, season, ep)
 
-    if prev_exists:
+    if prev_ep is not None:
         nav_buttons.append(
             InlineKeyboardButton(
-                text=f" {ep-1} серия",
-                callback_data=f"ep|{make_cb_id(anime, dub, str(season), str(ep - 1))}|{page}",
+                text=f" {prev_ep} серия",
+                callback_data=f"ep|{make_cb_id(anime, dub, str(season), str(prev_ep))}|"
+                              f"{CATALOG.episode_position(anime, dub, season, prev_ep) // EPISODES_PER_PAGE}",
                 style="primary"
             )
         )
 
-    if next_exists:
+    if next_ep is not None:
         nav_buttons.append(
             InlineKeyboardButton(
-                text=f"{ep+1} серия ",
-                callback_data=f"ep|{make_cb_id(anime, dub, str(season), str(ep + 1))}|{page}",
+                text=f"{next_ep} серия ",
+                callback_data=f"ep|{make_cb_id(anime, dub, str(season), str(next_ep))}|"
+                              f"{CATALOG.episode_position(anime, dub, season, next_ep) // EPISODES_PER_PAGE}",
                 style="primary"
             )
         )
@@ -7809,7 +9586,7 @@ async def send_episode(
     file_id,
     page=0
 ):
-    save_watch_progress(user_id, anime, dub, season, ep)
+    await save_watch_progress(user_id, anime, dub, season, ep)
 
     episode_caption = format_episode_caption(season, ep)
     caption = (
@@ -7878,52 +9655,248 @@ async def cleanup_old_records():
     while True:
         try:
             print("[Cleanup] Начинаем очистку старых invoice...")
-            cursor.execute(
+            await DB.execute(
                 "DELETE FROM processed_invoices WHERE created_at < datetime('now', '-7 days')"
             )
-            db.commit()
+            # Загруженные через /darling видео больше не нужны в очереди
+            await DB.execute(
+                "DELETE FROM pending_videos WHERE status='ingested' AND ingested_at < ?",
+                ((datetime.now() - timedelta(seconds=PENDING_VIDEOS_TTL)).isoformat(),)
+            )
             print("[Cleanup] Очистка завершена.")
         except Exception as e:
             print(f"[Cleanup] Ошибка при очистке: {e}")
         await asyncio.sleep(24 * 60 * 60)  # 1 день
 
-async def on_startup(dp: Dispatcher):
-    print("Бот стартовал!")
+async def wal_checkpoint_worker():
+    """Периодически переносит WAL в anime.db, чтобы -wal файл не рос бесконечно."""
+    while True:
+        await asyncio.sleep(DB_CHECKPOINT_INTERVAL)
+        try:
+            busy, wal_pages, moved = await DB.checkpoint()
+            if busy or wal_pages != moved:
+                # Кто-то читает старый снимок — попробуем в следующий раз.
+                logging.info(f"[DB] Чекпоинт частичный: {moved}/{wal_pages} страниц")
+        except Exception as e:
+            logging.warning(f"[DB] Ошибка чекпоинта: {e}")
 
-async def start_webhook():
-    runner = web.AppRunner(app)
-    await runner.setup()
-    ssl_context = build_ssl_context()
-    site = web.TCPSite(runner, "0.0.0.0", WEBHOOK_PORT, ssl_context=ssl_context)
-    await site.start()
-    scheme = "HTTPS" if ssl_context else "HTTP"
-    print(f"Webhook сервер запущен на порту {WEBHOOK_PORT} ({scheme})")
+# =========================
+# Фоновая догрузка метаданных
+# =========================
+PREFETCH_QUEUE = asyncio.Queue()
+PREFETCH_QUEUED = set()
+
+
+def enqueue_metadata_prefetch(anime: str):
+    if anime not in PREFETCH_QUEUED:
+        PREFETCH_QUEUED.add(anime)
+        PREFETCH_QUEUE.put_nowait(anime)
+
+
+async def find_titles_to_prefetch() -> list:
+    """Тайтлы каталога без постера/метаданных/описания или с устаревшими данными.
+
+    Сначала те, у которых данных нет совсем, затем самые старые.
+    """
+    # Всё, что есть в videos, должно иметь ID в anime_catalog.
+    rows = await DB.fetchall("""
+        SELECT DISTINCT v.anime
+        FROM videos v
+        LEFT JOIN anime_catalog c ON c.anime = v.anime
+        WHERE c.anime IS NULL
+    """)
+    for (anime,) in rows:
+        await get_or_create_anime_id(anime)
+
+    stale_before = (datetime.now() - timedelta(seconds=META_DB_TTL)).isoformat()
+    rows = await DB.fetchall(
+        """
+        SELECT c.anime
+        FROM anime_catalog c
+        LEFT JOIN anime_info i ON i.anime = c.anime
+        WHERE i.anime IS NULL
+           OR i.poster IS NULL
+           OR i.score IS NULL
+           OR i.genres IS NULL
+           OR i.year IS NULL
+           OR i.description IS NULL
+           OR i.fetched_at IS NULL
+           OR i.fetched_at < ?
+        ORDER BY i.fetched_at IS NOT NULL, i.fetched_at
+        """,
+        (stale_before,)
+    )
+    return [row[0] for row in rows]
+
+
+async def prefetch_anime_metadata(anime: str):
+    """Обновляет описание/рейтинг/жанры/год одного тайтла (запросы к Shikimori)."""
+    META_CACHE.pop(anime)
+    return await get_anime_info(anime)
+
+
+async def prefetch_posters(infos: dict):
+    """Постеры для тайтлов пачки, у которых их ещё нет: один запрос в AniList на всю пачку.
+
+    infos — anime -> ответ get_anime_info; постер Shikimori идёт запасным вариантом.
+    """
+    if not infos:
+        return
+
+    placeholders = ", ".join("?" for _ in infos)
+    rows = await DB.fetchall(
+        f"""
+        SELECT t.name, COALESCE(NULLIF(t.english_name, ''), t.name)
+        FROM titles t
+        LEFT JOIN anime_info i ON i.anime = t.name
+        WHERE t.name IN ({placeholders}) AND i.poster IS NULL
+        """,
+        list(infos)
+    )
+    if not rows:
+        return
+
+    english_names = [english for _, english in rows if not NEGATIVE_CACHE.get(("anilist", english))]
+    try:
+        posters = await ANILIST_POSTERS.resolve_many(english_names)
+    except Exception as e:
+        print(f"[Prefetch] AniList недоступен: {e}")
+        posters = {}
+
+    for english in english_names:
+        # Кэшируем «не найдено», только если AniList ответил про это название
+        if english in posters and not posters[english]:
+            NEGATIVE_CACHE.set(("anilist", english), True)
+
+    for anime, english in rows:
+        poster_url = posters.get(english) or fix_shiki_poster(infos[anime].get("poster"))
+        if poster_url:
+            await DB.execute(
+                "INSERT INTO anime_info (anime, poster) VALUES (?, ?) "
+                "ON CONFLICT(anime) DO UPDATE SET poster=COALESCE(anime_info.poster, excluded.poster)",
+                (anime, poster_url)
+            )
+
+
+async def metadata_prefetch_worker():
+    """Проходит по каталогу и заполняет anime_info заранее, с фиксированным темпом.
+
+    Так первый пользователь, открывший тайтл, читает уже готовые данные из базы.
+    """
+    last_scan = 0.0
 
-async def cleanup_old_records():
     while True:
         try:
-            print("[Cleanup] Начинаем очистку старых invoice...")
-            cursor.execute(
-                "DELETE FROM processed_invoices WHERE created_at < datetime('now', '-7 days')"
-            )
-            db.commit()
-            print("[Cleanup] Очистка завершена.")
+            if PREFETCH_QUEUE.empty():
+                wait = METADATA_PREFETCH_RESCAN - (time.monotonic() - last_scan)
+                if last_scan and wait > 0:
+                    # Ждём новые тайтлы из on_catalog_changed или следующего пересканирования.
+                    try:
+                        anime = await asyncio.wait_for(PREFETCH_QUEUE.get(), timeout=wait)
+                    except asyncio.TimeoutError:
+                        continue
+                    PREFETCH_QUEUE.put_nowait(anime)
+                    continue
+
+                last_scan = time.monotonic()
+                titles = await find_titles_to_prefetch()
+                for anime in titles:
+                    enqueue_metadata_prefetch(anime)
+                print(f"[Prefetch] В очереди на обновление метаданных: {len(titles)}")
+                continue
+
+            # Берём сразу пачку: Shikimori — строго по одному тайтлу в темпе
+            # METADATA_PREFETCH_INTERVAL, постеры для всей пачки — одним запросом в AniList.
+            batch = []
+            while not PREFETCH_QUEUE.empty() and len(batch) < ANILIST_POSTERS.max_batch:
+                anime = PREFETCH_QUEUE.get_nowait()
+                PREFETCH_QUEUED.discard(anime)
+                batch.append(anime)
+
+            infos = {}
+            for anime in batch:
+                try:
+                    info = await prefetch_anime_metadata(anime)
+                    if info:
+                        infos[anime] = info
+                except Exception as e:
+                    print(f"[Prefetch] Ошибка для {anime}: {e}")
+                await asyncio.sleep(METADATA_PREFETCH_INTERVAL)
+
+            await prefetch_posters(infos)
+            continue
+
         except Exception as e:
-            print(f"[Cleanup] Ошибка при очистке: {e}")
-        await asyncio.sleep(24 * 60 * 60)  # 1 день
+            print(f"[Prefetch] Ошибка: {e}")
+
+        await asyncio.sleep(METADATA_PREFETCH_INTERVAL)
+
+
+def _log_phase(name: str, started: float) -> float:
+    now = time.perf_counter()
+    logging.info(f"[Startup] {name}: {(now - started) * 1000:.0f} мс")
+    return now
+
 
 async def main():
-    # Удаляем webhook Telegram (если он был установлен)
-    await bot.delete_webhook(drop_pending_updates=True)
+    if TELEGRAM_DELIVERY not in ("polling", "webhook"):
+        raise RuntimeError(f"TELEGRAM_DELIVERY должен быть polling или webhook, а не {TELEGRAM_DELIVERY!r}")
+    if TELEGRAM_DELIVERY == "webhook" and not TELEGRAM_WEBHOOK_URL:
+        raise RuntimeError("Для TELEGRAM_DELIVERY=webhook нужен TELEGRAM_WEBHOOK_URL или WEBHOOK_FULL_URL")
+
+    started = phase = time.perf_counter()
 
-    # Запускаем вебхук сервер для CryptoBot
+    # Схема базы — одной транзакцией
+    await DB.write(init_db)
+    phase = _log_phase("схема БД", phase)
+
+    # Снимок каталога (с хэшами callback) и поисковый индекс
+    await rebuild_catalog()
+    await SEARCH_INDEX.rebuild()
+    phase = _log_phase("индексы каталога", phase)
+
+    # Общий HTTP-клиент для Shikimori / AniList / CryptoBot / YooKassa
+    await HTTP.start()
+
+    # Запускаем вебхук сервер для CryptoBot / YooKassa / YooMoney (и Telegram)
     await start_webhook()
+    phase = _log_phase("HTTP-сервер", phase)
 
-    # Запускаем очистку invoice
+    # Запускаем очистку invoice и периодический чекпоинт WAL
     asyncio.create_task(cleanup_old_records())
+    asyncio.create_task(wal_checkpoint_worker())
+
+    # Фоновое заполнение anime_info по всему каталогу
+    asyncio.create_task(metadata_prefetch_worker())
 
-    # Запускаем polling Telegram бота
-    await dp.start_polling(bot, skip_updates=True, on_startup=on_startup)
+    # Курсы CryptoBot в памяти
+    if CRYPTOBOT_TOKEN:
+        asyncio.create_task(EXCHANGE_RATES.run())
+
+    try:
+        if TELEGRAM_DELIVERY == "webhook":
+            await bot.set_webhook(
+                TELEGRAM_WEBHOOK_URL,
+                secret_token=TELEGRAM_WEBHOOK_SECRET,
+                allowed_updates=dp.resolve_used_update_types(),
+                max_connections=100,
+                drop_pending_updates=True
+            )
+            phase = _log_phase("setWebhook", phase)
+            _log_phase("старт целиком", started)
+            await on_startup(dp)
+            await asyncio.Event().wait()
+        else:
+            # Удаляем webhook Telegram (если он был установлен)
+            await bot.delete_webhook(drop_pending_updates=True)
+            phase = _log_phase("deleteWebhook", phase)
+            _log_phase("старт целиком", started)
+            await dp.start_polling(bot, skip_updates=True, on_startup=on_startup)
+    finally:
+        # Сначала апдейты: их обработчикам ещё нужны HTTP-клиент и база
+        await stop_telegram_workers()
+        await HTTP.close()
+        DB.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,83 @@
+"""/darling: загрузка из очереди не теряет видео и не пишет их дважды."""
+import os
+import sqlite3
+import sys
+import tempfile
+
+import pytest
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(), "anime.db"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(":memory:")
+    bot.init_db(conn)
+    conn.executemany(
+        "INSERT INTO pending_videos (message_id, file_id, date) VALUES (?, ?, ?)",
+        [(i, f"file{i}", f"2026-01-01 00:00:{i:02d}") for i in range(1, 6)]
+    )
+    conn.commit()
+    yield conn
+    conn.close()
+
+
+def _ingest(conn, claim_token, count, start_episode, season=1):
+    with conn:
+        videos = bot._claim_pending_videos(conn, count, claim_token)
+    with conn:
+        return videos, bot._ingest_claimed_videos(
+            conn, videos, claim_token, "наруто", "AniDub", season, start_episode, None
+        )
+
+
+def _episodes(conn, season=1) -> dict:
+    return dict(conn.execute(
+        "SELECT episode, file_id FROM videos WHERE anime='наруто' AND dub='AniDub' AND season=?",
+        (season,)
+    ).fetchall())
+
+
+def _statuses(conn) -> dict:
+    return dict(conn.execute("SELECT message_id, status FROM pending_videos").fetchall())
+
+
+def test_ingest_into_existing_range_keeps_videos_pending(conn):
+    _, result = _ingest(conn, "first", 2, 1)
+    assert result == (True, [])
+    assert _episodes(conn) == {1: "file1", 2: "file2"}
+
+    # Серия 2 уже есть: ничего не вставляем, видео возвращаются в очередь
+    _, result = _ingest(conn, "second", 2, 2)
+    assert result == (False, [2])
+    assert _episodes(conn) == {1: "file1", 2: "file2"}
+    assert _statuses(conn) == {1: "ingested", 2: "ingested", 3: "pending", 4: "pending", 5: "pending"}
+
+    # С правильным номером те же видео загружаются
+    _, result = _ingest(conn, "third", 2, 3)
+    assert result == (True, [])
+    assert _episodes(conn) == {1: "file1", 2: "file2", 3: "file3", 4: "file4"}
+
+
+def test_film_conflict_is_reported(conn):
+    assert _ingest(conn, "first", 1, 1, season="Фильм")[1] == (True, [])
+    assert _ingest(conn, "second", 1, 1, season="Фильм")[1] == (False, [1])
+    # Сезон 1 с тем же номером серии — другой ключ
+    assert _ingest(conn, "third", 1, 1)[1] == (True, [])
+
+
+def test_lost_claim_inserts_nothing(conn):
+    with conn:
+        videos = bot._claim_pending_videos(conn, 2, "stale")
+        conn.execute("UPDATE pending_videos SET claimed_at='2000-01-01' WHERE claim_token='stale'")
+    _, result = _ingest(conn, "fresh", 2, 1)
+    assert result == (True, [])
+
+    with conn:
+        result = bot._ingest_claimed_videos(conn, videos, "stale", "наруто", "AniDub", 1, 10, None)
+    assert result == (False, [])
+    assert _episodes(conn) == {1: "file1", 2: "file2"}
@@ -0,0 +1,164 @@
+"""Отсев кандидатов в SearchIndex не должен менять выдачу поиска.
+
+Эталон — полный перебор всех алиасов тем же скорером, что и без индекса,
+и отдельно — исходная оценка через difflib, под которую подобраны пороги.
+"""
+import difflib
+import os
+import sys
+import tempfile
+
+import pytest
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(), "anime.db"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+
+CATALOG = {
+    "наруто": "Naruto",
+    "наруто: ураганные хроники": "Naruto Shippuden",
+    "боруто": "Boruto: Naruto Next Generations",
+    "ван пис": "One Piece",
+    "атака титанов": "Shingeki no Kyojin",
+    "клинок, рассекающий демонов": "Kimetsu no Yaiba",
+    "магическая битва": "Jujutsu Kaisen",
+    "человек-бензопила": "Chainsaw Man",
+    "стальной алхимик: братство": "Fullmetal Alchemist: Brotherhood",
+    "тетрадь смерти": "Death Note",
+    "моя геройская академия": "Boku no Hero Academia",
+    "re:zero. жизнь с нуля в альтернативном мире": "Re:Zero kara Hajimeru Isekai Seikatsu",
+    "аля иногда кокетничает со мной по-русски": "Tokidoki Bosotto Russiago de Dereru Tonari no Alya-san",
+    "семья шпиона": "Spy x Family",
+    "ванпанчмен": "One Punch Man",
+    "токийский гуль": "Tokyo Ghoul",
+    "хантер х хантер": "Hunter x Hunter",
+    "евангелион": "Neon Genesis Evangelion",
+    "ковбой бибоп": "Cowboy Bebop",
+    "врата штейна": "Steins;Gate",
+    "ао": "",
+    "к": "K",
+    # Ниже — названия, которые раньше терялись при отсеве по триграммам
+    "табакошка": "Yani Neko",
+    "санда": "Sanda",
+    "хёка": "",
+    "нана": "NANA",
+    "гатиакута": "Gachiakuta",
+    "берсерк": "Kenpuu Denki Berserk",
+    "семь смертных грехов": "Nanatsu no Taizai",
+    "школа-тюрьма": "Prison School",
+    "старшая школа dxd": "High School DxD",
+    "рагна багровый": "Ragna Crimson",
+    "аркнайтс: зимнее уединение": "",
+    "аркнайтс: прелюдия к рассвету": "Arknights: Prelude to Dawn",
+    "аркнайтс: восстание из пепла": "Arknights: Rise from Ember",
+}
+
+QUERIES = [
+    "н", "на", "нар", "нарут", "наруто", "нарутл", "naruto", "naruti", "ywhenj",
+    "ван", "ванпис", "one pice", "onepiece", "атака", "атака титанв", "shingeki",
+    "клинок", "клинок рассекающий", "kimetsu no yaba", "магическя битва", "jujutsu",
+    "бензопила", "chainsaw", "алхимик", "fullmetal alchemist", "тетрадь", "death nite",
+    "геройская", "my hero", "re zero", "рэ зеро", "жизнь с нуля", "аля", "alya san",
+    "семья шпиона", "spy family", "ванпанч", "one punch", "гуль", "tokyo gul",
+    "хантер", "hunter hunter", "ева", "evangelion", "ковбой", "bebop", "штейн",
+    "steins gate", "ао", "к", "x", "ghjcnj", "аниме про титанов", "sword art online",
+    "аркнайтс: восстание из ", "старша", "рагна", "школа-", "аркнай", "накиарут",
+    "рaкнай", "тетрадь смер",
+]
+
+
+def _threshold(q: str) -> float:
+    # Пороги из fuzzy_rank_anime
+    if len(q) <= 2:
+        return 82.0
+    if len(q) <= 4:
+        return 70.0
+    return 58.0
+
+
+def _variants(query: str) -> set:
+    q = bot.normalize_search_text(query)
+    return {x for x in {q, bot.compact_search_text(q), bot.ru_to_latin(q)} if x}
+
+
+def _full_scan(index, q_variants, threshold: float) -> list:
+    prepared_q = [bot._prepare_search_text(qv) for qv in q_variants]
+    prepared_q = [p for p in prepared_q if p[0]]
+    scored = []
+    for anime_name, aliases in index.aliases.items():
+        best = max(
+            bot._match_score_prepared(q, q_tokens, q_compact, c, c_tokens, c_compact)
+            for q, q_tokens, q_compact in prepared_q
+            for c, c_tokens, c_compact in aliases
+        )
+        if best >= threshold:
+            scored.append((best, anime_name))
+    return scored
+
+
+def _difflib_scan(index, q_variants, threshold: float) -> list:
+    """Исходный скорер: точные совпадения, иначе SequenceMatcher.ratio() без отсева."""
+    scored = []
+    for anime_name, aliases in index.aliases.items():
+        best = 0.0
+        for q, q_tokens, q_compact in (bot._prepare_search_text(qv) for qv in q_variants):
+            for c, c_tokens, c_compact in aliases:
+                score = bot._exact_tier_score(q, q_tokens, c, c_tokens)
+                if not score:
+                    score = difflib.SequenceMatcher(None, q, c).ratio() * 100.0
+                    if q_compact and c_compact:
+                        score = max(score, difflib.SequenceMatcher(None, q_compact, c_compact).ratio() * 100.0)
+                best = max(best, score)
+        if best >= threshold:
+            scored.append((best, anime_name))
+    return scored
+
+
+def _ranked(scored) -> list:
+    return [anime for _, anime in sorted(scored, key=lambda x: (-x[0], x[1]))]
+
+
+@pytest.fixture(scope="module")
+def index():
+    index = bot.SearchIndex()
+    for anime_name, english_name in CATALOG.items():
+        index._put(anime_name, index._build_aliases(anime_name, {english_name}))
+    index.ready = True
+    return index
+
+
+@pytest.mark.parametrize("query", QUERIES)
+def test_ranking_matches_full_scan(index, query):
+    q_variants = _variants(query)
+    threshold = _threshold(bot.normalize_search_text(query))
+
+    expected = _ranked(_full_scan(index, q_variants, threshold))
+    actual = _ranked(index.search(q_variants, threshold))
+
+    assert actual[:10] == expected[:10]
+    assert actual == expected
+
+
+@pytest.mark.parametrize("query", QUERIES)
+def test_accepted_titles_match_difflib(index, query):
+    q_variants = _variants(query)
+    threshold = _threshold(bot.normalize_search_text(query))
+
+    expected = _difflib_scan(index, q_variants, threshold)
+    actual = index.search(q_variants, threshold)
+
+    assert {anime for _, anime in actual} == {anime for _, anime in expected}
+    assert _ranked(actual) == _ranked(expected)
+
+
+def test_refresh_keeps_parity(index):
+    index._drop("наруто")
+    index._put("наруто", index._build_aliases("наруто", {"Naruto", "Naruto TV"}))
+
+    for query in ("нарутл", "naruto tv", "ywhenj"):
+        q_variants = _variants(query)
+        threshold = _threshold(bot.normalize_search_text(query))
+        assert _ranked(index.search(q_variants, threshold)) == _ranked(_full_scan(index, q_variants, threshold))
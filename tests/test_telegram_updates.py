@@ -0,0 +1,107 @@
+"""Очереди апдейтов вебхука: порядок у одного пользователя, независимость разных."""
+import asyncio
+import os
+import sys
+import tempfile
+
+import pytest
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(), "anime.db"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+
+def _update(user_id: int, update_id: int) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "test"},
+            "text": "hi",
+        },
+    }
+
+
+class Handled(list):
+    """Обработанные апдейты (user_id, update_id); release_slow отпускает пользователя 1."""
+    release_slow = None
+
+
+@pytest.fixture
+def handled(monkeypatch):
+    """Подменяет dp.feed_update: пользователь 1 «медленный», остальные отвечают сразу."""
+    handled = Handled()
+
+    async def feed_update(_bot, update):
+        user_id = update.message.from_user.id
+        if user_id == 1:
+            await handled.release_slow.wait()
+        handled.append((user_id, update.update_id))
+
+    monkeypatch.setattr(bot.dp, "feed_update", feed_update)
+    monkeypatch.setattr(bot, "TELEGRAM_MAX_CONCURRENT_UPDATES", 4)
+    monkeypatch.setattr(bot, "TELEGRAM_USER_QUEUE_SIZE", 20)
+    monkeypatch.setattr(bot, "TELEGRAM_QUEUE_SIZE", 1000)
+    monkeypatch.setattr(bot, "TELEGRAM_PENDING_UPDATES", 0)
+    monkeypatch.setattr(bot, "TELEGRAM_DROPPED_UPDATES", 0)
+    monkeypatch.setattr(bot, "TELEGRAM_USER_QUEUES", {})
+    monkeypatch.setattr(bot, "TELEGRAM_WORKER_TASKS", set())
+    monkeypatch.setattr(bot, "TELEGRAM_UPDATE_SEMAPHORE", None)
+    return handled
+
+
+def _run(handled, scenario):
+    async def main():
+        bot.TELEGRAM_UPDATE_SEMAPHORE = asyncio.Semaphore(bot.TELEGRAM_MAX_CONCURRENT_UPDATES)
+        handled.release_slow = asyncio.Event()
+        try:
+            await scenario()
+        finally:
+            handled.release_slow.set()
+            await bot.stop_telegram_workers()
+
+    asyncio.run(main())
+
+
+def test_flooding_user_does_not_block_others(handled):
+    async def scenario():
+        # Пользователь 1 присылает больше апдейтов, чем слотов в пуле, и все они висят
+        for update_id in range(1, 11):
+            assert bot.enqueue_telegram_update(_update(1, update_id))
+        for update_id in range(11, 21):
+            assert bot.enqueue_telegram_update(_update(2 + update_id % 5, update_id))
+
+        for _ in range(20):
+            await asyncio.sleep(0)
+        others = [item for item in handled if item[0] != 1]
+        assert len(others) == 10
+
+        handled.release_slow.set()
+        for _ in range(50):
+            await asyncio.sleep(0)
+        assert [update_id for user_id, update_id in handled if user_id == 1] == list(range(1, 11))
+        assert bot.TELEGRAM_PENDING_UPDATES == 0
+        assert bot.TELEGRAM_USER_QUEUES == {}
+
+    _run(handled, scenario)
+
+
+def test_full_user_queue_drops_only_that_user(handled, monkeypatch):
+    monkeypatch.setattr(bot, "TELEGRAM_USER_QUEUE_SIZE", 3)
+
+    async def scenario():
+        accepted = [bot.enqueue_telegram_update(_update(1, update_id)) for update_id in range(1, 7)]
+        # Первый апдейт ещё в очереди (обработчик не успел стартовать), влезают три
+        assert accepted == [True, True, True, False, False, False]
+        assert bot.TELEGRAM_DROPPED_UPDATES == 3
+        assert bot.enqueue_telegram_update(_update(2, 100))
+
+        for _ in range(10):
+            await asyncio.sleep(0)
+        assert (2, 100) in handled
+
+    _run(handled, scenario)